@@ -1,61 +1,263 @@
 # analysis_logic.py
 import streamlit as st
 import pandas as pd
-import json
+import os
 import traceback
-from prompts import select_best_prompt, MODIFY_SQL_TEMPLATE
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from prompts import select_best_prompt, get_prompt_id, MODIFY_SQL_TEMPLATE
+from query_cache import run_query, dataframe_fingerprint, normalize_sql
+from comment_cache import get_comment_cache, make_comment_key
+from rollup import resolve_sheet_table
+from sql_cache import get_sql_cache, SQL_CACHE_ENABLED
+from result_policy import fetch_with_result_policy, describe_result_meta
+from job_manager import current_session_id
+from retry_policy import call_with_retry, classify_error, PERMISSION, QUOTA, TRANSIENT, CANCELLED, CONFIGURATION
+from tracing import start_span, record_llm_usage, set_current_attributes
+from sql_validator import validate_and_repair_sql, describe_problems
+from data_summarizer import summarize_dataframe, summarize_dataframes
+from history_store import add_history_entry
+from cost_guard import estimate_query_cost, check_query_cost, make_job_config, format_cost_estimate, format_bytes, MAX_BYTES_BILLED
 
 MAX_ATTEMPTS = 3
+# 複数レポートを並列実行する際の同時実行ジョブ数の上限
+MAX_CONCURRENT_QUERIES = int(os.environ.get("MAX_CONCURRENT_QUERIES", "6"))
+# Geminiの応答をストリーミングで受け取り、生成途中のテキストを表示する
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "true").lower() == "true"
+# 候補SQLを並列生成するモードの候補数と、候補ごとの生成温度
+SPECULATIVE_CANDIDATES = int(os.environ.get("SPECULATIVE_CANDIDATES", "3"))
+SPECULATIVE_TEMPERATURES = [0.0, 0.4, 0.8]
 
-def json_converter(o):
-    import datetime, decimal
-    if isinstance(o, (datetime.date, datetime.datetime)): return o.isoformat()
-    if isinstance(o, decimal.Decimal): return float(o)
-    return str(o)
+def stream_generate(model, prompt, generation_config=None):
+    """Geminiの応答をテキスト断片として順に返す（ストリーミング無効時は全文を1回で返す）"""
+    kwargs = {"generation_config": generation_config} if generation_config else {}
+    if not GEMINI_STREAMING:
+        response = model.generate_content(prompt, **kwargs)
+        record_llm_usage(getattr(response, "usage_metadata", None))
+        yield response.text
+        return
+    usage = None
+    try:
+        for chunk in model.generate_content(prompt, stream=True, **kwargs):
+            # トークン数は断片ごとに累計値が入るため、最後に受け取った値を記録する
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            try:
+                text = chunk.text
+            except (ValueError, AttributeError):
+                # 安全フィルタ等でテキストを含まない断片は読み飛ばす
+                continue
+            if text:
+                yield text
+    finally:
+        # 呼び出し側が途中で読むのをやめた場合も、それまでに受け取った分を記録する
+        record_llm_usage(usage)
 
-def generate_ai_comment(model, df: pd.DataFrame, graph_cfg: dict) -> str:
+def render_stream(chunks, placeholder=None) -> str:
+    """テキスト断片を受け取りながら placeholder に逐次表示し、全文を返す"""
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        if placeholder is not None:
+            placeholder.info(text + "▌")
+    text = text.strip()
+    if placeholder is not None:
+        placeholder.info(text)
+    return text
+
+def generate_comment_text(model, prompt, placeholder=None, attempts: list = None) -> str:
+    """コメントを生成する。レート制限や一時的な障害の場合は、同じプロンプトで再試行する"""
+    with start_span("gemini.comment", prompt_chars=len(prompt)) as span:
+        text = call_with_retry(lambda: render_stream(stream_generate(model, prompt), placeholder), attempts, label="gemini")
+        span.set_attribute("response_chars", len(text))
+        return text
+
+def generate_ai_comment(model, df: pd.DataFrame, graph_cfg: dict, result_meta: dict = None, force_refresh: bool = False, placeholder=None) -> str:
     try:
-        sample = df.head(10).to_dict(orient="records")
         chart_type = graph_cfg.get('main_chart_type', '未選択')
         analysis_focus = f"「{chart_type}」で可視化しています。"
         if legend_col := graph_cfg.get('legend_col'):
             if legend_col != "なし":
                 analysis_focus += f" 「{legend_col}」でグループ化しています。"
+        if result_note := describe_result_meta(result_meta):
+            analysis_focus += f" {result_note}"
         prompt = f"""
-        以下のデータサンプルとグラフ設定に基づき、ビジネス上の示唆を含む簡潔な分析コメントを出してください。
-        [データサンプル]
-        {json.dumps(sample, ensure_ascii=False, default=json_converter)}
+        以下のデータの要約とグラフ設定に基づき、ビジネス上の示唆を含む簡潔な分析コメントを出してください。
+        [データの要約]
+        {summarize_dataframe(df)}
         [グラフ設定]
         {analysis_focus}
         """
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        # 同じデータ・同じグラフ設定であれば、キャッシュ済みのコメントを再利用する
+        cache_key = make_comment_key("workbench", dataframe_fingerprint(df), {"focus": analysis_focus})
+        return get_comment_cache().get_or_generate(
+            cache_key, lambda: generate_comment_text(model, prompt, placeholder), force_refresh=force_refresh
+        )
     except Exception as e:
         return f"⚠️ AIコメント生成でエラー: {e}"
 
-def generate_sql(model, prompt_text):
-    response = model.generate_content(
-        prompt_text, generation_config={"temperature": 0, "max_output_tokens": 1024}
-    )
-    return response.text.strip().replace("```sql", "").replace("```", "").strip()
+def extract_complete_sql(text: str):
+    """
+    ストリーミング途中のテキストから、閉じたコードフェンス内のSQLを取り出す。
+    フェンスがまだ閉じていなければNone
+    """
+    start = text.find("```")
+    if start == -1:
+        return None
+    body_start = text.find("\n", start)
+    if body_start == -1:
+        return None
+    end = text.find("```", body_start)
+    if end == -1:
+        return None
+    return text[body_start:end].strip()
+
+def _read_sql_stream(model, prompt_text, generation_config) -> str:
+    text = ""
+    stream = stream_generate(model, prompt_text, generation_config)
+    try:
+        for chunk in stream:
+            text += chunk
+            # 閉じフェンスが届いた時点でSQLは確定するため、以降の説明文は待たずに打ち切る
+            sql = extract_complete_sql(text)
+            if sql is not None:
+                return sql
+    finally:
+        # 打ち切った場合も、スパンの内側でトークン数が記録されるようにストリームを閉じる
+        stream.close()
+    return text
+
+def generate_sql(model, prompt_text, temperature: float = 0, attempts: list = None):
+    generation_config = {"temperature": temperature, "max_output_tokens": 1024}
+    with start_span("gemini.generate_sql", temperature=temperature, prompt_chars=len(prompt_text)) as span:
+        sql = call_with_retry(lambda: _read_sql_stream(model, prompt_text, generation_config), attempts, label="gemini")
+        # フェンスや引用符、列名の綴り違いなど機械的に直せる誤りは、BigQueryに送る前にここで直す
+        sql, fixes, _ = validate_and_repair_sql(sql)
+        if fixes:
+            span.set_attribute("sql.local_fixes", fixes)
+    return sql
 
-def execute_bigquery_with_retry(bq_client, model, sql_query):
+def execute_bigquery_with_retry(bq_client, model, sql_query, alternatives=None):
+    """
+    SQLを実行し、SQLの誤りによるエラーの場合はAIに修正させて再実行する。
+    レート制限や一時的な障害は同じSQLのままバックオフして再試行し、権限エラー等はAIに回さずに終了する。
+    alternatives に候補SQLを渡すと、エラー時はAIに修正させる前に次の候補を試す。
+    各試行の結果と所要時間は st.session_state.execution_attempts に記録する。
+    """
+    alternatives = list(alternatives or [])
+    attempts = st.session_state.execution_attempts = []
     for attempt in range(MAX_ATTEMPTS):
+        sql_query, _, local_errors = validate_and_repair_sql(sql_query)
+        if local_errors and attempt + 1 < MAX_ATTEMPTS:
+            # ローカルで直せない誤りが分かっている場合は、BigQueryに送らずにAIへ修正を依頼する
+            # （最後の試行は検証の誤判定に備えてBigQueryで実行する）
+            st.warning(f"SQLエラー発生。AIが修正を試みます... ({attempt + 1}/{MAX_ATTEMPTS})")
+            correction_prompt = f"以下のSQLには次の問題があります。修正してください。\n# SQL:\n{sql_query}\n# 問題:\n{describe_problems(local_errors)}\n# 出力は修正後のSQLのみ"
+            sql_query = generate_sql(model, correction_prompt, attempts=attempts)
+            continue
         try:
-            return sql_query, bq_client.query(sql_query).to_dataframe(), True
+            with start_span("bigquery.execute", attempt=attempt + 1):
+                df, st.session_state.result_meta = call_with_retry(
+                    lambda: fetch_with_result_policy(bq_client, sql_query, job_config=make_job_config()), attempts, label="bigquery"
+                )
+            return sql_query, df, True
         except Exception as e:
             error_msg = str(e)
-            if "403 Forbidden" in error_msg:
-                 st.error("BigQueryへのアクセス権限がありません。")
-                 return sql_query, pd.DataFrame(), False
+            category = classify_error(e)
+            if category == CANCELLED:
+                # 新しい操作で取り消されたジョブはSQLの誤りではないため、修正せずに終了する
+                return sql_query, pd.DataFrame(), False
+            if category == CONFIGURATION:
+                # クライアントを作成できない場合はSQLの誤りではないため、原因をそのまま表示する
+                st.error(error_msg)
+                return sql_query, pd.DataFrame(), False
+            if category == PERMISSION:
+                st.error("BigQueryへのアクセス権限がありません。")
+                return sql_query, pd.DataFrame(), False
+            if category in (QUOTA, TRANSIENT):
+                # 再試行しても解消しなかった障害はSQLの誤りではないため、AIには修正させない
+                st.error("BigQueryが混雑しているか、一時的に利用できません。しばらく待ってから再度お試しください。")
+                return sql_query, pd.DataFrame(), False
+            if alternatives:
+                # 検証済みの候補が残っていれば、AIの修正を待たずに次の候補を実行する
+                print(f"Candidate SQL failed, trying next candidate: {error_msg}")
+                sql_query = alternatives.pop(0)
+                continue
             if attempt + 1 == MAX_ATTEMPTS:
                 st.error(f"SQL修正を{MAX_ATTEMPTS}回試みましたが解決できませんでした。")
                 return sql_query, pd.DataFrame(), False
             st.warning(f"SQLエラー発生。AIが修正を試みます... ({attempt + 1}/{MAX_ATTEMPTS})")
             correction_prompt = f"以下のSQLはエラーになりました。エラーメッセージを参考に修正してください。\n# SQL:\n{sql_query}\n# エラー:\n{error_msg}\n# 出力は修正後のSQLのみ"
-            sql_query = generate_sql(model, correction_prompt)
+            sql_query = generate_sql(model, correction_prompt, attempts=attempts)
     return sql_query, pd.DataFrame(), False
 
+def report_unexpected_error(error: Exception):
+    """想定外のエラーを表示する。クライアントの初期化失敗は原因のメッセージをそのまま表示する"""
+    if classify_error(error) == CONFIGURATION:
+        st.error(str(error))
+    else:
+        st.error(f"予期せぬエラー: {error}")
+
+def check_sql_cost(bq_client, sql_query) -> str:
+    """
+    ドライランで推定スキャン量を見積もり、"ok" / "confirm" / "reject" を返す。
+    見積もり結果はワークベンチで表示できるようセッションに保存する。
+    """
+    try:
+        with start_span("bigquery.dry_run") as span:
+            estimate = estimate_query_cost(bq_client, sql_query)
+            span.set_attribute("bq.estimated_bytes", estimate["bytes"])
+    except Exception as e:
+        # 構文エラー等はドライランでも失敗するため、実行時のリトライ処理に任せる
+        print(f"Dry run failed: {e}")
+        st.session_state.cost_estimate = None
+        return "ok"
+
+    return report_cost_estimate(estimate)
+
+def report_cost_estimate(estimate: dict) -> str:
+    """見積もり結果をセッションに保存して表示し、"ok" / "confirm" / "reject" を返す"""
+    st.session_state.cost_estimate = estimate
+    st.caption(format_cost_estimate(estimate))
+    verdict = check_query_cost(estimate["bytes"])
+    if verdict == "reject":
+        st.error(f"スキャン量が上限（{format_bytes(MAX_BYTES_BILLED)}）を超えるため実行を中止しました。期間や対象を絞って指示してください。")
+    elif verdict == "confirm":
+        st.warning("スキャン量の大きいクエリです。内容を確認のうえ「このまま実行する」を押してください。")
+    return verdict
+
+def _prepare_candidate(bq_client, model, prompt: str, temperature: float) -> dict:
+    """候補SQLを1つ生成してローカル検証とドライランを行う（ワーカースレッドで実行するためst.*は使わない）"""
+    candidate = {"temperature": temperature, "sql": None, "estimate": None, "error": None}
+    try:
+        candidate["sql"] = generate_sql(model, prompt, temperature=temperature)
+        _, _, local_errors = validate_and_repair_sql(candidate["sql"])
+        if local_errors:
+            candidate["error"] = describe_problems(local_errors)
+            return candidate
+        candidate["estimate"] = estimate_query_cost(bq_client, candidate["sql"])
+    except Exception as e:
+        candidate["error"] = str(e)
+    return candidate
+
+def generate_sql_candidates(bq_client, model, prompt: str, num_candidates: int = SPECULATIVE_CANDIDATES) -> list:
+    """
+    生成温度を変えた候補SQLを並列に生成・ドライランし、候補のリストを返す。
+    ドライランに成功した候補を推定スキャン量の少ない順に並べ、失敗した候補はその後ろに置く。
+    同じSQLになった候補は1つにまとめる。
+    """
+    temperatures = [SPECULATIVE_TEMPERATURES[i % len(SPECULATIVE_TEMPERATURES)] for i in range(max(1, num_candidates))]
+    with ThreadPoolExecutor(max_workers=len(temperatures), thread_name_prefix="sql-candidate") as executor:
+        futures = [executor.submit(_prepare_candidate, bq_client, model, prompt, t) for t in temperatures]
+        candidates = [future.result() for future in futures]
+
+    unique, seen = [], set()
+    for candidate in candidates:
+        key = normalize_sql(candidate["sql"] or "")
+        if candidate["sql"] and key not in seen:
+            seen.add(key)
+            unique.append(candidate)
+    valid = sorted((c for c in unique if c["estimate"] is not None), key=lambda c: c["estimate"]["bytes"])
+    return valid + [c for c in unique if c["estimate"] is None]
+
 def build_where_clause(filters: dict, apply_date: bool, apply_media: bool, apply_campaign: bool, prefix: str = "WHERE") -> str:
     """フィルタ辞書と適用フラグからSQLのWHERE句またはAND句を構築する"""
     where_conditions = []
@@ -78,6 +280,31 @@ def build_where_clause(filters: dict, apply_date: bool, apply_media: bool, apply
     # prefix を付けて条件を連結する
     return f" {prefix} " + " AND ".join(where_conditions)
 
+def run_queries_concurrently(bq_client, queries: dict, max_workers: int = MAX_CONCURRENT_QUERIES):
+    """
+    複数のクエリを並列に実行し、完了した順に結果を回収する。
+    戻り値は (レポート名→DataFrame, レポート名→例外) の2つの辞書。
+    ワーカースレッドからはst.*を呼ばないため、エラー表示は呼び出し側で行う。
+    """
+    results, errors = {}, {}
+    if not queries:
+        return results, errors
+
+    # ワーカースレッドからはセッションを参照できないため、投入元のセッションのジョブとして記録する
+    session_id = current_session_id()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(queries)))) as executor:
+        futures = {
+            executor.submit(call_with_retry, lambda sql=sql: run_query(bq_client, sql, session_id=session_id), label=name): name
+            for name, sql in queries.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+    return results, errors
+
 def run_summary02_analysis(bq_client, model, filters, sheet_analysis_queries):
     """サマリー02の複数のレポートを統合してAIコメントを生成する"""
     df_dict = {}
@@ -86,6 +313,7 @@ def run_summary02_analysis(bq_client, model, filters, sheet_analysis_queries):
     summary_reports = ["サマリー02_年月メディア分布", "サマリー02_年月デバイス分布", "サマリー02_年月性別分布", "サマリー02_年月年齢分布", "サマリー02_時間×曜日", "サマリー02_地域別"]
 
     with st.spinner("サマリー02のデータ分析を実行中です..."):
+        queries = {}
         for report_name in summary_reports:
             query_info = sheet_analysis_queries.get(report_name)
             if not query_info:
@@ -100,24 +328,30 @@ def run_summary02_analysis(bq_client, model, filters, sheet_analysis_queries):
                 apply_media="media" in supported_filters,
                 apply_campaign="campaign" in supported_filters
             )
-            final_query = query_info["query"].format(table=query_info["table"], where_clause=where_clause)
-            
-            try:
-                df = bq_client.query(final_query).to_dataframe()
-                if not df.empty:
-                    # 時間×曜日のデータはクロス集計
-                    if report_name == "サマリー02_時間×曜日":
-                        df_pivot = pd.pivot_table(df, values='Clicks', index='HourOfDay', columns='DayOfWeekJA', fill_value=0)
-                        # 列の順序を日本語の曜日に設定
-                        days_order = ['月', '火', '水', '木', '金', '土', '日']
-                        ordered_cols = [col for col in days_order if col in df_pivot.columns]
-                        df_pivot = df_pivot[ordered_cols]
-                        df_dict[report_name] = df_pivot
-                    else:
-                        df_dict[report_name] = df
-            except Exception as e:
-                st.error(f"レポート '{report_name}' のデータ取得中にエラーが発生しました: {e}")
+            queries[report_name] = query_info["query"].format(table=resolve_sheet_table(query_info), where_clause=where_clause)
+
+        # 全クエリを同時に投入し、最も遅いクエリの時間で完了させる
+        results, errors = run_queries_concurrently(bq_client, queries)
+
+        # 表示順を安定させるため、元のレポート順で結果を格納する
+        for report_name in queries:
+            if report_name in errors:
+                st.error(f"レポート '{report_name}' のデータ取得中にエラーが発生しました: {errors[report_name]}")
                 df_dict[report_name] = pd.DataFrame()
+                continue
+
+            df = results[report_name]
+            if not df.empty:
+                # 時間×曜日のデータはクロス集計
+                if report_name == "サマリー02_時間×曜日":
+                    df_pivot = pd.pivot_table(df, values='Clicks', index='HourOfDay', columns='DayOfWeekJA', fill_value=0)
+                    # 列の順序を日本語の曜日に設定
+                    days_order = ['月', '火', '水', '木', '金', '土', '日']
+                    ordered_cols = [col for col in days_order if col in df_pivot.columns]
+                    df_pivot = df_pivot[ordered_cols]
+                    df_dict[report_name] = df_pivot
+                else:
+                    df_dict[report_name] = df
 
     with st.spinner("Geminiが分析コメントを生成中です..."):
         prompt = f"""
@@ -125,16 +359,19 @@ def run_summary02_analysis(bq_client, model, filters, sheet_analysis_queries):
         重要な傾向や示唆を、箇条書きで3つ以内にまとめて、マーケティング担当者向けに分かりやすく解説してください。
 
         [分析データセット]
-        {json.dumps({k: v.head().to_dict(orient='records') for k, v in df_dict.items()}, ensure_ascii=False, default=json_converter)}
+        {summarize_dataframes(df_dict)}
         """
-        response = model.generate_content(prompt)
-        st.session_state.comment = response.text.strip()
+        cache_key = make_comment_key("summary02", [dataframe_fingerprint(v) for v in df_dict.values()], list(df_dict.keys()))
+        st.session_state.comment = get_comment_cache().get_or_generate(
+            cache_key, lambda: generate_comment_text(model, prompt, st.empty())
+        )
     
     # グラフ表示用に、最初に見つかったデータフレームをセッションに格納
     first_df_name = list(df_dict.keys())[0] if df_dict else None
     if first_df_name:
         st.session_state.df = df_dict[first_df_name]
         st.session_state.sql = "" # 統合分析のためSQLは空に
+        st.session_state.result_meta = None
         st.session_state.editable_sql = ""
         # グラフ設定はデフォルト値をセット
         cfg = {"main_chart_type": "棒グラフ", "x_axis": df_dict[first_df_name].columns[0], "y_axis_left": "Clicks", "y_axis_right": "なし", "legend_col": "なし"}
@@ -144,8 +381,18 @@ def run_summary02_analysis(bq_client, model, filters, sheet_analysis_queries):
         st.warning("データが取得できませんでした。フィルタ条件を見直してください。")
 
 
-def run_analysis_flow(user_input: str, filters: dict, apply_date: bool, apply_media: bool, apply_campaign: bool, sheet_analysis_queries):
-    """分析指示から一連の処理を実行する"""
+def run_analysis_flow(user_input: str, filters: dict, apply_date: bool, apply_media: bool, apply_campaign: bool, sheet_analysis_queries,
+                      speculative: bool = False):
+    """
+    分析指示から一連の処理を実行する。
+    speculative=True の場合は複数の候補SQLを並列に生成・ドライランし、最もスキャン量の少ない有効な候補を実行する。
+    段階ごとの処理時間はトレースとして記録し、ワークベンチの処理時間パネルに表示する。
+    """
+    with start_span("analysis_flow", speculative=speculative) as root:
+        _run_analysis_flow(user_input, filters, apply_date, apply_media, apply_campaign, sheet_analysis_queries, speculative)
+    st.session_state.last_trace = root.finished
+
+def _run_analysis_flow(user_input, filters, apply_date, apply_media, apply_campaign, sheet_analysis_queries, speculative):
     bq_client, model = st.session_state.bq_client, st.session_state.model
 
     # サマリー02の場合、特別処理を呼び出す
@@ -154,29 +401,100 @@ def run_analysis_flow(user_input: str, filters: dict, apply_date: bool, apply_me
         return
 
     try:
-        with st.spinner("GeminiがSQLを生成中です..."):
+        with start_span("select_prompt") as span:
             info = select_best_prompt(user_input)
-            if not info:
-                st.error("分析対象のテーブルが見つかりませんでした。"); return
+            span.set_attribute("prompt_id", get_prompt_id(info) if info else None)
+        if not info:
+            st.error("分析対象のテーブルが見つかりませんでした。"); return
+
+        # フィルタ条件を文字列として構築
+        filter_context = build_where_clause(filters, apply_date, apply_media, apply_campaign)
+
+        # 同じ指示・フィルタで実行に成功したSQLがあれば、GeminiとリトライループをスキップしてSQLを再利用する
+        cache_key = (get_prompt_id(info), user_input, filter_context)
+        with start_span("sql_cache.lookup") as span:
+            cached_sql = get_sql_cache().lookup(*cache_key) if SQL_CACHE_ENABLED else None
+            span.set_attribute("hit", cached_sql is not None)
+        if cached_sql:
+            if execute_analysis_sql(user_input, cached_sql, use_retry=False):
+                st.caption("♻️ 過去に実行に成功したSQLを再利用しました。")
+                return
+            get_sql_cache().invalidate(*cache_key, cached_sql)
 
-            # フィルタ条件を文字列として構築
-            filter_context = build_where_clause(filters, apply_date, apply_media, apply_campaign)
+        # フィルタが指定されている場合のみ、プロンプトに条件を組み込む
+        prompt = info["template"].format(user_input=user_input)
+        if filter_context:
+            prompt = f"{prompt}\n#追加のフィルタ条件:\n#以下のWHERE句を必ずSQLに含めてください。\n#`{filter_context}`"
 
-            # フィルタが指定されている場合のみ、プロンプトに条件を組み込む
-            if filter_context:
-                prompt = info["template"].format(user_input=user_input)
-                prompt_with_filter = f"{prompt}\n#追加のフィルタ条件:\n#以下のWHERE句を必ずSQLに含めてください。\n#`{filter_context}`"
-                generated_sql = generate_sql(model, prompt_with_filter)
+        alternatives = []
+        if speculative:
+            with st.spinner(f"GeminiがSQLの候補を{SPECULATIVE_CANDIDATES}件生成し、スキャン量を見積もり中です..."), \
+                    start_span("speculative_candidates", candidates=SPECULATIVE_CANDIDATES):
+                candidates = generate_sql_candidates(bq_client, model, prompt)
+            if not candidates:
+                st.error("SQLを生成できませんでした。"); return
+            best = candidates[0]
+            generated_sql = best["sql"]
+            alternatives = [c["sql"] for c in candidates[1:] if c["estimate"] is not None]
+            valid_count = sum(1 for c in candidates if c["estimate"] is not None)
+            st.caption(f"🔀 候補SQL {len(candidates)}件のうち、有効な{valid_count}件から最もスキャン量の少ないものを実行します。")
+            if best["estimate"] is not None:
+                verdict = report_cost_estimate(best["estimate"])
             else:
-                # フィルタが指定されていない場合は、元のプロンプトでSQLを生成
-                prompt = info["template"].format(user_input=user_input)
+                # すべての候補がドライランに失敗した場合は、通常の修正ループに任せる
+                st.session_state.cost_estimate = None
+                verdict = "ok"
+        else:
+            with st.spinner("GeminiがSQLを生成中です..."):
                 generated_sql = generate_sql(model, prompt)
+            with st.spinner("BigQueryでスキャン量を見積もり中です..."):
+                verdict = check_sql_cost(bq_client, generated_sql)
+
+        if verdict == "reject":
+            st.code(generated_sql, language="sql")
+            return
+        if verdict == "confirm":
+            st.session_state.pending_sql = {"user_input": user_input, "sql": generated_sql, "cache_key": cache_key, "alternatives": alternatives}
+            return
+
+        execute_analysis_sql(user_input, generated_sql, cache_key=cache_key, alternatives=alternatives)
+    except Exception as e:
+        report_unexpected_error(e)
 
+def execute_analysis_sql(user_input: str, generated_sql: str, cache_key=None, use_retry: bool = True, alternatives=None) -> bool:
+    """
+    生成済みのSQLを実行し、結果・グラフ設定・コメント・履歴をセッションに保存する。
+    use_retry=False の場合はエラー時にAI修正を行わず、何も表示せずにFalseを返す。
+    cache_key を渡すと、成功したSQLをSQL生成キャッシュに記録する。
+    alternatives には、エラー時にAI修正より先に試す候補SQLを渡す。
+    """
+    with start_span("execute_analysis_sql", use_retry=use_retry) as span:
+        is_success = _execute_analysis_sql(user_input, generated_sql, cache_key, use_retry, alternatives)
+    # 確認後の実行など、分析フローの外から呼ばれた場合はこの実行を1つのトレースとして表示する
+    if span.parent is None:
+        st.session_state.last_trace = span.finished
+    return is_success
+
+def _execute_analysis_sql(user_input, generated_sql, cache_key, use_retry, alternatives) -> bool:
+    bq_client, model = st.session_state.bq_client, st.session_state.model
+    st.session_state.pending_sql = None
+    try:
         with st.spinner("BigQueryでSQLを実行中です..."):
-            final_sql, df, is_success = execute_bigquery_with_retry(bq_client, model, generated_sql)
+            if use_retry:
+                final_sql, df, is_success = execute_bigquery_with_retry(bq_client, model, generated_sql, alternatives=alternatives)
+            else:
+                try:
+                    df, st.session_state.result_meta = fetch_with_result_policy(bq_client, generated_sql, job_config=make_job_config())
+                    final_sql, is_success = generated_sql, True
+                except Exception as e:
+                    print(f"Cached SQL failed, regenerating: {e}")
+                    return False
 
             if is_success:
+                if cache_key and SQL_CACHE_ENABLED:
+                    get_sql_cache().record_success(*cache_key, final_sql)
                 st.session_state.sql, st.session_state.df = final_sql, df
+                set_current_attributes(rows=len(df), columns=len(df.columns))
                 if df.empty:
                     st.warning("クエリは成功しましたが、結果データが0件でした。")
                 else:
@@ -185,15 +503,15 @@ def run_analysis_flow(user_input: str, filters: dict, apply_date: bool, apply_me
                     if y_axis_default:
                         cfg = {"main_chart_type": "棒グラフ", "x_axis": df.columns[0], "y_axis_left": y_axis_default, "y_axis_right": "なし", "legend_col": "なし"}
                         st.session_state.graph_cfg = cfg
-                        st.session_state.comment = generate_ai_comment(model, df, cfg)
+                        st.session_state.comment = generate_ai_comment(model, df, cfg, st.session_state.result_meta, placeholder=st.empty())
                         st.success("分析完了！")
-                        history_entry = {"user_input": user_input, "sql": final_sql, "df": df, "graph_cfg": cfg, "comment": st.session_state.comment}
-                        st.session_state.analysis_history.append(history_entry)
-                        if len(st.session_state.analysis_history) > 10: st.session_state.analysis_history.pop(0)
+                        add_history_entry(st.session_state.analysis_history, user_input, final_sql, df, cfg, st.session_state.comment, st.session_state.result_meta)
                     else:
                         st.warning("グラフ化に適した数値データが見つかりませんでした。")
+            return is_success
     except Exception as e:
-        st.error(f"予期せぬエラー: {e}")
+        report_unexpected_error(e)
+        return False
 
 def rerun_sql_flow(sql_query: str, filters: dict, apply_date: bool, apply_media: bool, apply_campaign: bool, sheet_analysis_queries):
     """ユーザーが修正したSQLを再実行する"""
@@ -201,7 +519,7 @@ def rerun_sql_flow(sql_query: str, filters: dict, apply_date: bool, apply_media:
     try:
         with st.spinner("修正されたSQLをBigQueryで実行中です..."):
             # この関数ではフィルタを直接SQLに適用しないが、将来的な拡張性のために引数は維持
-            df = bq_client.query(sql_query).to_dataframe()
+            df, st.session_state.result_meta = fetch_with_result_policy(bq_client, sql_query, job_config=make_job_config())
             st.session_state.sql, st.session_state.df = sql_query, df
             if not df.empty:
                 numeric_cols = df.select_dtypes(include='number').columns
@@ -209,7 +527,7 @@ def rerun_sql_flow(sql_query: str, filters: dict, apply_date: bool, apply_media:
                 if y_axis_default:
                     cfg = {"main_chart_type": "棒グラフ", "x_axis": df.columns[0], "y_axis_left": y_axis_default, "y_axis_right": "なし", "legend_col": "なし"}
                     st.session_state.graph_cfg = cfg
-                    st.session_state.comment = generate_ai_comment(model, df, cfg)
+                    st.session_state.comment = generate_ai_comment(model, df, cfg, st.session_state.result_meta)
                 else:
                     st.warning("グラフ化に適した数値データが見つかりませんでした。")
             st.success("SQLの再実行完了！")
@@ -226,7 +544,16 @@ def modify_and_rerun_sql_flow(original_sql: str, instruction: str, filters: dict
             # この関数ではフィルタを直接SQLに適用しないが、将来的な拡張性のために引数は維持
             prompt = MODIFY_SQL_TEMPLATE.format(original_sql=original_sql, modification_instruction=instruction)
             modified_sql = generate_sql(model, prompt)
-        
+
+        with st.spinner("BigQueryでスキャン量を見積もり中です..."):
+            verdict = check_sql_cost(bq_client, modified_sql)
+        if verdict == "reject":
+            st.code(modified_sql, language="sql")
+            return
+        if verdict == "confirm":
+            st.session_state.pending_sql = {"user_input": instruction, "sql": modified_sql}
+            return
+
         with st.spinner("修正されたSQLをBigQueryで実行中です..."):
             final_sql, df, is_success = execute_bigquery_with_retry(bq_client, model, modified_sql)
             if is_success:
@@ -237,9 +564,9 @@ def modify_and_rerun_sql_flow(original_sql: str, instruction: str, filters: dict
                     if y_axis_default:
                         cfg = {"main_chart_type": "棒グラフ", "x_axis": df.columns[0], "y_axis_left": y_axis_default, "y_axis_right": "なし", "legend_col": "なし"}
                         st.session_state.graph_cfg = cfg
-                        st.session_state.comment = generate_ai_comment(model, df, cfg)
+                        st.session_state.comment = generate_ai_comment(model, df, cfg, st.session_state.result_meta)
                     else:
                         st.warning("グラフ化に適した数値データが見つかりませんでした。")
                 st.success("SQLの修正・再実行が完了しました！")
     except Exception as e:
-        st.error(f"予期せぬエラー: {e}")
\ No newline at end of file
+        report_unexpected_error(e)
\ No newline at end of file
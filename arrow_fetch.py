@@ -0,0 +1,134 @@
+# arrow_fetch.py
+"""
+BigQueryのクエリ結果をArrowのレコードバッチ単位で読み込み、省メモリなDataFrameを構築する
+- BigQuery Storage Read API が使える場合はそれを使い、使えない場合はREST経由のArrowバッチで読む
+- メディア名・キャンペーン名などの文字列はカテゴリ型に、値が収まる整数は int32 にダウンキャストする
+  （指標の四則演算で桁あふれしないよう、int8 / int16 までは縮めない）
+- max_rows を指定すると、行数の予算に達した時点で読み込みを打ち切る
+"""
+import os
+import threading
+import pandas as pd
+
+# カテゴリ型に変換するディメンション列
+CATEGORY_COLUMNS = {
+    "ServiceNameJA_Media", "ServiceNameJA", "CampaignName", "AccountName", "PromotionName",
+    "AdGroupName", "DeviceCategory", "DayOfWeekJA", "AgeRange", "UnifiedGenderJA", "RegionJA", "AdTypeJA",
+}
+# 上記以外の文字列列も、行数が多く値の種類が少なければカテゴリ型にする
+CATEGORY_MIN_ROWS = 1000
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+_INT32 = pd.api.types.pandas_dtype("int32")
+_INT32_INFO = (-(2 ** 31), 2 ** 31 - 1)
+
+USE_BQSTORAGE = os.environ.get("USE_BQSTORAGE", "true").lower() == "true"
+
+_bqstorage_client = None
+_bqstorage_lock = threading.Lock()
+
+def get_bqstorage_client():
+    """Storage Read API のクライアントを返す。利用できない場合はNone"""
+    global _bqstorage_client
+    if not USE_BQSTORAGE:
+        return None
+    with _bqstorage_lock:
+        if _bqstorage_client is None:
+            try:
+                from google.cloud import bigquery_storage
+                _bqstorage_client = bigquery_storage.BigQueryReadClient()
+            except Exception as e:
+                print(f"BigQuery Storage API is unavailable, falling back to REST: {e}")
+                _bqstorage_client = False
+        return _bqstorage_client or None
+
+def iter_arrow_batches(row_iterator, bqstorage_client=None):
+    """RowIterator から pyarrow.RecordBatch を順に返す"""
+    if hasattr(row_iterator, "to_arrow_iterable"):
+        yield from row_iterator.to_arrow_iterable(bqstorage_client=bqstorage_client)
+    else:
+        yield from row_iterator.to_arrow(bqstorage_client=bqstorage_client).to_batches()
+
+def batches_to_dataframe(batches, max_rows=None, columns=None):
+    """
+    レコードバッチを読み込んでDataFrameを構築する。
+    max_rows に達した時点で読み込みを止め、df.attrs["truncated"] に打ち切りの有無を記録する。
+    """
+    import pyarrow as pa
+
+    collected, total_rows, truncated = [], 0, False
+    batch_iter = iter(batches)
+    for batch in batch_iter:
+        if max_rows is not None and total_rows + batch.num_rows > max_rows:
+            batch = batch.slice(0, max_rows - total_rows)
+            truncated = True
+        if batch.num_rows:
+            collected.append(batch)
+            total_rows += batch.num_rows
+        if max_rows is not None and total_rows >= max_rows:
+            # 予算ちょうどで止まった場合は、続きのバッチがあるかだけ確認する
+            if not truncated:
+                truncated = any(b.num_rows for b in batch_iter)
+            break
+
+    if not collected:
+        df = pd.DataFrame(columns=columns or [])
+    else:
+        table = pa.Table.from_batches(collected)
+        del collected
+        # self_destruct でArrowのバッファを変換しながら解放し、メモリの二重確保を避ける
+        df = compact_dtypes(table.to_pandas(self_destruct=True, split_blocks=True))
+    df.attrs["truncated"] = truncated
+    return df
+
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """ディメンション列をカテゴリ型に、int32 に収まる整数列を int32 に変換する"""
+    for col in df.columns:
+        series = df[col]
+        if (series.dtype.kind in "iu" and not pd.api.types.is_extension_array_dtype(series)
+                and series.dtype.itemsize > _INT32.itemsize):
+            if series.empty or (series.min() >= _INT32_INFO[0] and series.max() <= _INT32_INFO[1]):
+                df[col] = series.astype(_INT32)
+        elif pd.api.types.is_string_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+            # pandas 3 以降は文字列が str 型、それより前は object 型で読み込まれる
+            if col in CATEGORY_COLUMNS or (
+                len(series) >= CATEGORY_MIN_ROWS and series.nunique() <= len(series) * CATEGORY_MAX_UNIQUE_RATIO
+            ):
+                df[col] = series.astype("category")
+    # 浮動小数はコスト等の精度を保つため float64 のまま保持する
+    return df
+
+def fetch_dataframe(query_job, max_rows=None, batch_iterator=None) -> pd.DataFrame:
+    """
+    クエリジョブの結果をArrowバッチ経由でDataFrameにする。
+    batch_iterator を渡すと、RowIterator の代わりにそのバッチ列を読み込む。
+    """
+    if batch_iterator is not None:
+        return batches_to_dataframe(batch_iterator, max_rows=max_rows)
+    if not hasattr(query_job, "result"):
+        # Arrowに対応していないジョブは従来どおりREST経由で取得する
+        df = query_job.to_dataframe()
+        if max_rows is not None and len(df) > max_rows:
+            df = df.head(max_rows)
+            df.attrs["truncated"] = True
+        return df
+
+    row_iterator = query_job.result()
+    columns = [field.name for field in (getattr(row_iterator, "schema", None) or [])]
+    return batches_to_dataframe(
+        iter_arrow_batches(row_iterator, bqstorage_client=get_bqstorage_client()),
+        max_rows=max_rows,
+        columns=columns,
+    )
+
+def fetch_table_dataframe(bq_client, table_id: str) -> pd.DataFrame:
+    """
+    既存のテーブル（クエリジョブの出力先の一時テーブル等）の全行をDataFrameにする。
+    クエリを実行せずに行を読み出すため、スキャン量は発生しない。
+    """
+    row_iterator = bq_client.list_rows(table_id)
+    columns = [field.name for field in (getattr(row_iterator, "schema", None) or [])]
+    return batches_to_dataframe(
+        iter_arrow_batches(row_iterator, bqstorage_client=get_bqstorage_client()),
+        columns=columns,
+    )
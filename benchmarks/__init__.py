@@ -0,0 +1,8 @@
+# benchmarks/__init__.py
+"""
+GCPに接続せずに分析フローの性能を測るベンチマーク
+- run_benchmarks: 分析フローの段階別の処理時間・メモリ（`python -m benchmarks.run_benchmarks --help`）
+- memory_sessions: 多数のセッションが結果を保持したときのメモリ使用量（`python -m benchmarks.memory_sessions --help`）
+- import_time: アプリ起動時のモジュール読み込み時間（`python -m benchmarks.import_time --help`）
+- checks: 過去に不具合のあった処理の動作確認（`python -m benchmarks.checks`）
+"""
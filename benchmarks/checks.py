@@ -0,0 +1,490 @@
+# benchmarks/checks.py
+"""
+ベンチマーク用の代替実装を使った、GCPに接続しない動作確認
+
+    python -m benchmarks.checks
+
+過去に不具合のあった処理を、記録済み（または合成）のデータと代替のStreamlit・BigQuery・Geminiで実行し、
+期待どおりの結果になることを assert で確認する。失敗した確認があれば終了コード1で終わる。
+"""
+import os
+import sys
+import traceback
+
+# アプリのモジュールを読み込む前に、外部サービスやキャッシュを使わない設定にする（先読みは有効のまま確認する）
+for _key, _value in {
+    "USE_BQSTORAGE": "false",
+    "QUERY_CACHE_DIR": "",
+    "SQL_CACHE_ENABLED": "false",
+    "SQL_CACHE_PATH": "",
+    "COMMENT_CACHE_TTL_SECONDS": "-1",
+    "USE_ROLLUP_TABLES": "false",
+    "USE_LOCAL_ENGINE": "false",
+    "TRACE_ENABLED": "false",
+    "JOB_POLL_INTERVAL_SECONDS": "0.001",
+}.items():
+    os.environ.setdefault(_key, _value)
+
+import re
+import time
+import datetime
+import threading
+
+import pandas as pd
+
+import analysis_logic
+import charting
+import cost_guard
+import dashboard_analyzer
+import dimension_index
+import job_manager
+import local_engine
+import prefetch
+import result_policy
+import tracing
+from query_cache import get_query_cache
+from benchmarks.fakes import StubStreamlit, FakeBigQueryClient, FakeModel, FakeJobBackend
+from benchmarks.fixtures import synthetic_campaign_data, DEFAULT_RESPONSES
+
+
+def check_categorical_legend():
+    """凡例の列がカテゴリ型で項目数が上限を超えても、組合せグラフ・単一グラフを描画できる"""
+    charting.st = StubStreamlit()
+    df = synthetic_campaign_data(20000)
+    df["CampaignName"] = df["CampaignName"].astype("category")
+    assert df["CampaignName"].nunique() > charting.CHART_LEGEND_TOP_N
+
+    plot_df, order = charting.cap_legend(df, "CampaignName", "Date", ["Clicks"])
+    assert order[-1] == charting.OTHER_LABEL and len(order) == charting.CHART_LEGEND_TOP_N + 1
+    assert set(plot_df["CampaignName"].unique()) == set(order)
+    assert plot_df["Clicks"].sum() == df["Clicks"].sum()
+
+    for chart_type in ["組合せグラフ", "折れ線グラフ"]:
+        cfg = {"main_chart_type": chart_type, "x_axis": "Date", "y_axis_left": "Clicks",
+               "y_axis_right": "CostIncludingFees", "legend_col": "CampaignName"}
+        fig = charting.render_plotly_chart(df, cfg)
+        names = {trace.name for trace in fig.data}
+        assert any(charting.OTHER_LABEL in str(name) for name in names), f"{chart_type}: {names}"
+
+
+class _RecordingPlaceholder:
+    """st.empty() の代替。表示された文字列を順に記録する"""
+
+    def __init__(self):
+        self.shown = []
+
+    def info(self, text):
+        self.shown.append(text)
+
+
+def _dashboard_context(latency_ms: float = 0):
+    stub = StubStreamlit()
+    for module in (dashboard_analyzer, job_manager):
+        module.st = stub
+    get_query_cache().clear()
+    data = synthetic_campaign_data(2000)
+    bq_client = FakeBigQueryClient(lambda sql: data, latency_ms=latency_ms)
+    model = FakeModel(DEFAULT_RESPONSES, chunk_chars=10)
+    filters = {"start_date": datetime.date(2024, 1, 1), "end_date": datetime.date(2024, 12, 31),
+               "media": [], "campaigns": [], "sheet": "メディア"}
+    return bq_client, model, filters
+
+
+def check_dashboard_comment_streams():
+    """現在のシートのコメントは先読みを待たずにフォアグラウンドで逐次表示され、先読みは他のシートだけを計算する"""
+    bq_client, model, filters = _dashboard_context(latency_ms=20)
+    scheduler = prefetch._scheduler = prefetch.PrefetchScheduler(max_workers=2)
+    computed = []
+    original = dashboard_analyzer.compute_dashboard_comment
+
+    def recording_compute(bq, m, sheet_name, *args, **kwargs):
+        computed.append((sheet_name, kwargs.get("placeholder") is not None))
+        return original(bq, m, sheet_name, *args, **kwargs)
+
+    dashboard_analyzer.compute_dashboard_comment = recording_compute
+    try:
+        queries = dashboard_analyzer.SHEET_ANALYSIS_QUERIES
+        dashboard_analyzer.schedule_dashboard_prefetch(bq_client, model, filters, queries)
+        placeholder = _RecordingPlaceholder()
+        comment = dashboard_analyzer.get_ai_dashboard_comment(bq_client, model, filters["sheet"], filters, queries, placeholder=placeholder)
+        scheduler._executor.shutdown(wait=True)
+    finally:
+        dashboard_analyzer.compute_dashboard_comment = original
+
+    expected = DEFAULT_RESPONSES["comment"].strip()
+    assert comment == expected, comment
+    # 断片ごとにカーソル付きで表示され、最後に全文が表示される
+    assert len(placeholder.shown) > 2 and placeholder.shown[0].endswith("▌"), placeholder.shown[:3]
+    assert placeholder.shown[-1] == expected
+    current = [streamed for sheet_name, streamed in computed if sheet_name == filters["sheet"]]
+    assert current == [True], computed
+    assert len(computed) > 1, "他のシートが先読みされていません"
+    assert scheduler.get(filters["sheet"], filters) == expected
+
+
+def check_dashboard_comment_error_fallback():
+    """コメントの生成に失敗した場合は None ではなく、固定の案内文を返す"""
+    bq_client, model, filters = _dashboard_context()
+
+    def failing_route(sql):
+        raise ValueError("Unrecognized name: Cost")
+
+    bq_client.route = failing_route
+    comment = dashboard_analyzer.get_ai_dashboard_comment(
+        bq_client, model, filters["sheet"], filters, dashboard_analyzer.SHEET_ANALYSIS_QUERIES, force_refresh=True
+    )
+    assert comment == "コメントの生成中にエラーが発生しました。管理者にご確認ください。", comment
+
+
+def check_prefetch_failure_backoff():
+    """先読みに失敗したシートは、再実行のたびに再投入されず、一定時間が経つか破棄されるまで待つ"""
+    scheduler = prefetch.PrefetchScheduler(max_workers=1, failure_backoff=60)
+    filters = {"start_date": "2024-01-01", "end_date": "2024-01-31", "media": [], "campaigns": []}
+    calls = []
+
+    def failing_compute(sheet_name, prefetch_filters, cancel_event):
+        calls.append(sheet_name)
+        raise RuntimeError("ServiceBusy")
+
+    def drain():
+        for future in list(scheduler._futures.values()):
+            future.exception()
+
+    for _ in range(5):  # 5回の再実行（複数セッションからの呼び出しも同じ）
+        scheduler.schedule("session-a", filters, ["日別"], failing_compute)
+        drain()
+    assert calls == ["日別"], calls
+
+    scheduler.invalidate("日別", filters)
+    scheduler.schedule("session-a", filters, ["日別"], failing_compute)
+    drain()
+    assert calls == ["日別", "日別"], calls
+
+    scheduler._failures = {key: failed_at - 61 for key, failed_at in scheduler._failures.items()}
+    scheduler.schedule("session-b", filters, ["日別"], lambda *args: "ok")
+    drain()
+    assert scheduler.get("日別", filters) == "ok"
+    scheduler._executor.shutdown(wait=True)
+
+
+def _date_range_route(data: pd.DataFrame, loaded: list):
+    """SQLの Date >= '...' AND Date <= '...' の範囲だけを返すBigQueryの代替の振り分け。読み込んだ範囲を記録する"""
+    def route(sql):
+        since, until = re.search(r"Date >= '([\d-]+)' AND Date <= '([\d-]+)'", sql).groups()
+        since, until = datetime.date.fromisoformat(since), datetime.date.fromisoformat(until)
+        loaded.append((since, until))
+        return data[(data["Date"] >= since) & (data["Date"] <= until)].reset_index(drop=True)
+    return route
+
+
+def _expected_media_summary(data: pd.DataFrame, filters: dict) -> pd.DataFrame:
+    """「メディア」シートの集計を pandas で計算した正解"""
+    rows = data[(data["Date"] >= filters["start_date"]) & (data["Date"] <= filters["end_date"])]
+    if filters["media"]:
+        rows = rows[rows["ServiceNameJA_Media"].isin(filters["media"])]
+    summary = rows.groupby("ServiceNameJA_Media").agg(
+        Cost=("CostIncludingFees", "sum"), Impressions=("Impressions", "sum"), Clicks=("Clicks", "sum"),
+    )
+    return summary.sort_index()
+
+
+def check_local_engine_parity():
+    """ローカルエンジン（DuckDB）のシート集計が pandas の正解と一致し、要求期間を欠いたまま集計しない"""
+    _dashboard_context()
+    data = synthetic_campaign_data(5000)
+    loaded = []
+    bq_client = FakeBigQueryClient(_date_range_route(data, loaded))
+    queries = dashboard_analyzer.SHEET_ANALYSIS_QUERIES
+    query_info = queries["メディア"]
+    working_set = local_engine.LocalWorkingSet()
+
+    def run(filters):
+        where_clause = dashboard_analyzer.build_sheet_where_clause(query_info, filters)
+        result = working_set.run_sheet_query(bq_client, query_info, where_clause, filters)
+        # 読み込み時にカテゴリ型へ変換された列は、DuckDB から ENUM（カテゴリ型）のまま返る
+        result["ServiceNameJA_Media"] = result["ServiceNameJA_Media"].astype(str)
+        actual = result.set_index("ServiceNameJA_Media")[["Cost", "Impressions", "Clicks"]].sort_index()
+        expected = _expected_media_summary(data, filters)
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    media = sorted(data["ServiceNameJA_Media"].unique())[:2]
+    november = {"start_date": datetime.date(2024, 11, 1), "end_date": datetime.date(2024, 11, 30), "media": media, "campaigns": []}
+    january = {"start_date": datetime.date(2024, 1, 1), "end_date": datetime.date(2024, 1, 31), "media": [], "campaigns": []}
+    assert local_engine.can_run_locally(query_info, november)
+    assert not local_engine.can_run_locally(queries["時間×曜日"], november)
+
+    original_max_days = local_engine.LOCAL_ENGINE_MAX_DAYS
+    local_engine.LOCAL_ENGINE_MAX_DAYS = 60
+    try:
+        run(november)
+        run({**november, "media": []})  # 保持中の期間内は再読み込みしない
+        assert len(loaded) == 1, loaded
+        # 保持中の期間と合わせると上限を超える場合、要求された期間を削らずにその期間だけを読み込み直す
+        run(january)
+        assert loaded[-1] == (january["start_date"], january["end_date"]), loaded
+        assert working_set.covers(january["start_date"], january["end_date"])
+        # 上限を超える期間はローカルで実行しない
+        whole_year = {**january, "end_date": datetime.date(2024, 12, 31)}
+        assert not local_engine.can_run_locally(query_info, whole_year)
+    finally:
+        local_engine.LOCAL_ENGINE_MAX_DAYS = original_max_days
+
+
+def check_full_result_reads_destination():
+    """打ち切った結果の全件データは、元のクエリを再実行せずに最初のジョブの出力先から読む"""
+    _dashboard_context()
+    data = synthetic_campaign_data(3000)
+    rollup = data.groupby("Date", as_index=False)[["Clicks"]].sum()
+    bq_client = FakeBigQueryClient(lambda sql: rollup if "FROM `fake-project._anonymous." in sql else data, batch_size=500)
+    sql = "SELECT Date, Clicks FROM `campaign`"
+
+    df, meta = result_policy.fetch_with_result_policy(bq_client, sql, row_limit=1000)
+    assert meta["truncated"] or meta["aggregated"], meta
+    assert meta["destination"], meta
+    queries_before = len(bq_client.queries)
+    full = result_policy.fetch_full_result(bq_client, meta)
+    assert len(full) == len(data), len(full)
+    assert len(bq_client.queries) == queries_before, bq_client.queries[queries_before:]
+
+    # 出力先が期限切れ等で読めない場合のみ、元のクエリを実行する
+    full = result_policy.fetch_full_result(bq_client, {**meta, "destination": "fake-project._anonymous.expired"})
+    assert len(full) == len(data) and bq_client.queries[-1] == sql, bq_client.queries[-1]
+
+
+class _RecordingStreamlit(StubStreamlit):
+    """st.error の表示内容を記録する StubStreamlit"""
+
+    def __init__(self):
+        super().__init__()
+        object.__setattr__(self, "errors", [])
+
+    def error(self, text, *args, **kwargs):
+        self.errors.append(text)
+
+
+def check_summary02_queries_overlap():
+    """サマリー02の各クエリは並列に実行され、結果の対応付け・表示順・エラーは直列実行と変わらない"""
+    stub = _RecordingStreamlit()
+    for module in (analysis_logic, job_manager):
+        module.st = stub
+    get_query_cache().clear()
+    latency_ms = 300
+    frames = {}
+
+    def route(sql):
+        if "RegionJA" in sql:
+            raise ValueError("Unrecognized name: RegionJA")
+        # クエリごとに別の結果を返し、投入元のレポートに対応付くかを確認する
+        key = frames.setdefault(sql, len(frames))
+        return pd.DataFrame({"Key": [key], "HourOfDay": [0], "DayOfWeekJA": ["月"], "Clicks": [key * 10]})
+
+    bq_client = FakeBigQueryClient(route, latency_ms=latency_ms)
+    queries = {f"report_{i}": f"SELECT {i} AS Key FROM `t{i}`" for i in range(6)}
+    started = time.perf_counter()
+    results, errors = analysis_logic.run_queries_concurrently(bq_client, queries)
+    elapsed = time.perf_counter() - started
+    assert elapsed < len(queries) * latency_ms / 1000 / 2, f"{len(queries)}件で{elapsed:.2f}秒"
+    assert not errors and set(results) == set(queries), errors
+    for name, sql in queries.items():
+        assert results[name]["Key"].tolist() == [frames[sql]], name
+
+    results, errors = analysis_logic.run_queries_concurrently(bq_client, {"ok": "SELECT 1", "broken": "SELECT RegionJA"})
+    assert set(results) == {"ok"} and isinstance(errors.get("broken"), ValueError), errors
+
+    # 失敗したレポートだけがエラー表示になり、グラフには元の順序で最初のレポート（年月メディア分布）を使う
+    get_query_cache().clear()
+    filters = {"start_date": datetime.date(2024, 1, 1), "end_date": datetime.date(2024, 1, 31), "media": [], "campaigns": []}
+    started = time.perf_counter()
+    analysis_logic.run_summary02_analysis(bq_client, FakeModel(DEFAULT_RESPONSES), filters, dashboard_analyzer.SHEET_ANALYSIS_QUERIES)
+    elapsed = time.perf_counter() - started
+    assert elapsed < 6 * latency_ms / 1000 / 2, f"6件で{elapsed:.2f}秒"
+    assert len(stub.errors) == 1 and "サマリー02_地域別" in stub.errors[0], stub.errors
+    media_sql = next(sql for sql in frames if "ServiceNameJA_Media" in sql)
+    assert stub.session_state.df["Key"].tolist() == [frames[media_sql]]
+
+
+def _analysis_context(bq_client):
+    """分析フロー用のセッション状態を持つ StubStreamlit を差し込む"""
+    stub = _RecordingStreamlit()
+    stub.session_state.update({
+        "bq_client": bq_client, "model": FakeModel(DEFAULT_RESPONSES),
+        "sql": "", "df": pd.DataFrame(), "comment": "", "graph_cfg": {}, "analysis_history": [],
+        "pending_sql": None, "cost_estimate": None, "result_meta": None, "execution_attempts": [],
+    })
+    for module in (analysis_logic, job_manager):
+        module.st = stub
+    get_query_cache().clear()
+    return stub
+
+
+def check_sql_cost_guard():
+    """ドライランの推定スキャン量に応じて実行・確認待ち・拒否に分かれ、実行するジョブには課金上限が設定される"""
+    data = synthetic_campaign_data(2000)
+    bq_client = FakeBigQueryClient(lambda sql: data)
+    stub = _analysis_context(bq_client)
+    sql = "SELECT Date, SUM(Clicks) AS Clicks FROM `campaign` GROUP BY Date"
+    for dry_run_bytes, expected in [(cost_guard.COST_CONFIRM_BYTES - 1, "ok"),
+                                    (cost_guard.COST_CONFIRM_BYTES + 1, "confirm"),
+                                    (cost_guard.MAX_BYTES_BILLED + 1, "reject")]:
+        bq_client.dry_run_bytes = dry_run_bytes
+        assert analysis_logic.check_sql_cost(bq_client, sql) == expected, (dry_run_bytes, expected)
+        assert stub.session_state.cost_estimate["bytes"] == dry_run_bytes
+    assert len(stub.errors) == 1 and "上限" in stub.errors[0], stub.errors
+    assert not bq_client.queries, "ドライラン以外のジョブが実行されました"
+
+    # 確認が必要なSQLは実行せずに確認待ちにし、確認後の実行には maximum_bytes_billed を設定する
+    bq_client.dry_run_bytes = cost_guard.COST_CONFIRM_BYTES + 1
+    analysis_logic.run_analysis_flow(
+        "先月のメディア別のクリック数の日別推移を教えてください",
+        {"start_date": datetime.date(2024, 1, 1), "end_date": datetime.date(2024, 1, 31), "media": [], "campaigns": []},
+        True, False, False, dashboard_analyzer.SHEET_ANALYSIS_QUERIES,
+    )
+    pending = stub.session_state.pending_sql
+    assert pending and pending["sql"], pending
+    assert not bq_client.queries, bq_client.queries
+    assert analysis_logic.execute_analysis_sql(pending["user_input"], pending["sql"], cache_key=pending["cache_key"])
+    assert stub.session_state.pending_sql is None
+    assert bq_client.job_configs and all(
+        config is not None and config.maximum_bytes_billed == cost_guard.MAX_BYTES_BILLED for config in bq_client.job_configs
+    ), bq_client.job_configs
+
+
+def _wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "待機がタイムアウトしました"
+        time.sleep(0.005)
+
+
+def check_job_cancellation_on_rerun():
+    """再実行の開始時に前回の実行のジョブだけが取り消され、同時実行数は上限を超えない"""
+    job_manager.st = StubStreamlit()
+    backend = FakeJobBackend()
+    manager = job_manager.JobManager(backend=backend, max_concurrent=3, poll_interval=0.001)
+    outcomes = {}
+
+    def run(session_id, sql):
+        try:
+            manager.run(None, sql, session_id=session_id, show_progress=False)
+            outcomes[sql] = "done"
+        except job_manager.JobCancelled:
+            outcomes[sql] = "cancelled"
+
+    threads = [threading.Thread(target=run, args=args) for args in
+               [("session-a", "a1"), ("session-a", "a2"), ("session-b", "b1")]]
+    for thread in threads:
+        thread.start()
+    _wait_until(lambda: len(backend.jobs) == 3)
+    # 上限に達しているため、4件目は枠が空くまで投入されない
+    queued = threading.Thread(target=run, args=("session-a", "a3"))
+    queued.start()
+    time.sleep(0.05)
+    assert len(backend.jobs) == 3 and backend.max_active == 3, [job.sql for job in backend.jobs]
+
+    manager.begin_run("session-a")
+    _wait_until(lambda: len(backend.jobs) == 4)
+    for sql in ("b1", "a3"):
+        backend.finish(sql)
+    for thread in threads + [queued]:
+        thread.join(timeout=5)
+
+    assert outcomes == {"a1": "cancelled", "a2": "cancelled", "b1": "done", "a3": "done"}, outcomes
+    assert sorted(job.sql for job in backend.jobs if job.cancelled) == ["a1", "a2"]
+    assert backend.max_active <= 3, backend.max_active
+    assert manager.stats() == {"submitted": 4, "cancelled": 2, "running": 0}, manager.stats()
+
+
+class _CollectingExporter:
+    """終了したスパンを記録する tracing のエクスポーターの代替"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+def check_sql_generation_records_usage():
+    """閉じフェンスでSQLの読み込みを打ち切っても、SQL生成のトークン数がスパンに記録される"""
+    exporter = _CollectingExporter()
+    original_enabled, original_exporter = tracing.TRACE_ENABLED, tracing._exporter
+    tracing.TRACE_ENABLED = True
+    tracing.set_exporter(exporter)
+    try:
+        model = FakeModel(DEFAULT_RESPONSES, chunk_chars=20)
+        sql = analysis_logic.generate_sql(model, "# 分析対象: メディア別のクリック数")
+    finally:
+        tracing.TRACE_ENABLED = original_enabled
+        tracing.set_exporter(original_exporter)
+
+    assert sql.startswith("SELECT") and "上記" not in sql, sql
+    span = next(span for span in exporter.spans if span["name"] == "gemini.generate_sql")
+    assert span["attributes"].get("llm.prompt_tokens", 0) > 0, span["attributes"]
+    assert span["attributes"].get("llm.response_tokens", 0) > 0, span["attributes"]
+
+
+def check_dimension_index_builds_in_background():
+    """フィルタの索引は run_query（課金上限つき）で作成され、作成を待たずに戻り、失敗時はすぐには再実行しない"""
+    job_manager.st = StubStreamlit()
+    data = synthetic_campaign_data(3000)
+    grouped = data.groupby(["ServiceNameJA_Media", "CampaignName"], as_index=False).agg(
+        first_seen=("Date", "min"), last_seen=("Date", "max"), spend=("CostIncludingFees", "sum"),
+    ).rename(columns={"ServiceNameJA_Media": "media", "CampaignName": "campaign"})
+    grouped.insert(2, "day", None)
+    bq_client = FakeBigQueryClient(lambda sql: grouped, latency_ms=200)
+
+    index = dimension_index.DimensionIndex(source_table="campaign")
+    started = time.perf_counter()
+    index.ensure_fresh(bq_client)
+    assert time.perf_counter() - started < 0.1 and not index.ready, "索引の作成を待っています"
+    index.ensure_fresh(bq_client)  # 作成中に呼ばれても二重に投入しない
+    _wait_until(lambda: index.ready)
+    assert len(bq_client.queries) == 1, bq_client.queries
+    assert bq_client.job_configs[0].maximum_bytes_billed == cost_guard.MAX_BYTES_BILLED
+
+    media = sorted(data["ServiceNameJA_Media"].unique())
+    assert index.media_options() == media
+    in_january = data[(data["ServiceNameJA_Media"] == media[0]) & (data["Date"] <= datetime.date(2024, 1, 31))]
+    assert index.campaign_options([media[0]], datetime.date(2023, 12, 1), datetime.date(2024, 1, 31)) == \
+        sorted(in_january["CampaignName"].unique())
+
+    attempts = []
+
+    def failing_route(sql):
+        attempts.append(sql)
+        raise ValueError("Access Denied: Table campaign")
+
+    failing = dimension_index.DimensionIndex(source_table="campaign")
+    failing_client = FakeBigQueryClient(failing_route)
+    failing.ensure_fresh(failing_client)
+    _wait_until(lambda: failing.last_error is not None)
+    failing.ensure_fresh(failing_client)
+    time.sleep(0.05)
+    assert len(attempts) == 1 and "Access Denied" in str(failing.last_error), attempts
+
+
+CHECKS = [
+    check_categorical_legend, check_dashboard_comment_streams, check_dashboard_comment_error_fallback,
+    check_prefetch_failure_backoff, check_local_engine_parity,
+    check_full_result_reads_destination, check_summary02_queries_overlap,
+    check_sql_cost_guard, check_job_cancellation_on_rerun,
+    check_sql_generation_records_usage, check_dimension_index_builds_in_background,
+]
+
+
+def main(argv=None):
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+            print(f"ok    {check.__name__}")
+        except Exception:
+            failures += 1
+            print(f"FAIL  {check.__name__}")
+            traceback.print_exc()
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+# benchmarks/fakes.py
+"""
+ベンチマーク用の Streamlit・BigQuery・Gemini の代替実装
+- StubStreamlit はアプリの各モジュールの `st` を置き換え、描画系の呼び出しを何もしない処理にする
+- FakeBigQueryClient は記録済みの結果をArrowのレコードバッチとして返し、ジョブの完了確認・ドライラン・出力先テーブルにも応答する
+- FakeModel は記録済みの応答を、ストリーミングの場合は断片に分けて返す
+- FakeJobBackend はジョブマネージャのバックエンドの代替で、完了させるまで終わらないジョブと取り消しを記録する
+遅延（latency_ms）を指定すると、ネットワーク越しの呼び出し時間を模擬できる
+"""
+import time
+import threading
+from contextlib import contextmanager
+import pyarrow as pa
+
+
+class _Null:
+    """どのような属性アクセス・呼び出し・with文にも応じる何もしないオブジェクト"""
+
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        return iter([])
+
+    def __bool__(self):
+        return False
+
+
+class SessionState(dict):
+    """属性アクセスもできる st.session_state の代替"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        self.pop(name, None)
+
+
+class StubStreamlit(_Null):
+    """描画を行わない streamlit モジュールの代替"""
+
+    def __init__(self):
+        object.__setattr__(self, "session_state", SessionState())
+
+    @contextmanager
+    def spinner(self, *args, **kwargs):
+        yield
+
+    def columns(self, spec, *args, **kwargs):
+        count = spec if isinstance(spec, int) else len(spec)
+        return [_Null() for _ in range(count)]
+
+    def tabs(self, labels):
+        return [_Null() for _ in labels]
+
+
+class _Field:
+    def __init__(self, name):
+        self.name = name
+
+
+class _TableReference:
+    def __init__(self, table_id):
+        self.project, self.dataset_id, self.table_id = "fake-project", "_anonymous", table_id
+
+
+class FakeRowIterator:
+    def __init__(self, table: pa.Table, batch_size: int):
+        self._table = table
+        self._batch_size = batch_size
+        self.schema = [_Field(name) for name in table.column_names]
+        self.total_rows = table.num_rows
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        yield from self._table.to_batches(max_chunksize=self._batch_size)
+
+
+class FakeQueryJob:
+    def __init__(self, table: pa.Table = None, dry_run_bytes: int = None, latency_ms: float = 0, batch_size: int = 10000):
+        self._table = table
+        self._batch_size = batch_size
+        self._ready_at = time.monotonic() + latency_ms / 1000
+        self.job_id = f"fake_{id(self):x}"
+        self.destination = _TableReference(f"anon_{self.job_id}")
+        self.total_bytes_processed = dry_run_bytes if dry_run_bytes is not None else (table.nbytes if table is not None else 0)
+        self.slot_millis = int(latency_ms)
+        self.cache_hit = False
+
+    def done(self, *args, **kwargs):
+        return time.monotonic() >= self._ready_at
+
+    def cancel(self):
+        self._ready_at = 0
+
+    def result(self, *args, **kwargs):
+        remaining = self._ready_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        return FakeRowIterator(self._table, self._batch_size)
+
+
+class FakeBigQueryClient:
+    """
+    route(sql) が返すDataFrameを結果とするBigQueryクライアントの代替。
+    同じDataFrameのArrow変換結果は再利用し、変換時間を計測に含めない。
+    dry_run_bytes を指定すると、ドライランの推定スキャン量を結果のサイズの代わりにその値にする。
+    """
+
+    def __init__(self, route, latency_ms: float = 0, batch_size: int = 10000, dry_run_bytes: int = None):
+        self.route = route
+        self.latency_ms = latency_ms
+        self.batch_size = batch_size
+        self.dry_run_bytes = dry_run_bytes
+        self.job_configs = []  # 実行したジョブ（ドライラン以外）のジョブ設定
+        self._tables = {}
+        self._destinations = {}  # ジョブの出力先のID → 結果のArrowテーブル
+        self.queries = []
+
+    def query(self, sql, job_config=None, **kwargs):
+        df = self.route(sql)
+        table = self._tables.get(id(df))
+        if table is None:
+            table = self._tables[id(df)] = (df, pa.Table.from_pandas(df, preserve_index=False))
+        if job_config is not None and getattr(job_config, "dry_run", False):
+            return FakeQueryJob(dry_run_bytes=table[1].nbytes if self.dry_run_bytes is None else self.dry_run_bytes)
+        self.queries.append(sql)
+        self.job_configs.append(job_config)
+        job = FakeQueryJob(table[1], latency_ms=self.latency_ms, batch_size=self.batch_size)
+        destination = job.destination
+        self._destinations[f"{destination.project}.{destination.dataset_id}.{destination.table_id}"] = table[1]
+        return job
+
+    def list_rows(self, table, **kwargs):
+        if table not in self._destinations:
+            raise KeyError(f"Not found: Table {table}")
+        return FakeRowIterator(self._destinations[table], self.batch_size)
+
+
+class _FakeJob:
+    def __init__(self, job_id, sql):
+        self.job_id = job_id
+        self.sql = sql
+        self.finished = False
+        self.cancelled = False
+
+
+class FakeJobBackend:
+    """
+    JobManager のバックエンドの代替。投入されたジョブは finish() を呼ぶか取り消されるまで完了しない。
+    同時に実行中だったジョブ数の最大値（max_active）と、取り消されたジョブを記録する。
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def submit(self, bq_client, sql, job_config=None):
+        with self._lock:
+            job = _FakeJob(f"fake_job_{len(self.jobs)}", sql)
+            self.jobs.append(job)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        return job
+
+    def is_done(self, job):
+        return job.finished or job.cancelled
+
+    def cancel(self, job):
+        self._complete(job, cancelled=True)
+
+    def job_id(self, job):
+        return job.job_id
+
+    def finish(self, sql):
+        """指定したSQLの未完了のジョブを完了させる"""
+        for job in list(self.jobs):
+            if job.sql == sql:
+                self._complete(job)
+
+    def _complete(self, job, cancelled=False):
+        with self._lock:
+            if job.finished or job.cancelled:
+                return
+            job.cancelled, job.finished = cancelled, not cancelled
+            self.active -= 1
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, response_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = response_tokens
+
+
+class _Chunk:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeModel:
+    """
+    記録済みの応答を返す GenerativeModel の代替。
+    プロンプトにテーブル定義やSQLが含まれる場合（SQLの生成・修正）はSQLの応答を、それ以外はコメントの応答を返す。
+    """
+
+    def __init__(self, responses: dict, latency_ms: float = 0, chunk_chars: int = 40):
+        self.responses = responses
+        self.latency_ms = latency_ms
+        self.chunk_chars = chunk_chars
+        self.calls = 0
+
+    def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+        self.calls += 1
+        text = self.responses["sql" if "# 分析対象:" in prompt or "SQL" in prompt else "comment"]
+        usage = _Usage(len(prompt) // 2, len(text) // 2)
+        if not stream:
+            time.sleep(self.latency_ms / 1000)
+            return _Chunk(text, usage)
+        return self._stream(text, usage)
+
+    def _stream(self, text, usage):
+        # Gemini と同様に、各断片にはそこまでの累計のトークン数が入る
+        pieces = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+        streamed = 0
+        for piece in pieces:
+            time.sleep(self.latency_ms / 1000 / max(1, len(pieces)))
+            streamed += len(piece)
+            yield _Chunk(piece, _Usage(usage.prompt_token_count, streamed // 2))
@@ -0,0 +1,95 @@
+# benchmarks/fixtures.py
+"""
+ベンチマーク用のBigQuery結果とGeminiの応答
+- benchmarks/fixtures/<名前>.parquet があればそれを記録済みの結果として使い、指定行数まで繰り返し・切り詰めする
+- なければ、キャンペーンレポートと同じ列構成の合成データを乱数シード固定で生成する
+- Geminiの応答は benchmarks/fixtures/gemini_responses.json（{"sql": ..., "comment": ...}）があればそれを使う
+record_fixture() で、実環境のクエリ結果を Parquet として記録できる
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CAMPAIGN_TABLE = "vorn-digi-mktg-poc-635a.toki_air.LookerStudio_report_campaign"
+
+DEFAULT_RESPONSES = {
+    "sql": (
+        "```sql\n"
+        "SELECT Date, ServiceNameJA_Media, SUM(Impressions) AS Impressions, SUM(Clicks) AS Clicks,\n"
+        "  SUM(Conversions) AS Conversions, SUM(CostIncludingFees) AS CostIncludingFees\n"
+        f"FROM `{CAMPAIGN_TABLE}`\n"
+        "GROUP BY Date, ServiceNameJA_Media\n"
+        "ORDER BY Date\n"
+        "```\n"
+        "上記のSQLでは日別・メディア別に主要指標を集計しています。"
+    ),
+    "comment": (
+        "- 直近2週間でクリック数が増加しており、特に検索広告の伸びが大きくなっています。\n"
+        "- CPAは横ばいですが、ディスプレイ広告は前月比で悪化しています。\n"
+        "- 週末はCVRが高く、土日への予算配分の見直しが有効と考えられます。"
+    ),
+}
+
+_MEDIA = ["Google検索", "Yahoo!検索", "Googleディスプレイ", "Yahoo!ディスプレイ", "Meta", "X", "LINE", "TikTok"]
+_DEVICES = ["PC", "スマートフォン", "タブレット"]
+_DAYS_JA = ["月", "火", "水", "木", "金", "土", "日"]
+
+
+def synthetic_campaign_data(rows: int, seed: int = 0) -> pd.DataFrame:
+    """キャンペーンレポートと同じ主要列を持つ合成データを返す"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2024-01-01", periods=365, freq="D")
+    date_index = rng.integers(0, len(dates), rows)
+    campaign_count = max(5, min(500, rows // 200))
+    impressions = rng.integers(100, 50000, rows)
+    clicks = (impressions * rng.uniform(0.005, 0.05, rows)).astype("int64")
+    return pd.DataFrame({
+        "Date": dates[date_index].date,
+        "ServiceNameJA_Media": np.array(_MEDIA, dtype=object)[rng.integers(0, len(_MEDIA), rows)],
+        "CampaignName": np.array([f"キャンペーン_{i:03d}" for i in range(campaign_count)], dtype=object)[rng.integers(0, campaign_count, rows)],
+        "DayOfWeekJA": np.array(_DAYS_JA, dtype=object)[dates[date_index].dayofweek],
+        "HourOfDay": rng.integers(0, 24, rows),
+        "DeviceCategory": np.array(_DEVICES, dtype=object)[rng.integers(0, len(_DEVICES), rows)],
+        "Impressions": impressions,
+        "Clicks": clicks,
+        "Conversions": (clicks * rng.uniform(0.0, 0.08, rows)).round(2),
+        "CostIncludingFees": (clicks * rng.uniform(20, 200, rows)).round(0),
+    })
+
+
+def load_campaign_data(rows: int, name: str = "campaign") -> pd.DataFrame:
+    """記録済みの Parquet があれば指定行数に揃えて返し、なければ合成データを返す"""
+    path = os.path.join(FIXTURE_DIR, f"{name}.parquet")
+    if not os.path.exists(path):
+        return synthetic_campaign_data(rows)
+    recorded = pd.read_parquet(path)
+    if recorded.empty:
+        return synthetic_campaign_data(rows)
+    repeats = -(-rows // len(recorded))
+    return pd.concat([recorded] * repeats, ignore_index=True).head(rows)
+
+
+def aggregate_by_first_column(df: pd.DataFrame) -> pd.DataFrame:
+    """result_policy のロールアップSQLに相当する、先頭列での集計結果を返す"""
+    numeric = df.select_dtypes(include="number").columns.tolist()
+    return df.groupby(df.columns[0], observed=True, sort=True)[numeric].sum().reset_index()
+
+
+def load_responses() -> dict:
+    """記録済みのGeminiの応答（なければ既定の応答）を返す"""
+    path = os.path.join(FIXTURE_DIR, "gemini_responses.json")
+    responses = dict(DEFAULT_RESPONSES)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            responses.update(json.load(f))
+    return responses
+
+
+def record_fixture(bq_client, sql: str, name: str = "campaign") -> str:
+    """実環境でクエリを実行し、結果をベンチマーク用の Parquet として保存してパスを返す"""
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    path = os.path.join(FIXTURE_DIR, f"{name}.parquet")
+    bq_client.query(sql).to_dataframe().to_parquet(path, index=False)
+    return path
@@ -0,0 +1,100 @@
+# benchmarks/import_time.py
+"""
+アプリ起動時のモジュール読み込み時間のベンチマーク
+
+    python -m benchmarks.import_time --repeat 5 --top 15
+
+新しいPythonプロセスで `python -X importtime -c "import main"` を実行し、出力を集計する。
+読み込み全体の時間（中央値）と、main から直接読み込まれるモジュールのうち時間のかかる上位、
+起動時に読み込まないようにしているSDK（vertexai・google.cloud.bigquery・plotly など）が読み込まれていないかを出力する。
+--max-ms を指定すると、読み込み時間が上限を超えたときに終了コード1で終わる（起動時間の悪化の検知用）。
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# 起動時には読み込まず、最初に使われたときに読み込むモジュール
+DEFERRED_MODULES = [
+    "vertexai", "google.cloud.bigquery", "plotly.express",
+    "duckdb", "sqlglot", "xlsxwriter", "google.cloud.bigquery_storage",
+]
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(output: str) -> list:
+    """-X importtime の出力を (モジュール名, 階層, 自身の時間[us], 累積時間[us]) のリストにする"""
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # 見出し行
+        name = parts[2].rstrip()
+        stripped = name.lstrip(" ")
+        depth = (len(name) - len(stripped) - 1) // 2
+        entries.append((stripped, depth, int(parts[0]), int(parts[1])))
+    return entries
+
+
+def measure(module: str) -> list:
+    """新しいプロセスでモジュールを読み込み、-X importtime の集計結果を返す"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{module} の読み込みに失敗しました:\n{proc.stderr[-2000:]}")
+    return parse_importtime(proc.stderr)
+
+
+def summarize(runs: list, module: str, top: int) -> dict:
+    """複数回の計測結果から、全体・直接の依存ごとの累積時間の中央値と、読み込まれた遅延対象を返す"""
+    totals, children = [], {}
+    for entries in runs:
+        totals.append(sum(cumulative for name, depth, _, cumulative in entries if name == module and depth == 0))
+        for name, depth, _, cumulative in entries:
+            if depth == 1:
+                children.setdefault(name, []).append(cumulative)
+    imported = {name for name, *_ in runs[-1]}
+    slowest = sorted(((name, statistics.median(values)) for name, values in children.items()), key=lambda item: -item[1])
+    return {
+        "module": module,
+        "total_ms": round(statistics.median(totals) / 1000, 1),
+        "top_imports": [{"module": name, "cumulative_ms": round(us / 1000, 1)} for name, us in slowest[:top]],
+        "deferred_loaded": [name for name in DEFERRED_MODULES if name in imported],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="アプリ起動時のモジュール読み込み時間のベンチマーク")
+    parser.add_argument("--module", default="main", help="読み込むモジュール")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="表示する直接の依存の件数")
+    parser.add_argument("--max-ms", type=float, help="読み込み時間の上限（超えたら終了コード1）")
+    parser.add_argument("--json", dest="json_path", help="結果をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    measure(args.module)  # .pyc の作成を計測に含めないための空実行
+    result = summarize([measure(args.module) for _ in range(args.repeat)], args.module, args.top)
+
+    print(f"import {result['module']}: {result['total_ms']:.1f} ms（{args.repeat}回の中央値）")
+    for item in result["top_imports"]:
+        print(f"  {item['module']:<40}{item['cumulative_ms']:>10.1f} ms")
+    if result["deferred_loaded"]:
+        print(f"起動時に読み込まれた遅延対象のモジュール: {', '.join(result['deferred_loaded'])}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"repeat": args.repeat, **result}, f, ensure_ascii=False, indent=2)
+    if args.max_ms is not None and result["total_ms"] > args.max_ms:
+        print(f"読み込み時間が上限（{args.max_ms:.0f} ms）を超えています")
+        sys.exit(1)
+    return result
+
+
+if __name__ == "__main__":
+    main()
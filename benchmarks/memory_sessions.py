@@ -0,0 +1,109 @@
+# benchmarks/memory_sessions.py
+"""
+多数のセッションが同時に結果を保持したときのメモリ使用量のベンチマーク
+
+    python -m benchmarks.memory_sessions --sessions 50 --rows 50000 --budget-mb 256
+
+各セッションに分析結果のDataFrame・グラフ・履歴を持たせ、ランダムな順序で操作（計測・追い出し・読み戻し）を繰り返す。
+メモリガバナーなし（予算無制限）とありの2通りで、最終的に保持されているメモリ（tracemalloc）と、
+ガバナーが把握している合計・追い出し回数・読み戻し回数を出力する。
+Arrowが確保する文字列列のメモリは tracemalloc では追跡されないため、tracked_mb（memory_usage(deep=True) の合計）も併せて見る。
+"""
+import gc
+import os
+import sys
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+os.environ.setdefault("TRACE_ENABLED", "false")
+
+import charting
+from history_store import HistoryStore
+from memory_governor import MemoryGovernor
+import history_store
+from benchmarks.fakes import SessionState, StubStreamlit
+from benchmarks.fixtures import synthetic_campaign_data
+
+MB = 1024 * 1024
+
+
+def make_session(rows: int, seed: int) -> SessionState:
+    """1セッション分の分析結果（DataFrame・グラフ・履歴）を持つセッション状態を作る"""
+    state = SessionState()
+    df = synthetic_campaign_data(rows, seed=seed)
+    cfg = {"main_chart_type": "組合せグラフ", "x_axis": "Date", "y_axis_left": "Clicks",
+           "y_axis_right": "CostIncludingFees", "legend_col": "ServiceNameJA_Media"}
+    state.update({"df": df, "fig": charting.render_plotly_chart(df, cfg), "graph_cfg": cfg, "analysis_history": []})
+    history_store.add_history_entry(state["analysis_history"], f"分析{seed}", "SELECT 1", df, cfg, "コメント")
+    return state
+
+
+def simulate(sessions: int, rows: int, budget_bytes: int, revisits: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    spill_dir = tempfile.mkdtemp(prefix="memory_sessions_")
+    store = HistoryStore(memory_budget=64 * MB, spill_dir=spill_dir)
+    history_store._history_store = store
+    governor = MemoryGovernor(budget_bytes=budget_bytes, min_idle_seconds=0, history_store=store)
+
+    gc.collect()
+    tracemalloc.start()
+    states = {}
+    peak_tracked = 0
+    restore_failures = 0
+    for index in range(sessions):
+        session_id = f"session-{index}"
+        states[session_id] = make_session(rows, seed=index)
+        governor.track(session_id, states[session_id])
+        governor.enforce(exclude=session_id)
+        peak_tracked = max(peak_tracked, governor.stats()["total_bytes"])
+
+    # ユーザーが戻ってきたセッションでは、退避された結果を読み戻してから操作する
+    for _ in range(revisits):
+        session_id = rng.choice(list(states))
+        if not governor.restore(states[session_id]):
+            restore_failures += 1
+        governor.track(session_id, states[session_id])
+        governor.enforce(exclude=session_id)
+        peak_tracked = max(peak_tracked, governor.stats()["total_bytes"])
+
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = governor.stats()
+    return {
+        "budget_mb": round(budget_bytes / MB) if budget_bytes < sys.maxsize else None,
+        "retained_mb": round(current / MB, 1),
+        "peak_mb": round(peak / MB, 1),
+        "tracked_mb": round(stats["total_bytes"] / MB, 1),
+        "peak_tracked_mb": round(peak_tracked / MB, 1),
+        "evicted_sessions": stats["evicted_sessions"],
+        "spilled_frames": stats["spilled_frames"],
+        "restored_frames": stats["restored_frames"],
+        "restore_failures": restore_failures,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多数のセッションのメモリ使用量のベンチマーク")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=50000, help="セッションごとの結果の行数")
+    parser.add_argument("--budget-mb", type=int, default=256, help="インスタンスのメモリ予算")
+    parser.add_argument("--revisits", type=int, default=100, help="ランダムに選んだセッションを再操作する回数")
+    args = parser.parse_args(argv)
+
+    charting.st = StubStreamlit()
+    results = [
+        ("governor off", simulate(args.sessions, args.rows, sys.maxsize, args.revisits)),
+        ("governor on", simulate(args.sessions, args.rows, args.budget_mb * MB, args.revisits)),
+    ]
+    keys = list(results[0][1])
+    print(f"{'':<14}" + "".join(f"{key:>18}" for key in keys))
+    for label, result in results:
+        print(f"{label:<14}" + "".join(f"{str(result[key]):>18}" for key in keys))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# benchmarks/run_benchmarks.py
+"""
+分析フローのオフラインベンチマーク
+
+    python -m benchmarks.run_benchmarks --sizes 1000,10000,100000,1000000 --repeat 5
+
+記録済み（または合成）のBigQuery結果とGeminiの応答を使い、Streamlitを置き換えた状態で
+run_analysis_flow / run_summary02_analysis / get_ai_dashboard_comment / render_plotly_chart を実行する。
+段階×データ行数ごとに、処理時間の p50 / p95 と、tracemalloc で計測したピークメモリ・確保ブロック数を出力する。
+キャッシュは毎回空にするため、いずれも初回表示（キャッシュなし）の時間になる。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import statistics
+import tracemalloc
+
+# アプリのモジュールを読み込む前に、外部サービスやキャッシュを使わない設定にする
+for _key, _value in {
+    "USE_BQSTORAGE": "false",
+    "QUERY_CACHE_DIR": "",
+    "SQL_CACHE_ENABLED": "false",
+    "SQL_CACHE_PATH": "",
+    "COMMENT_CACHE_TTL_SECONDS": "-1",
+    "PREFETCH_ENABLED": "false",
+    "USE_ROLLUP_TABLES": "false",
+    "USE_LOCAL_ENGINE": "false",
+    "TRACE_ENABLED": "false",
+    "JOB_POLL_INTERVAL_SECONDS": "0.001",
+}.items():
+    os.environ.setdefault(_key, _value)
+
+import pandas as pd
+
+import analysis_logic
+import charting
+import dashboard_analyzer
+import job_manager
+from query_cache import get_query_cache
+from dashboard_analyzer import SHEET_ANALYSIS_QUERIES
+from benchmarks.fakes import StubStreamlit, FakeBigQueryClient, FakeModel
+from benchmarks.fixtures import load_campaign_data, aggregate_by_first_column, load_responses
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+# ダッシュボードのシートクエリは集計済みの結果を返し、実環境では10万行を超えないため、既定では上限を設ける（--no-caps で解除）
+STAGE_MAX_ROWS = {"dashboard_comment": 100_000}
+
+BENCH_FILTERS = {
+    "start_date": datetime.date(2024, 1, 1),
+    "end_date": datetime.date(2024, 12, 31),
+    "media": [],
+    "campaigns": [],
+    "sheet": "キャンペーン",
+}
+
+
+class BenchContext:
+    """1つのデータ行数に対するフェイククライアントとStreamlitの代替"""
+
+    def __init__(self, rows: int, bq_latency_ms: float, llm_latency_ms: float):
+        self.rows = rows
+        self.data = load_campaign_data(rows)
+        self.rollup = aggregate_by_first_column(self.data)
+        self.bq_client = FakeBigQueryClient(self.route, latency_ms=bq_latency_ms)
+        self.model = FakeModel(load_responses(), latency_ms=llm_latency_ms)
+
+    def route(self, sql: str) -> pd.DataFrame:
+        # result_policy が最初のジョブの出力先に対して組み立てる先頭列での集計SQLには集計済みの結果を、それ以外は全行を返す
+        if sql.lstrip().startswith("SELECT `") and "FROM `fake-project._anonymous." in sql:
+            return self.rollup
+        return self.data
+
+    def reset(self):
+        """キャッシュを空にし、新しいセッションの状態でStreamlitの代替を差し込む"""
+        get_query_cache().clear()
+        stub = StubStreamlit()
+        stub.session_state.update({
+            "bq_client": self.bq_client, "model": self.model,
+            "sql": "", "df": pd.DataFrame(), "comment": "", "graph_cfg": {}, "analysis_history": [],
+            "pending_sql": None, "cost_estimate": None, "result_meta": None, "execution_attempts": [],
+        })
+        for module in (analysis_logic, charting, dashboard_analyzer, job_manager):
+            module.st = stub
+        return stub
+
+
+def stage_analysis_flow(ctx: BenchContext):
+    analysis_logic.run_analysis_flow(
+        "先月のメディア別のクリック数の日別推移を教えてください", BENCH_FILTERS,
+        True, False, False, SHEET_ANALYSIS_QUERIES,
+    )
+
+def stage_summary02(ctx: BenchContext):
+    analysis_logic.run_summary02_analysis(ctx.bq_client, ctx.model, BENCH_FILTERS, SHEET_ANALYSIS_QUERIES)
+
+def stage_dashboard_comment(ctx: BenchContext):
+    dashboard_analyzer.get_ai_dashboard_comment(
+        ctx.bq_client, ctx.model, BENCH_FILTERS["sheet"], BENCH_FILTERS, SHEET_ANALYSIS_QUERIES, force_refresh=True,
+    )
+
+def stage_chart_bar(ctx: BenchContext):
+    charting.render_plotly_chart(ctx.data, {
+        "main_chart_type": "棒グラフ", "x_axis": "Date", "y_axis_left": "Clicks", "y_axis_right": None, "legend_col": "なし",
+    })
+
+def stage_chart_combo_legend(ctx: BenchContext):
+    charting.render_plotly_chart(ctx.data, {
+        "main_chart_type": "組合せグラフ", "x_axis": "Date", "y_axis_left": "Clicks",
+        "y_axis_right": "CostIncludingFees", "legend_col": "ServiceNameJA_Media",
+    })
+
+STAGES = {
+    "analysis_flow": stage_analysis_flow,
+    "summary02": stage_summary02,
+    "dashboard_comment": stage_dashboard_comment,
+    "chart_bar": stage_chart_bar,
+    "chart_combo_legend": stage_chart_combo_legend,
+}
+
+
+def percentile(values: list, q: float) -> float:
+    """線形補間によるパーセンタイルを返す"""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def run_stage(ctx: BenchContext, stage_fn, repeat: int) -> dict:
+    """時間計測を repeat 回、メモリ計測（tracemalloc は処理を遅くするため別に）を1回行う"""
+    timings = []
+    for _ in range(repeat):
+        ctx.reset()
+        started = time.perf_counter()
+        stage_fn(ctx)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    ctx.reset()
+    tracemalloc.start()
+    try:
+        stage_fn(ctx)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+
+    return {
+        "p50_ms": round(percentile(timings, 0.5), 1),
+        "p95_ms": round(percentile(timings, 0.95), 1),
+        "mean_ms": round(statistics.mean(timings), 1),
+        "peak_mb": round(peak / 1024 / 1024, 1),
+        "live_blocks": blocks,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="分析フローのオフラインベンチマーク")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES), help="データ行数（カンマ区切り）")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"実行する段階（{', '.join(STAGES)}）")
+    parser.add_argument("--repeat", type=int, default=5, help="時間計測の繰り返し回数")
+    parser.add_argument("--bq-latency-ms", type=float, default=0, help="BigQueryジョブ1件あたりの模擬遅延")
+    parser.add_argument("--llm-latency-ms", type=float, default=0, help="Gemini呼び出し1件あたりの模擬遅延")
+    parser.add_argument("--no-caps", action="store_true", help="段階ごとの行数上限を無視する")
+    parser.add_argument("--json", dest="json_path", help="結果をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)}")
+
+    results = []
+    print(f"{'stage':<20}{'rows':>10}{'p50 ms':>12}{'p95 ms':>12}{'peak MB':>10}{'blocks':>10}")
+    for rows in sizes:
+        ctx = BenchContext(rows, args.bq_latency_ms, args.llm_latency_ms)
+        for stage in stages:
+            if not args.no_caps and rows > STAGE_MAX_ROWS.get(stage, rows):
+                print(f"{stage:<20}{rows:>10}{'(skipped)':>12}")
+                continue
+            result = {"stage": stage, "rows": rows, **run_stage(ctx, STAGES[stage], args.repeat)}
+            results.append(result)
+            print(f"{stage:<20}{rows:>10}{result['p50_ms']:>12.1f}{result['p95_ms']:>12.1f}{result['peak_mb']:>10.1f}{result['live_blocks']:>10}")
+            sys.stdout.flush()
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"repeat": args.repeat, "results": results}, f, ensure_ascii=False, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
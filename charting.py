@@ -1,15 +1,56 @@
 # charting.py
+import os
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 import streamlit as st
+from result_policy import RATIO_METRICS
+
+# 凡例に表示する項目数の上限（超えた分は「その他」にまとめる）
+CHART_LEGEND_TOP_N = int(os.environ.get("CHART_LEGEND_TOP_N", "10"))
+# この点数を超える折れ線・散布図は WebGL（Scattergl）で描画する
+CHART_WEBGL_THRESHOLD = int(os.environ.get("CHART_WEBGL_THRESHOLD", "5000"))
+OTHER_LABEL = "その他"
+
+def _aggregation(col) -> str:
+    """比率指標は平均、それ以外は合計で集計する"""
+    return "mean" if str(col).upper() in RATIO_METRICS else "sum"
+
+def cap_legend(df: pd.DataFrame, legend_col: str, x_axis: str, measures: list, top_n: int = CHART_LEGEND_TOP_N, force: bool = False):
+    """
+    凡例の項目を左軸の指標の合計が大きい上位 top_n 件に絞り、残りを「その他」にまとめる。
+    凡例×X軸ごとに1回の groupby で集計した結果と、凡例の表示順を返す。
+    項目数が上限以下で force=False の場合は、元のデータをそのまま返す。
+    """
+    legend = df[legend_col]
+    totals = df.groupby(legend, observed=True, sort=False)[measures[0]].sum().sort_values(ascending=False)
+    if len(totals) <= top_n and not force:
+        return df, list(totals.index)
+
+    top = totals.index[:top_n]
+    order = list(top)
+    if len(totals) > top_n:
+        if isinstance(legend.dtype, pd.CategoricalDtype) and OTHER_LABEL not in legend.cat.categories:
+            # カテゴリ型の列には、既存のカテゴリにない値を入れられない
+            legend = legend.cat.add_categories([OTHER_LABEL])
+        legend = legend.where(legend.isin(top), OTHER_LABEL)
+        order.append(OTHER_LABEL)
+    measures = list(dict.fromkeys(measures))
+    aggregated = (
+        df[[x_axis] + measures]
+        .groupby([legend.rename(legend_col), df[x_axis]], observed=True, sort=True)[measures]
+        .agg({col: _aggregation(col) for col in measures})
+        .reset_index()
+    )
+    return aggregated, order
 
 def render_plotly_chart(df: pd.DataFrame, cfg: dict):
     """
     Plotlyグラフを描画する。
     設定(cfg)に基づいて、単一グラフ、または左右のY軸を持つ組合せグラフを生成する。
     """
+    # plotly はアプリの起動を遅らせないよう、最初にグラフを描くときに読み込む
+    import plotly.express as px
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
     try:
         chart_type = cfg.get("main_chart_type")
         x_axis = cfg.get("x_axis")
@@ -27,14 +68,20 @@ def render_plotly_chart(df: pd.DataFrame, cfg: dict):
 
             # --- 凡例が指定されている場合 ---
             if legend_col:
-                # 凡例の各項目でループ
-                for value in df[legend_col].unique():
-                    df_filtered = df[df[legend_col] == value]
+                # 凡例×X軸で1回だけ集計し、凡例の項目ごとの位置で切り出す
+                plot_df, order = cap_legend(df, legend_col, x_axis, [y_axis_left, y_axis_right], force=True)
+                positions = plot_df.groupby(legend_col, observed=True, sort=False).indices
+                line_trace = go.Scattergl if len(plot_df) > CHART_WEBGL_THRESHOLD else go.Scatter
+                x_values, left_values, right_values = (plot_df[col].to_numpy() for col in (x_axis, y_axis_left, y_axis_right))
+                for value in order:
+                    rows = positions.get(value)
+                    if rows is None:
+                        continue
                     # 左軸の棒グラフを追加
                     fig.add_trace(
                         go.Bar(
-                            x=df_filtered[x_axis],
-                            y=df_filtered[y_axis_left],
+                            x=x_values[rows],
+                            y=left_values[rows],
                             name=f"{value} ({y_axis_left})", # 凡例名を明確化
                             showlegend=True
                         ),
@@ -42,9 +89,9 @@ def render_plotly_chart(df: pd.DataFrame, cfg: dict):
                     )
                     # 右軸の折れ線グラフを追加
                     fig.add_trace(
-                        go.Scatter(
-                            x=df_filtered[x_axis],
-                            y=df_filtered[y_axis_right],
+                        line_trace(
+                            x=x_values[rows],
+                            y=right_values[rows],
                             name=f"{value} ({y_axis_right})", # 凡例名を明確化
                             mode='lines+markers',
                             showlegend=True
@@ -53,12 +100,13 @@ def render_plotly_chart(df: pd.DataFrame, cfg: dict):
                     )
             # --- 凡例が指定されていない場合 ---
             else:
+                line_trace = go.Scattergl if len(df) > CHART_WEBGL_THRESHOLD else go.Scatter
                 fig.add_trace(
                     go.Bar(x=df[x_axis], y=df[y_axis_left], name=y_axis_left, showlegend=True),
                     secondary_y=False,
                 )
                 fig.add_trace(
-                    go.Scatter(x=df[x_axis], y=df[y_axis_right], name=y_axis_right, mode='lines+markers', showlegend=True),
+                    line_trace(x=df[x_axis], y=df[y_axis_right], name=y_axis_right, mode='lines+markers', showlegend=True),
                     secondary_y=True,
                 )
 
@@ -78,9 +126,15 @@ def render_plotly_chart(df: pd.DataFrame, cfg: dict):
                 fig = px_func(df, names=x_axis, values=y_axis_left, hole=.3)
             elif px_func:
                 kwargs = {'x': x_axis, 'y': y_axis_left, 'color': legend_col}
+                plot_df = df
+                if legend_col:
+                    plot_df, order = cap_legend(df, legend_col, x_axis, [y_axis_left])
+                    kwargs['category_orders'] = {legend_col: order}
                 if chart_type in ["折れ線グラフ", "散布図", "面グラフ"]:
                     kwargs['markers'] = True
-                fig = px_func(df, **kwargs)
+                if chart_type in ["折れ線グラフ", "散布図"] and len(plot_df) > CHART_WEBGL_THRESHOLD:
+                    kwargs['render_mode'] = 'webgl'
+                fig = px_func(plot_df, **kwargs)
             else:
                 return go.Figure()
 
@@ -92,4 +146,4 @@ def render_plotly_chart(df: pd.DataFrame, cfg: dict):
 
     except Exception as e:
         st.error(f"グラフ描画中にエラーが発生しました: {e}")
-        return go.Figure()
\ No newline at end of file
+        return go.Figure()
@@ -0,0 +1,222 @@
+# client_pool.py
+"""
+インスタンス内の全セッションで共有する BigQuery / Vertex AI クライアントの呼び出し制御
+- BigQueryクライアントのHTTPコネクションプールの大きさを BQ_HTTP_POOL_SIZE に揃える
+- サービスごとのセマフォで同時呼び出し数を制限し、空きを待つ時間（キュー待ち）を記録する
+- Gemini はトークンバケットでリクエスト数を平準化し、クォータ超過（429）になる前に待たせる
+- 待ち時間が POOL_ACQUIRE_TIMEOUT_SECONDS を超えた場合は ServiceBusy を送出し、混雑中であることを利用者に伝える
+- LazyClient は最初に使われたときにSDKを読み込んでクライアントを作成し、起動直後の画面表示を待たせない
+ラッパーは元のクライアントと同じメソッドで呼び出せるため、呼び出し側の変更は不要
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+BQ_HTTP_POOL_SIZE = int(os.environ.get("BQ_HTTP_POOL_SIZE", "32"))
+BQ_MAX_CONCURRENT_CALLS = int(os.environ.get("BQ_MAX_CONCURRENT_CALLS", "16"))
+GEMINI_MAX_CONCURRENT_CALLS = int(os.environ.get("GEMINI_MAX_CONCURRENT_CALLS", "8"))
+# Gemini のリクエスト数の上限（1分あたり）と、瞬間的に許容する連続リクエスト数
+GEMINI_REQUESTS_PER_MINUTE = float(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "60"))
+GEMINI_BURST = int(os.environ.get("GEMINI_BURST", "10"))
+POOL_ACQUIRE_TIMEOUT_SECONDS = float(os.environ.get("POOL_ACQUIRE_TIMEOUT_SECONDS", "60"))
+
+
+class ServiceBusy(Exception):
+    """同時実行数やレート制限の空きを待ちきれなかったことを表す"""
+
+
+class ClientInitError(Exception):
+    """クライアントの作成（SDKの読み込み・認証情報の取得など）に失敗したことを表す"""
+
+
+class TokenBucket:
+    """一定の速度で補充されるトークンを消費してリクエスト数を制限する"""
+
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate = rate_per_second
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float = None) -> float:
+        """トークンを1つ消費する。補充を待った秒数を返し、timeout 秒以内に取れなければ ServiceBusy"""
+        if self.rate <= 0:
+            return 0.0
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return now - started
+                wait = (1 - self._tokens) / self.rate
+            if timeout is not None and time.monotonic() - started + wait > timeout:
+                raise ServiceBusy("リクエストが集中しています。しばらく待ってから再度お試しください。")
+            time.sleep(wait)
+
+
+class ServiceGate:
+    """サービス単位の同時実行数の制限と、キュー待ち時間の記録を行う"""
+
+    def __init__(self, name: str, max_concurrent: int, bucket: TokenBucket = None,
+                 timeout: float = POOL_ACQUIRE_TIMEOUT_SECONDS):
+        self.name = name
+        self.timeout = timeout
+        self.bucket = bucket
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrent))
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "queued": 0, "busy": 0, "in_flight": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+    @contextmanager
+    def slot(self):
+        """レート制限と同時実行数の空きを待ってから処理を実行させる"""
+        started = time.monotonic()
+        try:
+            if self.bucket is not None:
+                self.bucket.acquire(timeout=self.timeout)
+            remaining = None if self.timeout is None else max(0.0, self.timeout - (time.monotonic() - started))
+            if not self._slots.acquire(timeout=remaining):
+                raise ServiceBusy("リクエストが集中しています。しばらく待ってから再度お試しください。")
+        except ServiceBusy:
+            with self._lock:
+                self._stats["busy"] += 1
+            raise
+        self._record_wait(time.monotonic() - started)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._stats["in_flight"] -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_wait"] = stats["total_wait"] / stats["calls"] if stats["calls"] else 0.0
+        return stats
+
+    def _record_wait(self, waited: float):
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["in_flight"] += 1
+            self._stats["total_wait"] += waited
+            self._stats["max_wait"] = max(self._stats["max_wait"], waited)
+            # 10ms 以上待ったものを「キュー待ちが発生した呼び出し」として数える
+            if waited >= 0.01:
+                self._stats["queued"] += 1
+
+
+def configure_http_pool(bq_client, pool_size: int = BQ_HTTP_POOL_SIZE):
+    """BigQueryクライアントのHTTPセッションに、指定サイズのコネクションプールを設定する"""
+    http = getattr(bq_client, "_http", None)
+    if http is None or not hasattr(http, "mount"):
+        return
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+
+
+class PooledBigQueryClient:
+    """bigquery.Client へのクエリ投入を、共有のゲートを通して行うラッパー"""
+
+    def __init__(self, client, gate: ServiceGate = None):
+        self._client = client
+        self._gate = gate or _gates["bigquery"]
+        configure_http_pool(client)
+
+    def query(self, *args, **kwargs):
+        with self._gate.slot():
+            return self._client.query(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class PooledGenerativeModel:
+    """GenerativeModel の呼び出しを、レート制限つきの共有ゲートを通して行うラッパー"""
+
+    def __init__(self, model, gate: ServiceGate = None):
+        self._model = model
+        self._gate = gate or _gates["gemini"]
+
+    def generate_content(self, *args, **kwargs):
+        if kwargs.get("stream"):
+            return self._stream(*args, **kwargs)
+        with self._gate.slot():
+            return self._model.generate_content(*args, **kwargs)
+
+    def _stream(self, *args, **kwargs):
+        # ストリーミングは応答を読み終える（または読むのをやめる）まで枠を占有する
+        with self._gate.slot():
+            yield from self._model.generate_content(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+class LazyClient:
+    """
+    最初に属性が参照されたときに factory() でクライアントを作成するプロキシ。
+    作成に失敗した場合は ClientInitError を送出し、次の参照時に作成をやり直す。
+    """
+
+    def __init__(self, name: str, factory):
+        self._name = name
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+        self._warming = False
+
+    @property
+    def ready(self) -> bool:
+        return self._client is not None
+
+    def get(self):
+        """作成済みのクライアントを返す（未作成なら作成する）"""
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                try:
+                    self._client = self._factory()
+                except Exception as e:
+                    raise ClientInitError(f"{self._name}の初期化中にエラーが発生しました: {e}") from e
+            return self._client
+
+    def warm_up(self):
+        """バックグラウンドでクライアントを作成しておく（最初の利用時の待ち時間を減らす）"""
+        if self._client is not None or self._warming:
+            return
+        self._warming = True
+
+        def _run():
+            try:
+                self.get()
+            except ClientInitError as e:
+                print(f"Failed to warm up client: {e}")
+            finally:
+                self._warming = False
+
+        threading.Thread(target=_run, name=f"warm-up-{self._name}", daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+_gates = {
+    "bigquery": ServiceGate("bigquery", BQ_MAX_CONCURRENT_CALLS),
+    "gemini": ServiceGate(
+        "gemini", GEMINI_MAX_CONCURRENT_CALLS,
+        bucket=TokenBucket(GEMINI_REQUESTS_PER_MINUTE / 60.0, GEMINI_BURST),
+    ),
+}
+
+def get_pool_stats() -> dict:
+    """サービスごとの呼び出し数・キュー待ち時間の統計を返す"""
+    return {name: gate.stats() for name, gate in _gates.items()}
@@ -0,0 +1,72 @@
+# comment_cache.py
+"""
+AIコメントのキャッシュ
+- キーは データの内容ハッシュ + グラフ設定 + プロンプトのバージョン
+- インスタンス内の全セッションで共有し、同じデータの再表示ではGeminiを呼び出さない
+- force_refresh=True で明示的に再生成できる
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# コメント生成プロンプトを変更したら更新する
+COMMENT_PROMPT_VERSION = "2"
+COMMENT_CACHE_TTL_SECONDS = int(os.environ.get("COMMENT_CACHE_TTL_SECONDS", "3600"))
+COMMENT_CACHE_MAX_ENTRIES = int(os.environ.get("COMMENT_CACHE_MAX_ENTRIES", "500"))
+
+def make_comment_key(kind: str, fingerprint: str, config=None) -> str:
+    """コメントの種類・データの指紋・設定からキャッシュキーを作る"""
+    payload = json.dumps([kind, fingerprint, config, COMMENT_PROMPT_VERSION], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class CommentCache:
+    """TTLと件数上限を持つスレッドセーフなコメントキャッシュ"""
+
+    def __init__(self, ttl_seconds: int = COMMENT_CACHE_TTL_SECONDS, max_entries: int = COMMENT_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (保存時刻, コメント)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl_seconds:
+                self._entries.pop(key, None)
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key: str, comment: str):
+        with self._lock:
+            self._entries[key] = (time.time(), comment)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_generate(self, key: str, generate_fn, force_refresh: bool = False) -> str:
+        """キャッシュにあればそれを返し、なければ generate_fn() の結果を保存して返す"""
+        if not force_refresh:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+        comment = generate_fn()
+        if comment:
+            self.put(key, comment)
+        return comment
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+_comment_cache = CommentCache()
+
+def get_comment_cache() -> CommentCache:
+    """インスタンス全体で共有するコメントキャッシュを返す"""
+    return _comment_cache
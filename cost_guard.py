@@ -0,0 +1,47 @@
+# cost_guard.py
+"""
+AIが生成したSQLを実行する前に、ドライランでスキャン量と料金を見積もる
+- COST_CONFIRM_BYTES を超える場合はユーザーの確認を求める
+- MAX_BYTES_BILLED を超える場合は実行を拒否し、実ジョブにも maximum_bytes_billed を設定する
+"""
+import os
+
+MAX_BYTES_BILLED = int(os.environ.get("MAX_BYTES_BILLED", str(50 * 1024 ** 3)))
+COST_CONFIRM_BYTES = int(os.environ.get("COST_CONFIRM_BYTES", str(5 * 1024 ** 3)))
+# オンデマンド料金（USD / TiB）
+BQ_USD_PER_TIB = float(os.environ.get("BQ_USD_PER_TIB", "6.25"))
+
+def estimate_query_cost(bq_client, sql_query: str) -> dict:
+    """ドライランを実行し、推定スキャンバイト数と推定料金(USD)を返す"""
+    from google.cloud import bigquery
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    job = bq_client.query(sql_query, job_config=job_config)
+    total_bytes = int(job.total_bytes_processed or 0)
+    return {"bytes": total_bytes, "cost_usd": total_bytes / 1024 ** 4 * BQ_USD_PER_TIB}
+
+def check_query_cost(total_bytes: int, confirm_bytes: int = COST_CONFIRM_BYTES, max_bytes: int = MAX_BYTES_BILLED) -> str:
+    """推定スキャン量から "ok" / "confirm" / "reject" のいずれかを判定する"""
+    if max_bytes and total_bytes > max_bytes:
+        return "reject"
+    if confirm_bytes and total_bytes > confirm_bytes:
+        return "confirm"
+    return "ok"
+
+def make_job_config(max_bytes_billed: int = MAX_BYTES_BILLED):
+    """課金上限を設定した実行用のジョブ設定を返す"""
+    if not max_bytes_billed:
+        return None
+    from google.cloud import bigquery
+    return bigquery.QueryJobConfig(maximum_bytes_billed=max_bytes_billed)
+
+def format_bytes(num_bytes: int) -> str:
+    """バイト数を読みやすい単位の文字列に変換する"""
+    size = float(num_bytes)
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if size < 1024 or unit == "TB":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}B"
+        size /= 1024
+
+def format_cost_estimate(estimate: dict) -> str:
+    """見積もり結果を表示用の文字列に変換する"""
+    return f"推定スキャン量: {format_bytes(estimate['bytes'])}（約 ${estimate['cost_usd']:.4f}）"
@@ -2,7 +2,17 @@
 
 import streamlit as st
 import pandas as pd
-from analysis_logic import build_where_clause
+from analysis_logic import build_where_clause, generate_comment_text
+from query_cache import run_query, dataframe_fingerprint
+from comment_cache import get_comment_cache, make_comment_key
+from rollup import resolve_sheet_table
+from local_engine import get_local_working_set, can_run_locally
+from prefetch import get_prefetch_scheduler, prefetch_sheets, PrefetchCancelled, PREFETCH_ENABLED
+from job_manager import JobCancelled
+from data_summarizer import summarize_dataframe
+from retry_policy import call_with_retry
+from tracing import start_span
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # --- シート別分析クエリの定義 ---
 SHEET_ANALYSIS_QUERIES = {
@@ -481,58 +491,116 @@ SHEET_ANALYSIS_QUERIES = {
 }
 
 
-@st.cache_data(ttl=600)
-def get_ai_dashboard_comment(_bq_client, _model, sheet_name, filters, sheet_analysis_queries):
+def build_sheet_where_clause(query_info, filters):
+    """シートクエリの supported_filters に応じたWHERE句（またはAND句）を組み立てる"""
+    base_query = query_info["query"]
+
+    # supported_filters キーが存在しない場合、デフォルトで全て適用
+    supported_filters = query_info.get("supported_filters", ["date", "media", "campaign"])
+
+    # クエリテンプレートに既にWHERE句があるか判定
+    has_fixed_where = 'WHERE' in base_query.upper().replace('{WHERE_CLAUSE}', '')
+
+    # supported_filters に基づいて build_where_clause を呼び出し
+    return build_where_clause(
+        filters,
+        apply_date="date" in supported_filters,
+        apply_media="media" in supported_filters,
+        apply_campaign="campaign" in supported_filters,
+        prefix="AND" if has_fixed_where else "WHERE"
+    )
+
+def build_sheet_query(sheet_name, filters, sheet_analysis_queries):
+    """シート名とフィルタから実行するSQLを組み立てる"""
+    query_info = sheet_analysis_queries.get(sheet_name, sheet_analysis_queries["default"])
+    # 事前集計テーブルでカバーできるクエリはロールアップに振り向ける
+    table_id = resolve_sheet_table(query_info)
+    return query_info["query"].format(table=table_id, where_clause=build_sheet_where_clause(query_info, filters))
+
+def fetch_sheet_data(bq_client, sheet_name, filters, sheet_analysis_queries, cancel_event=None):
     """
-    選択されたシートとフィルタに基づいてAIコメントを生成する。
+    シートの集計データを取得する。
+    ローカルエンジンが有効で計算可能なシートはDuckDB上で集計し、それ以外はBigQueryで実行する。
+    cancel_event がセットされると、実行中のBigQueryジョブを取り消す。
+    """
+    query_info = sheet_analysis_queries.get(sheet_name, sheet_analysis_queries["default"])
+    working_set = get_local_working_set()
+    if working_set is not None and can_run_locally(query_info, filters):
+        try:
+            return working_set.run_sheet_query(bq_client, query_info, build_sheet_where_clause(query_info, filters), filters)
+        except Exception as e:
+            print(f"Local engine failed for sheet '{sheet_name}', falling back to BigQuery: {e}")
+    sql = build_sheet_query(sheet_name, filters, sheet_analysis_queries)
+    return call_with_retry(lambda: run_query(bq_client, sql, cancel_event=cancel_event), label=sheet_name)
+
+
+def compute_dashboard_comment(bq_client, model, sheet_name, filters, sheet_analysis_queries, cancel_event=None, force_refresh=False, placeholder=None):
+    """
+    シートのデータを取得してAIコメントを生成する。
+    データの内容が同じであれば、キャッシュ済みのコメントを返す。
+    先読みスレッドからも呼ばれるため、st.* は使わずに例外をそのまま送出する（placeholder 指定時のみ逐次表示する）。
     """
     try:
-        query_info = sheet_analysis_queries.get(sheet_name, sheet_analysis_queries["default"])
-        table_id = query_info["table"]
-        base_query = query_info["query"]
-        
-        # supported_filters キーが存在しない場合、デフォルトで全て適用
-        supported_filters = query_info.get("supported_filters", ["date", "media", "campaign"])
+        df = fetch_sheet_data(bq_client, sheet_name, filters, sheet_analysis_queries, cancel_event)
+    except JobCancelled:
+        raise PrefetchCancelled()
 
-        # クエリテンプレートに既にWHERE句があるか判定
-        has_fixed_where = 'WHERE' in base_query.upper().replace('{WHERE_CLAUSE}', '')
+    if df.empty:
+        return "分析対象のデータが見つかりませんでした。フィルタ条件を変更してみてください。"
 
-        # supported_filters に基づいて build_where_clause を呼び出し
-        if has_fixed_where:
-            where_clause = build_where_clause(
-                filters,
-                apply_date="date" in supported_filters,
-                apply_media="media" in supported_filters,
-                apply_campaign="campaign" in supported_filters,
-                prefix="AND"
-            )
-        else:
-            where_clause = build_where_clause(
-                filters,
-                apply_date="date" in supported_filters,
-                apply_media="media" in supported_filters,
-                apply_campaign="campaign" in supported_filters
-            )
+    # フィルタが変更されていれば、LLMの呼び出し前に打ち切る
+    if cancel_event is not None and cancel_event.is_set():
+        raise PrefetchCancelled()
 
-        final_query = base_query.format(table=table_id, where_clause=where_clause)
+    prompt = f"""
+    あなたは優秀なデータアナリストです。
+    以下のデータは、広告レポートの「{sheet_name}」シートのサマリーです。
+    このデータから読み取れる重要な傾向や、特筆すべき点を箇条書きで3つ以内にまとめて、マーケティング担当者向けに分かりやすく解説してください。
 
-        df = _bq_client.query(final_query).to_dataframe()
+    [データサマリー]
+    {summarize_dataframe(df)}
+    """
+    cache_key = make_comment_key("dashboard", dataframe_fingerprint(df), {"sheet": sheet_name})
+    return get_comment_cache().get_or_generate(
+        cache_key, lambda: generate_comment_text(model, prompt, placeholder), force_refresh=force_refresh
+    )
 
-        if df.empty:
-            return "分析対象のデータが見つかりませんでした。フィルタ条件を変更してみてください。"
+def schedule_dashboard_prefetch(bq_client, model, filters, sheet_analysis_queries):
+    """現在のシート以外の、よく使われるシートのコメントを先読みする（現在のシートはフォアグラウンドで生成する）"""
+    if not PREFETCH_ENABLED:
+        return
+    ctx = get_script_run_ctx()
+    session_id = ctx.session_id if ctx else "default"
 
-        prompt = f"""
-        あなたは優秀なデータアナリストです。
-        以下のデータは、広告レポートの「{sheet_name}」シートのサマリーです。
-        このデータから読み取れる重要な傾向や、特筆すべき点を箇条書きで3つ以内にまとめて、マーケティング担当者向けに分かりやすく解説してください。
+    def _compute(sheet_name, prefetch_filters, cancel_event):
+        return compute_dashboard_comment(bq_client, model, sheet_name, prefetch_filters, sheet_analysis_queries, cancel_event)
 
-        [データサマリー]
-        {df.to_string()}
-        """
-        response = _model.generate_content(prompt)
-        return response.text.strip()
+    sheets = [s for s in prefetch_sheets(filters["sheet"]) if s in sheet_analysis_queries]
+    get_prefetch_scheduler().schedule(session_id, filters, sheets, _compute)
+
+def get_ai_dashboard_comment(_bq_client, _model, sheet_name, filters, sheet_analysis_queries, force_refresh=False, placeholder=None):
+    """
+    選択されたシートとフィルタに基づいてAIコメントを生成する。
+    先読み済みの結果があればそれを使い、先読み中であれば完了を待つ。
+    force_refresh=True の場合は先読み結果とコメントキャッシュを使わずに再生成する。
+    placeholder を渡すと、生成中のコメントを逐次表示する。
+    """
+    with start_span("dashboard.comment", sheet=sheet_name, force_refresh=force_refresh) as span:
+        try:
+            scheduler = get_prefetch_scheduler()
+            if PREFETCH_ENABLED and not force_refresh:
+                prefetched = scheduler.get(sheet_name, filters, wait=True)
+                if prefetched is not None:
+                    span.set_attribute("prefetched", True)
+                    return prefetched
+
+            comment = compute_dashboard_comment(
+                _bq_client, _model, sheet_name, filters, sheet_analysis_queries, force_refresh=force_refresh, placeholder=placeholder
+            )
+            scheduler.put(sheet_name, filters, comment)
+            return comment
 
-    except Exception as e:
-        print(f"Error in get_ai_dashboard_comment: {e}")
-        st.error(f"コメント生成中にエラーが発生しました: {e}")
-        return "コメントの生成中にエラーが発生しました。管理者にご確認ください。"
\ No newline at end of file
+        except Exception as e:
+            span.record_error(e)
+            st.error(f"コメント生成中にエラーが発生しました: {e}")
+            return "コメントの生成中にエラーが発生しました。管理者にご確認ください。"
@@ -0,0 +1,258 @@
+# data_summarizer.py
+"""
+AIコメント用のデータ要約
+結果のDataFrameをそのままプロンプトに埋め込む代わりに、トークン予算内に収まる要約を作る。
+- 概要（行数・列・期間）と指標の合計（比率指標は合計から再計算）
+- 行数が少なければ全行、多ければ指標ごとの上位項目
+- 直近期間と前期間の比較（日付列がある場合）と、変化の大きい項目
+- 中央値からの乖離（MADによるロバストZスコア）が大きい外れ値
+集計はすべてpandasのベクトル演算で行い、行数が多くても要約の大きさは一定に保つ。
+"""
+import os
+import re
+import json
+import datetime
+import numpy as np
+import pandas as pd
+from result_policy import RATIO_METRICS, COST_COLUMNS
+
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("SUMMARY_TOKEN_BUDGET", "1500"))
+SUMMARY_TOP_K = int(os.environ.get("SUMMARY_TOP_K", "5"))
+# この行数以下の結果は要約せずに全行を含める（予算内に収まる場合のみ）
+SUMMARY_FULL_ROWS = int(os.environ.get("SUMMARY_FULL_ROWS", "30"))
+SUMMARY_OUTLIER_Z = float(os.environ.get("SUMMARY_OUTLIER_Z", "3.5"))
+# 日本語を含むJSONの1トークンあたりの文字数の概算（少なめに見積もる）
+CHARS_PER_TOKEN = 2
+# 上位項目を出す分類列の数の上限
+MAX_DIMENSIONS = 2
+
+# 数値型でも分類として扱う列（HourOfDay, YearMonth など）
+DIMENSION_NAME_PATTERN = re.compile(r"(Hour|HourOfDay|Year|Month|YearMonth|Week|ID|Id|Code)$")
+DATE_NAME_PATTERN = re.compile(r"(date|month|day$|日付|年月)", re.IGNORECASE)
+
+def estimate_tokens(text: str) -> int:
+    """文字数からトークン数を概算する"""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def _to_json(summary) -> str:
+    return json.dumps(summary, ensure_ascii=False, separators=(",", ":"))
+
+def _number(value):
+    """JSONに載せる数値を丸める（大きい値は小数1桁、小さい値は小数4桁）"""
+    if value is None or pd.isna(value):
+        return None
+    value = float(value)
+    if value.is_integer():
+        return int(value)
+    return round(value, 1) if abs(value) >= 100 else round(value, 4)
+
+def _label(value) -> str:
+    if isinstance(value, pd.Timestamp):
+        return value.strftime("%Y-%m-%d") if value == value.normalize() else value.isoformat()
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+def _parse_dates(series: pd.Series):
+    """日付として解釈できる列なら datetime64 のSeriesを、そうでなければNoneを返す"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+            or isinstance(series.dtype, pd.CategoricalDtype)):
+        return None
+    sample = series.dropna()
+    if sample.empty:
+        return None
+    first = sample.iloc[0]
+    if not isinstance(first, (datetime.date, str)):
+        return None
+    if isinstance(first, str) and not DATE_NAME_PATTERN.search(str(series.name)):
+        return None
+    # 重複の多い列でも変換は一意な値に対してのみ行う
+    codes, uniques = pd.factorize(series)
+    parsed = pd.to_datetime(pd.Series(uniques, dtype=object), errors="coerce")
+    if parsed.isna().mean() > 0.1:
+        return None
+    values = parsed.to_numpy()[codes]
+    values[codes < 0] = np.datetime64("NaT")
+    return pd.Series(values, index=series.index, name=series.name)
+
+def _split_columns(df: pd.DataFrame):
+    """日付列・分類列・指標列に分ける"""
+    date_col, dates, dimensions, measures = None, None, [], []
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series):
+            dimensions.append(col)
+        elif pd.api.types.is_numeric_dtype(series):
+            (dimensions if DIMENSION_NAME_PATTERN.search(str(col)) else measures).append(col)
+        else:
+            parsed = _parse_dates(series) if date_col is None else None
+            if parsed is not None:
+                date_col, dates = col, parsed
+            else:
+                dimensions.append(col)
+    return date_col, dates, dimensions, measures
+
+def _ratio_parts(measure, measures: list):
+    """比率指標を合計から再計算するための（分子, 分母）。再計算できなければNone"""
+    ratio = RATIO_METRICS.get(str(measure).upper())
+    if not ratio:
+        return None
+    cost_col = next((col for col in COST_COLUMNS if col in measures), None)
+    numerator, denominator = (part.format(cost=cost_col) if cost_col else part for part in ratio)
+    if numerator in measures and denominator in measures:
+        return numerator, denominator
+    return None
+
+def _aggregate(df: pd.DataFrame, measures: list, keys) -> pd.DataFrame:
+    """keys ごとに指標を集計する。加算できる指標は合計、比率指標は合計から再計算（できなければ平均）"""
+    grouped = df.groupby(keys, observed=True, sort=False)
+    additive = [m for m in measures if str(m).upper() not in RATIO_METRICS]
+    result = grouped[additive].sum() if additive else pd.DataFrame(index=grouped.size().index)
+    ratios = [m for m in measures if m not in additive]
+    if ratios:
+        means = grouped[ratios].mean()
+        for measure in ratios:
+            parts = _ratio_parts(measure, additive)
+            if parts:
+                result[measure] = result[parts[0]] / result[parts[1]].replace(0, np.nan)
+            else:
+                result[measure] = means[measure]
+    return result[measures]
+
+def _totals(df, measures):
+    totals = _aggregate(df, measures, np.zeros(len(df), dtype=np.int8)).iloc[0]
+    return {str(m): _number(v) for m, v in totals.items()}
+
+def _records(df: pd.DataFrame) -> list:
+    return [[_label(v) if not isinstance(v, (int, float, np.number)) else _number(v) for v in row]
+            for row in df.itertuples(index=False, name=None)]
+
+def _top_items(df, dates, dimensions, measures, k):
+    """分類列ごと・指標ごとの上位k件（分類列がなければ日付ごとの上位k件）"""
+    keys = [df[dim] for dim in dimensions[:MAX_DIMENSIONS]] or ([dates] if dates is not None else [])
+    section = {}
+    for key in keys:
+        grouped = _aggregate(df, measures, key)
+        if len(grouped) <= 1:
+            continue
+        section[str(key.name)] = {
+            str(m): [(_label(idx), _number(v)) for idx, v in grouped[m].dropna().nlargest(k).items()]
+            for m in measures
+        }
+    return section or None
+
+def _period_comparison(df, dates, dimensions, measures, k):
+    """直近期間と、その直前の同じ長さの期間を比較する"""
+    periods = np.sort(dates.dropna().unique())
+    half = len(periods) // 2
+    if half == 0:
+        return None
+    current, previous = periods[-half:], periods[-2 * half:-half]
+    values = dates.to_numpy()
+    in_current = values >= current[0]
+    mask = in_current | ((values >= previous[0]) & (values <= previous[-1]))
+    # 期間の区別は真偽値でグループ化する（文字列のキーより高速）
+    period_key = in_current[mask]
+    totals = _aggregate(df[mask], measures, period_key)
+    cur, prev = totals.loc[True], totals.loc[False]
+    section = {
+        "直近期間": f"{_label(pd.Timestamp(current[0]))}〜{_label(pd.Timestamp(current[-1]))}",
+        "前期間": f"{_label(pd.Timestamp(previous[0]))}〜{_label(pd.Timestamp(previous[-1]))}",
+        "直近合計": {str(m): _number(cur[m]) for m in measures},
+        "前期間合計": {str(m): _number(prev[m]) for m in measures},
+        "変化率": {str(m): _number((cur[m] - prev[m]) / abs(prev[m])) if prev[m] else None for m in measures},
+    }
+    # 主要指標（先頭の指標）で変化の大きい項目
+    if dimensions and measures:
+        dim, measure = dimensions[0], measures[0]
+        change = _aggregate(df[mask], [measure], [df[dim][mask], period_key])[measure].unstack(fill_value=0)
+        if {True, False} <= set(change.columns):
+            delta = (change[True] - change[False]).dropna()
+            movers = delta.reindex(delta.abs().nlargest(k).index)
+            section[f"{dim}別の{measure}の変化"] = [(_label(idx), _number(v)) for idx, v in movers.items()]
+    return section
+
+def _outliers(df, dates, date_col, dimensions, measures, k):
+    """日付（なければ先頭の分類列）ごとの集計値で、ロバストZスコアが閾値を超えるものを返す"""
+    if dates is not None:
+        series_frame, axis = _aggregate(df, measures, dates.rename(date_col)), date_col
+    elif dimensions:
+        series_frame, axis = _aggregate(df, measures, df[dimensions[0]]), dimensions[0]
+    else:
+        series_frame, axis = df[measures], "行"
+    if len(series_frame) < 5:
+        return None
+    values = series_frame.astype("float64")
+    median = values.median()
+    mad = (values - median).abs().median().replace(0, np.nan)
+    scores = (0.6745 * (values - median) / mad).abs()
+    stacked = scores.stack().dropna()
+    stacked = stacked[stacked > SUMMARY_OUTLIER_Z].nlargest(k)
+    items = [
+        {axis: _label(idx), "指標": str(m), "値": _number(values.at[idx, m]), "中央値": _number(median[m])}
+        for (idx, m) in stacked.index
+    ]
+    return items or None
+
+def _truncate(section, k: int):
+    """ランキング（リスト）を先頭k件に切り詰める。(項目, 値) の組はタプルなので切り詰めない"""
+    if isinstance(section, list):
+        return [_truncate(item, k) for item in section[:k]]
+    if isinstance(section, dict):
+        return {key: _truncate(value, k) for key, value in section.items()}
+    return section
+
+def summarize_dataframe(df: pd.DataFrame, budget_tokens: int = None, top_k: int = None) -> str:
+    """
+    DataFrameをトークン予算内のJSON文字列に要約する。
+    優先度の高い項目から追加し、予算を超える項目はランキングの件数を減らすか省略する。
+    """
+    budget_tokens = budget_tokens or SUMMARY_TOKEN_BUDGET
+    top_k = top_k or SUMMARY_TOP_K
+    if df is None or df.empty:
+        return _to_json({"概要": {"行数": 0}})
+    if not isinstance(df.index, pd.RangeIndex):
+        # ピボット結果など、インデックスに分類が入っている場合は列に戻す
+        df = df.reset_index()
+    df = df.loc[:, ~df.columns.duplicated()]
+
+    date_col, dates, dimensions, measures = _split_columns(df)
+    overview = {"行数": len(df), "列": [str(c) for c in df.columns]}
+    if dates is not None and dates.notna().any():
+        overview["期間"] = [_label(dates.min()), _label(dates.max())]
+    summary = {"概要": overview}
+
+    def fits(candidate):
+        return estimate_tokens(_to_json(candidate)) <= budget_tokens
+
+    def add(name, section):
+        """ランキングの件数を半分ずつ減らしながら、予算に収まる最大の項目を追加する"""
+        k = top_k
+        while section is not None and k >= 1:
+            trimmed = _truncate(section, k)
+            if fits({**summary, name: trimmed}):
+                summary[name] = trimmed
+                return
+            k //= 2
+
+    if measures:
+        add("合計", _totals(df, measures))
+    if len(df) <= SUMMARY_FULL_ROWS and fits({**summary, "全行": _records(df)}):
+        summary["全行"] = _records(df)
+    elif measures:
+        add("上位", _top_items(df, dates, dimensions, measures, top_k))
+    if dates is not None and measures:
+        add("期間比較", _period_comparison(df, dates, dimensions, measures, top_k))
+    if measures and "全行" not in summary:
+        add("外れ値", _outliers(df, dates, date_col, dimensions, measures, top_k))
+    return _to_json(summary)
+
+def summarize_dataframes(dfs: dict, budget_tokens: int = None) -> str:
+    """複数のDataFrameを、予算を均等に割り当てて要約する"""
+    budget_tokens = budget_tokens or SUMMARY_TOKEN_BUDGET
+    per_frame = max(50, budget_tokens // max(1, len(dfs)))
+    return "{" + ",".join(
+        f"{json.dumps(str(name), ensure_ascii=False)}:{summarize_dataframe(df, per_frame)}" for name, df in dfs.items()
+    ) + "}"
@@ -0,0 +1,188 @@
+# dimension_index.py
+"""
+フィルタの選択肢（メディア → キャンペーン）の索引
+- 1回のクエリで (メディア, キャンペーン) ごとの初出日・最終日・費用を集計し、インスタンス内で共有する
+- 直近 DIMENSION_INDEX_REFRESH_DAYS 日より前は確定分として (メディア, キャンペーン) 単位に畳み、
+  直近分だけを日別に保持する。更新時は前回の境界日以降だけを再集計して差し替える（増分更新）
+- キャンペーンの選択肢は、選択中のメディアと期間（初出日〜最終日が重なるもの）で追加のクエリなしに絞り込む
+- 作成・更新はバックグラウンドで行い、画面の表示（とBigQueryクライアントの作成）を待たせない
+ロールアップテーブルが利用可能な場合は、元テーブルの代わりにそちらを集計する
+"""
+import os
+import time
+import datetime
+import threading
+import pandas as pd
+from query_cache import run_query
+from cost_guard import make_job_config
+from rollup import CAMPAIGN_TABLE, ROLLUP_CAMPAIGN_TABLE, ROLLUP_REFRESH_DAYS, is_rollup_ready
+
+DIMENSION_INDEX_REFRESH_DAYS = int(os.environ.get("DIMENSION_INDEX_REFRESH_DAYS", str(ROLLUP_REFRESH_DAYS)))
+DIMENSION_INDEX_REFRESH_INTERVAL_SECONDS = int(os.environ.get("DIMENSION_INDEX_REFRESH_INTERVAL_SECONDS", "3600"))
+# 初回の作成に失敗した場合、この秒数が経つまでは再実行しない
+DIMENSION_INDEX_RETRY_SECONDS = int(os.environ.get("DIMENSION_INDEX_RETRY_SECONDS", "60"))
+
+MEDIA_COLUMN = "ServiceNameJA_Media"
+CAMPAIGN_COLUMN = "CampaignName"
+SPEND_COLUMN = "CostIncludingFees"
+_KEYS = ["media", "campaign"]
+_AGGREGATIONS = {"first_seen": "min", "last_seen": "max", "spend": "sum"}
+
+def build_index_query(table: str, boundary: str, since_date: str = None) -> str:
+    """
+    (メディア, キャンペーン) ごとの初出日・最終日・費用を返すSELECT文を返す。
+    boundary 以降の行は日別（day 列）に、それより前の行は day を NULL として1行に集計する。
+    """
+    where_clause = f"WHERE Date >= '{since_date}'" if since_date else ""
+    return f"""
+SELECT
+    {MEDIA_COLUMN} AS media,
+    {CAMPAIGN_COLUMN} AS campaign,
+    CASE WHEN Date >= '{boundary}' THEN Date END AS day,
+    MIN(Date) AS first_seen,
+    MAX(Date) AS last_seen,
+    SUM({SPEND_COLUMN}) AS spend
+FROM `{table}`
+{where_clause}
+GROUP BY 1, 2, 3
+"""
+
+def _normalize(rows: pd.DataFrame) -> pd.DataFrame:
+    rows = rows.copy()
+    # 読み込み時にカテゴリ型へ変換された列は、更新のたびにカテゴリが変わるため元の型に戻して集計する
+    for col in _KEYS:
+        rows[col] = rows[col].astype(object)
+    for col in ["day", "first_seen", "last_seen"]:
+        rows[col] = pd.to_datetime(rows[col])
+    rows["spend"] = pd.to_numeric(rows["spend"]).fillna(0.0).astype("float64")
+    return rows
+
+def _collapse(frames: list) -> pd.DataFrame:
+    """(メディア, キャンペーン) ごとに初出日・最終日・費用をまとめる"""
+    frames = [frame[_KEYS + list(_AGGREGATIONS)] for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=_KEYS + list(_AGGREGATIONS))
+    return pd.concat(frames, ignore_index=True).groupby(_KEYS, dropna=False, sort=False).agg(_AGGREGATIONS).reset_index()
+
+class DimensionIndex:
+    """メディア → キャンペーンの階層と、初出日・最終日・費用を保持するスレッドセーフな索引"""
+
+    def __init__(self, source_table: str = CAMPAIGN_TABLE, refresh_days: int = DIMENSION_INDEX_REFRESH_DAYS,
+                 refresh_interval: int = DIMENSION_INDEX_REFRESH_INTERVAL_SECONDS):
+        self.source_table = source_table
+        self.refresh_days = refresh_days
+        self.refresh_interval = refresh_interval
+        self.last_refreshed = 0.0
+        self._settled = None   # 境界日より前の集計（(メディア, キャンペーン) ごとに1行）
+        self._tail = None      # 境界日以降の日別の集計
+        self._pairs = None     # 確定分と直近分を合わせた、選択肢の絞り込みに使う表
+        self._boundary = None
+        self._refreshing = False
+        self._last_error = None  # (時刻, 例外)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stats = {"full_refreshes": 0, "incremental_refreshes": 0, "rows_scanned": 0}
+
+    @property
+    def ready(self) -> bool:
+        return self._pairs is not None
+
+    def refresh(self, bq_client, full: bool = False) -> str:
+        """索引を更新する。未作成の場合や full=True の場合は全期間を集計する"""
+        with self._refresh_lock:
+            boundary = (datetime.date.today() - datetime.timedelta(days=self.refresh_days)).strftime("%Y-%m-%d")
+            since_date = None if full or self._boundary is None else self._boundary
+            table = ROLLUP_CAMPAIGN_TABLE if is_rollup_ready() else self.source_table
+            # 索引自体がキャッシュなので、共有クエリキャッシュは経由しない
+            sql = build_index_query(table, boundary, since_date)
+            rows = _normalize(run_query(bq_client, sql, use_cache=False, job_config=make_job_config()))
+
+            settled_rows = rows[rows["day"].isna()]
+            tail = rows[rows["day"].notna()].reset_index(drop=True)
+            # 前回の境界日より前は確定済みのため、今回の集計に含まれていない分を引き継ぐ
+            settled = _collapse([settled_rows] if since_date is None else [self._settled, settled_rows])
+            pairs = _collapse([settled, tail])
+            for col in _KEYS:
+                pairs[col] = pairs[col].astype("category")
+
+            with self._lock:
+                self._settled, self._tail, self._pairs, self._boundary = settled, tail, pairs, boundary
+                self.last_refreshed = time.time()
+                self._stats["incremental_refreshes" if since_date else "full_refreshes"] += 1
+                self._stats["rows_scanned"] += len(rows)
+            return f"incremental since {since_date}" if since_date else "full"
+
+    @property
+    def last_error(self):
+        """初回の作成に失敗した場合の例外。作成済み、または未失敗ならNone"""
+        last_error = self._last_error
+        return None if self.ready or last_error is None else last_error[1]
+
+    def ensure_fresh(self, bq_client):
+        """
+        未作成なら作成を、更新間隔を過ぎていれば増分更新を、バックグラウンドで開始する（完了は待たない）。
+        初回の作成に失敗した場合は、DIMENSION_INDEX_RETRY_SECONDS が経つまで再実行しない。
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            if self.ready:
+                if time.time() - self.last_refreshed < self.refresh_interval:
+                    return
+            elif self._last_error and time.time() - self._last_error[0] < DIMENSION_INDEX_RETRY_SECONDS:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                mode = self.refresh(bq_client)
+                self._last_error = None
+                print(f"Dimension index refreshed ({mode}).")
+            except Exception as e:
+                print(f"Failed to refresh dimension index: {e}")
+                if self.ready:
+                    # 更新に失敗しても、前回の索引をそのまま使う
+                    self.last_refreshed = time.time()
+                else:
+                    self._last_error = (time.time(), e)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, name="dimension-index-refresh", daemon=True).start()
+
+    def media_options(self) -> list:
+        """メディアの選択肢（名前順）"""
+        pairs = self._pairs
+        if pairs is None:
+            return []
+        return sorted(pairs["media"].dropna().unique().tolist())
+
+    def campaign_options(self, media: list = None, start_date=None, end_date=None) -> list:
+        """選択中のメディアに属し、期間内に配信実績のあるキャンペーンの選択肢（名前順）"""
+        pairs = self._pairs
+        if pairs is None:
+            return []
+        mask = pairs["campaign"].notna()
+        if media:
+            mask &= pairs["media"].isin(media)
+        if start_date:
+            mask &= pairs["last_seen"] >= pd.Timestamp(start_date)
+        if end_date:
+            mask &= pairs["first_seen"] <= pd.Timestamp(end_date)
+        return sorted(pairs.loc[mask, "campaign"].unique().tolist())
+
+    def stats(self) -> dict:
+        with self._lock:
+            pairs = self._pairs
+            return {
+                **self._stats,
+                "pairs": 0 if pairs is None else len(pairs),
+                "bytes": 0 if pairs is None else int(pairs.memory_usage(deep=True).sum()),
+                "boundary": self._boundary,
+            }
+
+_dimension_index = DimensionIndex()
+
+def get_dimension_index() -> DimensionIndex:
+    """インスタンス全体で共有するフィルタの選択肢の索引を返す"""
+    return _dimension_index
@@ -0,0 +1,146 @@
+# exporter.py
+"""
+分析結果のファイル出力（CSV・Excel・Parquet・gzip圧縮CSV）
+- ファイルはダウンロードが要求されたときにだけ作成し、結果の内容ハッシュ + 形式をキーにインスタンス内で共有する
+- 行数の多い結果は、CSVはチャンク単位で、Excelは xlsxwriter の constant_memory モードで1行ずつ書き出し、
+  DataFrame全体の文字列化によるメモリの急増を避ける
+"""
+import io
+import os
+import gzip
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get("EXPORT_CACHE_MAX_MB", "128")) * 1024 * 1024
+# この行数を超える結果は逐次書き出しで作成する
+EXPORT_STREAMING_ROWS = int(os.environ.get("EXPORT_STREAMING_ROWS", "100000"))
+CSV_CHUNK_ROWS = int(os.environ.get("CSV_CHUNK_ROWS", "50000"))
+# 逐次書き出しのExcelで、一度にPythonの値に変換する行数
+EXCEL_CHUNK_ROWS = int(os.environ.get("EXCEL_CHUNK_ROWS", "10000"))
+EXCEL_MAX_ROWS = 1048576 - 1  # 見出し行を除くExcelの行数上限
+
+# 形式 -> (表示名, 拡張子, MIMEタイプ)
+EXPORT_FORMATS = {
+    "csv": ("CSV", "csv", "text/csv"),
+    "xlsx": ("Excel", "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "parquet": ("Parquet", "parquet", "application/octet-stream"),
+    "csv.gz": ("CSV（gzip圧縮）", "csv.gz", "application/gzip"),
+}
+
+class ExportTooLarge(Exception):
+    """選択した形式では出力できない大きさの結果"""
+
+def _write_csv(df: pd.DataFrame, stream):
+    """Excelで文字化けしないようBOM付きUTF-8で、CSV_CHUNK_ROWS 行ずつ書き出す"""
+    stream.write("\ufeff".encode("utf-8"))
+    stream.write(df.head(0).to_csv(index=False).encode("utf-8"))
+    for start in range(0, len(df), CSV_CHUNK_ROWS):
+        stream.write(df.iloc[start:start + CSV_CHUNK_ROWS].to_csv(index=False, header=False).encode("utf-8"))
+
+def _excel_column(series: pd.Series, worksheet, date_format):
+    """列を (Pythonの値のリスト, 書き込み関数) に変換する。欠損値はNoneにして書き込まない"""
+    missing = series.isna().to_numpy()
+    if pd.api.types.is_bool_dtype(series):
+        values, writer = series.astype(object).tolist(), worksheet.write_boolean
+    elif pd.api.types.is_numeric_dtype(series):
+        values, writer = series.astype("float64").tolist(), worksheet.write_number
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        if getattr(series.dt, "tz", None) is not None:
+            series = series.dt.tz_localize(None)
+        values = series.dt.to_pydatetime().tolist()
+        writer = lambda row, col, value: worksheet.write_datetime(row, col, value, date_format)
+    else:
+        values, writer = series.tolist(), worksheet.write
+    if missing.any():
+        values = [None if is_missing else value for value, is_missing in zip(values, missing)]
+    return values, writer
+
+def _write_excel_streaming(df: pd.DataFrame, stream):
+    """
+    constant_memory モードで、見出し行から順に1行ずつ書き出す（列ごとに型に合った書き込み関数を使う）。
+    Pythonの値への変換は EXCEL_CHUNK_ROWS 行ずつ行い、全行分のリストを同時に持たない。
+    """
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(stream, {
+        "constant_memory": True, "default_date_format": "yyyy-mm-dd", "strings_to_urls": False,
+    })
+    worksheet = workbook.add_worksheet("Result")
+    date_format = workbook.add_format({"num_format": "yyyy-mm-dd hh:mm:ss"})
+    worksheet.write_row(0, 0, [str(col) for col in df.columns])
+    for start in range(0, len(df), EXCEL_CHUNK_ROWS):
+        chunk = df.iloc[start:start + EXCEL_CHUNK_ROWS]
+        columns = [_excel_column(chunk.iloc[:, i], worksheet, date_format) for i in range(chunk.shape[1])]
+        for offset in range(len(chunk)):
+            for col_index, (values, writer) in enumerate(columns):
+                value = values[offset]
+                if value is not None:
+                    writer(start + offset + 1, col_index, value)
+    workbook.close()
+
+def build_export(df: pd.DataFrame, fmt: str) -> bytes:
+    """結果を指定した形式のファイルに変換する"""
+    buf = io.BytesIO()
+    if fmt == "csv":
+        _write_csv(df, buf)
+    elif fmt == "csv.gz":
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6) as gz:
+            _write_csv(df, gz)
+    elif fmt == "parquet":
+        df.to_parquet(buf, index=False)
+    elif fmt == "xlsx":
+        if len(df) > EXCEL_MAX_ROWS:
+            raise ExportTooLarge(f"Excelの行数上限（{EXCEL_MAX_ROWS:,}行）を超えています。CSVまたはParquet形式を選択してください。")
+        if len(df) > EXPORT_STREAMING_ROWS:
+            _write_excel_streaming(df, buf)
+        else:
+            df.to_excel(buf, index=False, sheet_name="Result", engine="xlsxwriter")
+    else:
+        raise ValueError(f"未対応の出力形式です: {fmt}")
+    return buf.getvalue()
+
+class ExportCache:
+    """結果の内容ハッシュ + 形式をキーに、作成済みのファイルを保持するLRUキャッシュ"""
+
+    def __init__(self, max_bytes: int = EXPORT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (指紋, 形式) -> bytes
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "builds": 0}
+
+    def peek(self, fingerprint: str, fmt: str):
+        """作成済みのファイルがあれば返す。なければNone"""
+        with self._lock:
+            data = self._entries.get((fingerprint, fmt))
+            if data is not None:
+                self._entries.move_to_end((fingerprint, fmt))
+            return data
+
+    def get_or_build(self, df: pd.DataFrame, fingerprint: str, fmt: str) -> bytes:
+        data = self.peek(fingerprint, fmt)
+        if data is not None:
+            with self._lock:
+                self._stats["hits"] += 1
+            return data
+        data = build_export(df, fmt)
+        with self._lock:
+            self._stats["builds"] += 1
+            key = (fingerprint, fmt)
+            if key not in self._entries and len(data) <= self.max_bytes:
+                self._entries[key] = data
+                self._total_bytes += len(data)
+                while self._total_bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._total_bytes -= len(evicted)
+        return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "bytes": self._total_bytes}
+
+_export_cache = ExportCache()
+
+def get_export_cache() -> ExportCache:
+    """インスタンス全体で共有する出力ファイルのキャッシュを返す"""
+    return _export_cache
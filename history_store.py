@@ -0,0 +1,169 @@
+# history_store.py
+"""
+分析履歴の保存先
+- セッションには指示・SQL・グラフ設定・コメント・行数・結果の指紋などの軽量なメタデータだけを保持する
+- 結果のDataFrameはインスタンス内で共有するストアに指紋をキーとして保存する
+  - メモリ上の保持量は HISTORY_MEMORY_BUDGET_MB までとし、超えた分は古いものから手放す
+  - 保存時に HISTORY_SPILL_DIR へ zstd 圧縮の Parquet として書き出し、メモリから外れた結果はそこから読み戻す
+- 「この分析を再現する」を押したときに初めて結果を読み込む（読み込めなければ呼び出し側でSQLを再実行する）
+Cloud Run の /tmp はメモリ上のファイルシステムのため、可能であれば永続ボリュームを HISTORY_SPILL_DIR に指定する
+"""
+import os
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+import pandas as pd
+from query_cache import dataframe_fingerprint
+
+HISTORY_MAX_ENTRIES = int(os.environ.get("HISTORY_MAX_ENTRIES", "10"))
+HISTORY_MEMORY_BUDGET_BYTES = int(os.environ.get("HISTORY_MEMORY_BUDGET_MB", "128")) * 1024 * 1024
+HISTORY_SPILL_DIR = os.environ.get("HISTORY_SPILL_DIR", os.path.join(tempfile.gettempdir(), "analysis_history"))
+# 書き出したファイルを残す期間（セッションより十分長くする）
+HISTORY_SPILL_TTL_SECONDS = int(os.environ.get("HISTORY_SPILL_TTL_SECONDS", str(24 * 3600)))
+HISTORY_SPILL_COMPRESSION = "zstd"
+
+class HistoryStore:
+    """指紋をキーに履歴の結果を保持する、メモリ上限付き・ディスク退避ありのスレッドセーフなストア"""
+
+    def __init__(self, memory_budget=HISTORY_MEMORY_BUDGET_BYTES, spill_dir=HISTORY_SPILL_DIR, spill_ttl=HISTORY_SPILL_TTL_SECONDS):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.spill_ttl = spill_ttl
+        self._frames = OrderedDict()  # 指紋 -> (DataFrame, バイト数)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"saved": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "spilled": 0}
+        self._last_sweep = 0.0
+        if self.spill_dir:
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            except OSError as e:
+                print(f"History spill directory is unavailable, keeping results in memory only: {e}")
+                self.spill_dir = ""
+
+    def put(self, df: pd.DataFrame, fingerprint: str = None, keep_in_memory: bool = True) -> str:
+        """
+        結果を保存し、指紋を返す。同じ内容の結果は1つだけ保持する。
+        keep_in_memory=False の場合はディスクにのみ書き出す（メモリを空けるための退避用）。
+        """
+        fingerprint = fingerprint or dataframe_fingerprint(df)
+        with self._lock:
+            self._stats["saved"] += 1
+            known = fingerprint in self._frames
+            if known:
+                self._frames.move_to_end(fingerprint)
+            elif keep_in_memory:
+                self._store(fingerprint, df)
+        if not known and not os.path.exists(self._spill_path(fingerprint)):
+            self._write_spill(fingerprint, df)
+        self._sweep()
+        return fingerprint
+
+    def get(self, fingerprint: str):
+        """保存済みの結果を返す。メモリになければディスクから読み戻し、どちらにもなければNone"""
+        with self._lock:
+            entry = self._frames.get(fingerprint)
+            if entry is not None:
+                self._frames.move_to_end(fingerprint)
+                self._stats["memory_hits"] += 1
+                return entry[0]
+
+        df = self._read_spill(fingerprint)
+        with self._lock:
+            if df is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._store(fingerprint, df)
+        return df
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._frames), "bytes": self._memory_bytes}
+
+    # --- 内部処理（呼び出し側でロックを保持すること） ---
+    def _store(self, fingerprint, df):
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.memory_budget:
+            # 予算を超える結果はメモリに置かず、ディスクからのみ読み戻す
+            self._stats["spilled"] += 1
+            return
+        self._frames[fingerprint] = (df, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_budget and self._frames:
+            _, (_, evicted_size) = self._frames.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self._stats["spilled"] += 1
+
+    # --- ディスク層 ---
+    def _spill_path(self, fingerprint):
+        return os.path.join(self.spill_dir, f"{fingerprint}.parquet") if self.spill_dir else ""
+
+    def _write_spill(self, fingerprint, df):
+        if not self.spill_dir:
+            return
+        path = self._spill_path(fingerprint)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            df.to_parquet(tmp_path, compression=HISTORY_SPILL_COMPRESSION)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Failed to spill history result to disk: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _read_spill(self, fingerprint):
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(fingerprint)
+        try:
+            df = pd.read_parquet(path)
+            os.utime(path)  # 読み戻した結果は期限を延ばす
+            return df
+        except Exception:
+            return None
+
+    def _sweep(self):
+        """期限切れの退避ファイルを削除する（1時間に1回まで）"""
+        now = time.time()
+        if not self.spill_dir or now - self._last_sweep < 3600:
+            return
+        self._last_sweep = now
+        try:
+            for name in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, name)
+                if now - os.path.getmtime(path) > self.spill_ttl:
+                    os.remove(path)
+        except OSError as e:
+            print(f"Failed to sweep history spill directory: {e}")
+
+_history_store = HistoryStore()
+
+def get_history_store() -> HistoryStore:
+    """インスタンス全体で共有する履歴ストアを返す"""
+    return _history_store
+
+def add_history_entry(history: list, user_input: str, sql: str, df: pd.DataFrame, graph_cfg: dict, comment: str,
+                      result_meta: dict = None, fingerprint: str = None) -> dict:
+    """結果をストアに保存し、メタデータだけの履歴を history に追加する（HISTORY_MAX_ENTRIES 件まで）"""
+    entry = {
+        "user_input": user_input,
+        "sql": sql,
+        "graph_cfg": dict(graph_cfg or {}),
+        "comment": comment,
+        "result_meta": result_meta,
+        "rows": len(df),
+        "columns": len(df.columns),
+        "fingerprint": get_history_store().put(df, fingerprint),
+        "saved_at": time.time(),
+    }
+    history.append(entry)
+    del history[:-HISTORY_MAX_ENTRIES]
+    return entry
+
+def load_history_frame(entry: dict):
+    """履歴の結果を読み込む。保存済みの結果が見つからなければNone"""
+    return get_history_store().get(entry["fingerprint"])
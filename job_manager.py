@@ -0,0 +1,163 @@
+# job_manager.py
+"""
+BigQueryジョブの非同期投入と取り消しを管理する
+- ジョブは投入後にポーリングで完了を待ち、その間は経過時間を画面に表示する
+- セッションごとに実行中のジョブIDを記録し、次のスクリプト実行が始まったら前回の実行のジョブを取り消す
+- 待機中にStreamlitの再実行・停止（RerunException等）が起きた場合も、そのジョブを取り消す
+- インスタンス全体の同時実行ジョブ数を MAX_CONCURRENT_BQ_JOBS に制限する
+ジョブの投入・完了確認・取り消しは backend に委ねるため、インメモリの偽バックエンドに差し替えて検証できる
+"""
+import os
+import time
+import threading
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+JOB_MANAGER_ENABLED = os.environ.get("JOB_MANAGER_ENABLED", "true").lower() == "true"
+MAX_CONCURRENT_BQ_JOBS = int(os.environ.get("MAX_CONCURRENT_BQ_JOBS", "8"))
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get("JOB_POLL_INTERVAL_SECONDS", "0.5"))
+# この秒数を超えて待つジョブだけ進捗を表示する（短いクエリで表示がちらつかないように）
+JOB_PROGRESS_DELAY_SECONDS = float(os.environ.get("JOB_PROGRESS_DELAY_SECONDS", "1.0"))
+
+
+class JobCancelled(Exception):
+    """ジョブが取り消されたことを表す"""
+
+
+class BigQueryJobBackend:
+    """google-cloud-bigquery のクライアントでジョブを投入・確認・取り消しする"""
+
+    def submit(self, bq_client, sql: str, job_config=None):
+        if job_config is not None:
+            return bq_client.query(sql, job_config=job_config)
+        return bq_client.query(sql)
+
+    def is_done(self, job) -> bool:
+        done = getattr(job, "done", None)
+        # 完了確認のできないジョブ（REST取得のみの実装など）は投入時点で完了したものとみなす
+        return done() if callable(done) else True
+
+    def cancel(self, job):
+        cancel = getattr(job, "cancel", None)
+        if callable(cancel):
+            cancel()
+
+    def job_id(self, job) -> str:
+        return getattr(job, "job_id", None) or str(id(job))
+
+
+def current_session_id():
+    """スクリプト実行中のセッションIDを返す。ワーカースレッド等、コンテキストがなければNone"""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else None
+
+
+class JobManager:
+    """セッション単位でジョブを追跡し、同時実行数を制限して実行する"""
+
+    def __init__(self, backend=None, max_concurrent: int = MAX_CONCURRENT_BQ_JOBS,
+                 poll_interval: float = JOB_POLL_INTERVAL_SECONDS):
+        self.backend = backend or BigQueryJobBackend()
+        self.poll_interval = poll_interval
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._jobs = {}  # セッションID -> {ジョブID: ジョブ}
+        self._stats = {"submitted": 0, "cancelled": 0, "running": 0}
+
+    def begin_run(self, session_id):
+        """
+        セッションの新しいスクリプト実行の開始を記録し、前回までの実行で投入されたジョブを取り消す。
+        スクリプトの先頭で毎回呼ぶ。
+        """
+        if session_id is not None:
+            self.cancel_session(session_id)
+
+    def run(self, bq_client, sql: str, job_config=None, session_id=None, cancel_event=None, show_progress: bool = True):
+        """
+        ジョブを投入して完了まで待ち、完了したジョブを返す。
+        session_id を指定するとセッションのジョブとして記録し、同セッションの次の実行開始時に取り消し対象にする。
+        cancel_event がセットされた場合や、待機中にスクリプトが中断された場合はジョブを取り消す。
+        """
+        self._slots.acquire()
+        try:
+            job = self.backend.submit(bq_client, sql, job_config)
+            job_id = self.backend.job_id(job)
+            with self._lock:
+                self._stats["submitted"] += 1
+                self._stats["running"] += 1
+                if session_id is not None:
+                    self._jobs.setdefault(session_id, {})[job_id] = job
+            try:
+                self._wait(job, session_id, job_id, cancel_event, show_progress)
+            except BaseException:
+                # 再実行・停止の例外も含め、完了していないジョブは課金が続かないよう取り消す
+                # （begin_run / cancel_session で登録が外れたジョブは取り消し済み）
+                with self._lock:
+                    registered = session_id is None or self._jobs.get(session_id, {}).pop(job_id, None) is not None
+                if registered and not self.backend.is_done(job):
+                    self._cancel(job)
+                raise
+            finally:
+                with self._lock:
+                    self._stats["running"] -= 1
+                    self._jobs.get(session_id, {}).pop(job_id, None)
+            return job
+        finally:
+            self._slots.release()
+
+    def cancel_session(self, session_id):
+        """セッションの実行中ジョブをすべて取り消す"""
+        with self._lock:
+            jobs = list(self._jobs.pop(session_id, {}).values())
+        for job in jobs:
+            self._cancel(job)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    # --- 内部処理 ---
+    def _wait(self, job, session_id, job_id, cancel_event, show_progress):
+        started = time.time()
+        placeholder = None
+        try:
+            while True:
+                # 取り消されたジョブも完了扱いになるため、完了確認より先に取り消しの有無を確認する
+                if cancel_event is not None and cancel_event.is_set():
+                    raise JobCancelled(f"Job {job_id} was cancelled.")
+                with self._lock:
+                    superseded = session_id is not None and job_id not in self._jobs.get(session_id, {})
+                if superseded:
+                    raise JobCancelled(f"Job {job_id} was superseded by a newer run.")
+                if self.backend.is_done(job):
+                    return
+                elapsed = time.time() - started
+                if show_progress and elapsed >= JOB_PROGRESS_DELAY_SECONDS and current_session_id() is not None:
+                    # 表示の更新時に、Streamlitは再実行・停止の要求があれば例外を送出する
+                    if placeholder is None:
+                        placeholder = st.empty()
+                    placeholder.caption(f"⏳ BigQueryでクエリを実行中です...（{elapsed:.0f}秒経過・ジョブID: {job_id}）")
+                time.sleep(self.poll_interval)
+        finally:
+            if placeholder is not None:
+                placeholder.empty()
+
+    def _cancel(self, job):
+        try:
+            self.backend.cancel(job)
+            with self._lock:
+                self._stats["cancelled"] += 1
+        except Exception as e:
+            print(f"Failed to cancel BigQuery job: {e}")
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager() -> JobManager:
+    """インスタンス全体で共有するジョブマネージャを返す"""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager()
+        return _job_manager
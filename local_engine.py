@@ -0,0 +1,140 @@
+# local_engine.py
+"""
+ダッシュボード用のローカル分析エンジン（DuckDB）
+- 現在の期間のキャンペーン単位データ（Date × メディア × キャンペーン）を一度だけBigQueryから読み込み、
+  インスタンス内のDuckDBに保持する
+- メディア・キャンペーンの絞り込みや再集計、シートサマリーはローカルで実行する
+- 要求された期間が保持中の期間を超えた場合、または LOCAL_ENGINE_TTL_SECONDS を過ぎた場合のみ再読み込みする
+duckdb がインストールされていない場合や USE_LOCAL_ENGINE が false の場合は何もしない
+"""
+import os
+import re
+import time
+import threading
+from query_cache import run_query
+from rollup import (
+    ROLLUP_CAMPAIGN_TABLE, build_rollup_select, is_covered_by_rollup, is_rollup_ready,
+)
+
+USE_LOCAL_ENGINE = os.environ.get("USE_LOCAL_ENGINE", "false").lower() == "true"
+LOCAL_ENGINE_TTL_SECONDS = int(os.environ.get("LOCAL_ENGINE_TTL_SECONDS", "3600"))
+# 期間を広げ続けてメモリを使い過ぎないよう、保持する日数に上限を設ける
+LOCAL_ENGINE_MAX_DAYS = int(os.environ.get("LOCAL_ENGINE_MAX_DAYS", "800"))
+LOCAL_TABLE = "local_campaign"
+
+# BigQuery 固有の関数を DuckDB のマクロで置き換える
+_BIGQUERY_MACROS = [
+    "CREATE OR REPLACE MACRO SAFE_DIVIDE(a, b) AS CASE WHEN b = 0 THEN NULL ELSE a / b END",
+    "CREATE OR REPLACE MACRO FORMAT_DATE(fmt, d) AS strftime(d, fmt)",
+]
+# DuckDB と BigQuery で結果が異なる構文（DAYOFWEEK の起点が異なる等）を含むクエリはローカルで実行しない
+_UNSUPPORTED_PATTERN = re.compile(r"\bEXTRACT\s*\(|\bDATE_TRUNC\s*\(|\bPARSE_\w+\s*\(", re.IGNORECASE)
+
+
+class LocalWindowUnavailable(Exception):
+    """要求された期間がローカルの作業セットに含まれていない"""
+
+
+class LocalWorkingSet:
+    """期間単位でキャンペーンデータを保持し、シートクエリをローカル実行する"""
+
+    def __init__(self):
+        import duckdb
+        self._con = duckdb.connect(database=":memory:")
+        for statement in _BIGQUERY_MACROS:
+            self._con.execute(statement)
+        self._lock = threading.Lock()
+        self.window = None  # (開始日, 終了日)
+        self.loaded_at = 0.0
+        self.row_count = 0
+
+    def covers(self, start_date, end_date) -> bool:
+        """指定期間が保持中のデータに含まれ、かつ期限内かを返す"""
+        if self.window is None or time.time() - self.loaded_at > LOCAL_ENGINE_TTL_SECONDS:
+            return False
+        return self.window[0] <= start_date and end_date <= self.window[1]
+
+    def ensure_window(self, bq_client, start_date, end_date):
+        """指定期間のデータがなければ、保持中の期間と合わせた範囲をBigQueryから読み込む"""
+        with self._lock:
+            self._ensure_window_locked(bq_client, start_date, end_date)
+
+    def _ensure_window_locked(self, bq_client, start_date, end_date):
+        if self.covers(start_date, end_date):
+            return
+        if self.window is not None and time.time() - self.loaded_at <= LOCAL_ENGINE_TTL_SECONDS:
+            merged_start, merged_end = min(start_date, self.window[0]), max(end_date, self.window[1])
+            # 合わせた範囲が上限を超える場合は、要求された期間だけを読み込み直す（要求期間を削らない）
+            if (merged_end - merged_start).days <= LOCAL_ENGINE_MAX_DAYS:
+                start_date, end_date = merged_start, merged_end
+        since, until = start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+
+        if is_rollup_ready():
+            sql = f"SELECT * FROM `{ROLLUP_CAMPAIGN_TABLE}` WHERE Date BETWEEN '{since}' AND '{until}'"
+        else:
+            sql = build_rollup_select(since_date=since, until_date=until)
+        # 作業セット自体がキャッシュなので、共有クエリキャッシュは経由しない
+        df = run_query(bq_client, sql, use_cache=False)
+
+        self._con.register("incoming_campaign", df)
+        self._con.execute(f"CREATE OR REPLACE TABLE {LOCAL_TABLE} AS SELECT * FROM incoming_campaign")
+        self._con.unregister("incoming_campaign")
+        self.window = (start_date, end_date)
+        self.loaded_at = time.time()
+        self.row_count = len(df)
+
+    def invalidate(self):
+        """保持中のデータを期限切れにし、次回のアクセスで再読み込みさせる"""
+        with self._lock:
+            self.loaded_at = 0.0
+
+    def query(self, sql: str):
+        """ローカルのDuckDBでSQLを実行し、DataFrameを返す"""
+        cursor = self._con.cursor()
+        try:
+            return cursor.execute(sql).df()
+        finally:
+            cursor.close()
+
+    def run_sheet_query(self, bq_client, query_info: dict, where_clause: str, filters: dict):
+        """
+        シートクエリをローカルのテーブルに対して実行する。
+        読み込み後も要求期間を保持できていなければ LocalWindowUnavailable を送出する（呼び出し側はBigQueryで実行する）。
+        実行中に他のセッションが期間を読み替えないよう、読み込みから実行までロックを保持する。
+        """
+        start_date, end_date = filters["start_date"], filters["end_date"]
+        sql = query_info["query"].format(table=LOCAL_TABLE, where_clause=where_clause).replace("`", "")
+        with self._lock:
+            self._ensure_window_locked(bq_client, start_date, end_date)
+            if not self.covers(start_date, end_date):
+                raise LocalWindowUnavailable(f"local window {self.window} does not cover {start_date}..{end_date}")
+            return self.query(sql)
+
+
+_working_set = None
+_working_set_lock = threading.Lock()
+
+def get_local_working_set():
+    """共有のローカル作業セットを返す。利用できない場合はNone"""
+    global _working_set
+    if not USE_LOCAL_ENGINE:
+        return None
+    with _working_set_lock:
+        if _working_set is None:
+            try:
+                _working_set = LocalWorkingSet()
+            except ImportError:
+                print("duckdb is not installed; local engine is disabled.")
+                _working_set = False
+        return _working_set or None
+
+def can_run_locally(query_info: dict, filters: dict) -> bool:
+    """シートクエリをローカルエンジンで正しく計算できるかを判定する"""
+    if not (filters.get("start_date") and filters.get("end_date")):
+        return False
+    if "date" not in query_info.get("supported_filters", ["date", "media", "campaign"]):
+        return False
+    # 保持できる日数を超える期間は、ローカルに読み込まずBigQueryで実行する
+    if (filters["end_date"] - filters["start_date"]).days > LOCAL_ENGINE_MAX_DAYS:
+        return False
+    return is_covered_by_rollup(query_info) and not _UNSUPPORTED_PATTERN.search(query_info["query"])
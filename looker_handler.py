@@ -5,15 +5,19 @@ import json
 from urllib.parse import quote
 import datetime
 import pandas as pd
-from dashboard_analyzer import get_ai_dashboard_comment
+from dashboard_analyzer import get_ai_dashboard_comment, build_sheet_query, schedule_dashboard_prefetch
+from prefetch import get_prefetch_scheduler
+from query_cache import get_query_cache
+from local_engine import get_local_working_set
+from dimension_index import get_dimension_index
 import os
 
 # --- レポート基本情報 ---
+# 未設定の場合はレポートの埋め込みだけを省略する（読み込み時に止めるとアプリ全体が表示されなくなる）
 REPORT_ID = os.environ.get("LOOKER_REPORT_ID")
-if not REPORT_ID:
-    st.error("環境変数LOOKER_REPORT_IDが設定されていません。")
-    st.stop()
-    
+# フィルタの索引の作成完了を確認する間隔（秒）
+DIMENSION_INDEX_POLL_SECONDS = float(os.environ.get("DIMENSION_INDEX_POLL_SECONDS", "2"))
+
 REPORT_SHEETS = {
     "予算管理": "Gcf9",
     "サマリー01": "6HI9",
@@ -130,16 +134,6 @@ SHEET_PARAM_SETS = {
     },
 }
 
-@st.cache_data(ttl=43200)
-def get_filter_options(_bq_client, table_id, column_name):
-    """BigQueryからフィルタの選択肢を取得する"""
-    try:
-        query = f"SELECT DISTINCT {column_name} FROM `{table_id}` WHERE {column_name} IS NOT NULL ORDER BY {column_name}"
-        return _bq_client.query(query).to_dataframe()[column_name].tolist()
-    except Exception as e:
-        st.error(f"フィルタオプションの取得中にエラーが発生しました ({column_name}): {e}")
-        return []
-
 def init_filters():
     """filtersセッションの初期化"""
     if "filters" not in st.session_state:
@@ -157,6 +151,14 @@ def init_filters():
         if key not in st.session_state.filters:
             st.session_state.filters[key] = value
 
+@st.fragment(run_every=DIMENSION_INDEX_POLL_SECONDS)
+def _rerun_when_dimension_index_ready():
+    """フィルタの索引の作成中に表示し、作成が終わった（または失敗した）ら画面全体を再実行する"""
+    dimension_index = get_dimension_index()
+    if dimension_index.ready or dimension_index.last_error is not None:
+        st.rerun(scope="app")
+    st.caption("⏳ フィルタの選択肢を読み込み中です...")
+
 def show_filter_ui(bq_client):
     """サイドバーに表示するフィルタUIを構築し、結果をsession_stateに保存する"""
     init_filters()
@@ -179,19 +181,31 @@ def show_filter_ui(bq_client):
     start_date = st.date_input("開始日", value=st.session_state.filters["start_date"])
     end_date = st.date_input("終了日", value=st.session_state.filters["end_date"])
 
-    table_id_for_filters = "vorn-digi-mktg-poc-635a.toki_air.LookerStudio_report_campaign"
-    media_options = get_filter_options(bq_client, table_id_for_filters, "ServiceNameJA_Media")
-    campaign_options = get_filter_options(bq_client, table_id_for_filters, "CampaignName")
+    # メディア → キャンペーンの索引から選択肢を作り、キャンペーンは選択中のメディアと期間で絞り込む
+    dimension_index = get_dimension_index()
+    dimension_index.ensure_fresh(bq_client)
+    if not dimension_index.ready:
+        # 索引の作成中は、選択中の値だけを選択肢として残す（作成が終わると画面を再実行して反映する）
+        if dimension_index.last_error is not None:
+            st.error(f"フィルタオプションの取得中にエラーが発生しました: {dimension_index.last_error}")
+        else:
+            _rerun_when_dimension_index_ready()
+    media_options = dimension_index.media_options() if dimension_index.ready else list(st.session_state.filters["media"])
 
     selected_media = st.multiselect(
         "メディア",
         options=media_options,
-        default=st.session_state.filters["media"]
+        default=[m for m in st.session_state.filters["media"] if m in media_options]
     )
+    if dimension_index.ready:
+        campaign_options = dimension_index.campaign_options(selected_media, start_date, end_date)
+    else:
+        campaign_options = list(st.session_state.filters["campaigns"])
     selected_campaigns = st.multiselect(
         "キャンペーン",
         options=campaign_options,
-        default=st.session_state.filters["campaigns"]
+        # 選択中のメディア・期間に該当しなくなったキャンペーンは選択から外す
+        default=[c for c in st.session_state.filters["campaigns"] if c in campaign_options]
     )
 
     # 選択状態を保存
@@ -276,21 +290,36 @@ def show_looker_studio_integration(bq_client, model, key_prefix="", sheet_analys
     #st.markdown("---")
 
     # iframeで表示
-    st.components.v1.iframe(final_url, height=600, scrolling=True)
+    if REPORT_ID:
+        st.components.v1.iframe(final_url, height=600, scrolling=True)
+    else:
+        st.error("環境変数LOOKER_REPORT_IDが設定されていません。")
     st.markdown("---")
 
     st.subheader("🤖 AIによる分析サマリー")
+    # タブ切り替えを即時にするため、他のシートのコメントをバックグラウンドで先読みする
+    schedule_dashboard_prefetch(bq_client, model, st.session_state.filters, sheet_analysis_queries)
+    comment_placeholder = st.empty()
     with st.spinner("AIが現在の表示内容を分析中です..."):
         comment = get_ai_dashboard_comment(
             _bq_client=bq_client,
             _model=model,
             sheet_name=st.session_state.filters["sheet"],
             filters=st.session_state.filters,
-            sheet_analysis_queries=sheet_analysis_queries
+            sheet_analysis_queries=sheet_analysis_queries,
+            force_refresh=st.session_state.pop("force_dashboard_refresh", False),
+            placeholder=comment_placeholder
         )
-        st.info(comment)
+        comment_placeholder.info(comment)
 
     # 再生成ボタンも用意
     if st.button("最新の情報で再生成", key=f"{key_prefix}_regenerate_summary"):
-        get_ai_dashboard_comment.clear()
+        # 「最新の情報」を取得するため、このシートのクエリ結果キャッシュも破棄する
+        get_query_cache().invalidate(
+            build_sheet_query(st.session_state.filters["sheet"], st.session_state.filters, sheet_analysis_queries)
+        )
+        get_prefetch_scheduler().invalidate(st.session_state.filters["sheet"], st.session_state.filters)
+        if working_set := get_local_working_set():
+            working_set.invalidate()
+        st.session_state.force_dashboard_refresh = True
         st.rerun()
\ No newline at end of file
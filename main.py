@@ -3,15 +3,23 @@
 import os
 import pandas as pd
 import streamlit as st
-import vertexai
-from vertexai.generative_models import GenerativeModel
-from google.cloud import bigquery
 from datetime import date, timedelta
 import base64
 
 from looker_handler import show_looker_studio_integration, show_filter_ui
 from ui_components import show_analysis_workbench
 from dashboard_analyzer import SHEET_ANALYSIS_QUERIES, get_ai_dashboard_comment
+from query_cache import get_query_cache
+from rollup import maybe_refresh_rollup
+from job_manager import get_job_manager, current_session_id
+from sql_cache import get_sql_cache
+from comment_cache import get_comment_cache
+from client_pool import PooledBigQueryClient, PooledGenerativeModel, LazyClient, get_pool_stats
+from history_store import load_history_frame, get_history_store
+from result_policy import fetch_with_result_policy
+from cost_guard import make_job_config
+from memory_governor import get_memory_governor, current_session_state
+from dimension_index import get_dimension_index
 
 # 環境変数からGCPプロジェクトIDとロケーションを取得
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "vorn-digi-mktg-poc-635a")
@@ -26,17 +34,27 @@ def get_base64_of_bin_file(bin_file):
         data = f.read()
     return base64.b64encode(data).decode()
 
+def _create_bigquery_client():
+    from google.cloud import bigquery
+    return PooledBigQueryClient(bigquery.Client(project=PROJECT_ID))
+
+def _create_gemini_model():
+    # vertexai の読み込みには数秒かかるため、最初に使われるまで遅らせる
+    import vertexai
+    from vertexai.generative_models import GenerativeModel
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+    return PooledGenerativeModel(GenerativeModel("gemini-2.0-flash-001"))
+
 @st.cache_resource
 def init_clients():
-    """GCPのクライアント（Vertex AI, BigQuery）を初期化する"""
-    try:
-        vertexai.init(project=PROJECT_ID, location=LOCATION)
-        model = GenerativeModel("gemini-2.0-flash-001")
-        bq_client = bigquery.Client(project=PROJECT_ID)
-        return bq_client, model
-    except Exception as e:
-        st.error(f"GCPクライアントの初期化中にエラーが発生しました: {e}")
-        return None, None
+    """
+    GCPのクライアント（Vertex AI, BigQuery）を用意する。
+    全セッションで共有するため、同時実行数とレートを制御するラッパーで包む。
+    SDKの読み込みとクライアントの作成は最初に使われたときに行い、最初の画面の表示を待たせない。
+    """
+    bq_client = LazyClient("BigQueryクライアント", _create_bigquery_client)
+    model = LazyClient("Vertex AIクライアント", _create_gemini_model)
+    return bq_client, model
 
 def init_session_state():
     """アプリケーションで利用するセッション変数を初期化する"""
@@ -44,6 +62,7 @@ def init_session_state():
         "sql": "", "df": pd.DataFrame(), "comment": "", "fig": None,
         "graph_cfg": {}, "is_looker_hidden": False, "editable_sql": "",
         "analysis_history": [],
+        "pending_sql": None, "cost_estimate": None, "result_meta": None, "execution_attempts": [],
         "apply_date_filter": True,
         "apply_media_filter": True,
         "apply_campaign_filter": True,
@@ -64,13 +83,20 @@ def main():
     # 背景画像を削除したため、CSSのセクションを削除
 
     bq_client, model = init_clients()
-    if not bq_client or not model:
-        st.stop()
 
     init_session_state()
 
     st.session_state.bq_client = bq_client
     st.session_state.model = model
+    # メモリ節約のために退避されていた結果があれば読み戻す
+    governor = get_memory_governor()
+    if not governor.restore(st.session_state):
+        st.session_state.df = pd.DataFrame()
+        st.warning("メモリ節約のため退避していた分析結果を復元できませんでした。お手数ですが分析を再実行してください。")
+    # 前回のスクリプト実行で投入され、まだ実行中のBigQueryジョブは結果が使われないため取り消す
+    get_job_manager().begin_run(current_session_id())
+    # ダッシュボード用の事前集計テーブルを必要に応じてバックグラウンドで更新
+    maybe_refresh_rollup(bq_client)
 
     with st.sidebar:
         st.header("表示モード切替")
@@ -100,14 +126,59 @@ def main():
                 if isinstance(history, dict) and 'user_input' in history:
                     with st.expander(f"履歴{len(st.session_state.analysis_history) - i}: {history['user_input'][:20]}"):
                         st.caption(f"指示内容: {history['user_input']}")
+                        st.caption(f"結果: {history['rows']:,}行 × {history['columns']}列")
                         if st.button(f"この分析を再現する", key=f"history_btn_{i}"):
-                            st.session_state.user_input_main = history["user_input"]
-                            st.session_state.sql = history["sql"]
-                            st.session_state.editable_sql = history["sql"]
-                            st.session_state.df = history["df"]
-                            st.session_state.graph_cfg = history["graph_cfg"]
-                            st.session_state.comment = history["comment"]
-                            st.rerun()
+                            df = load_history_frame(history)
+                            result_meta = history.get("result_meta")
+                            if df is None:
+                                # 保存済みの結果が期限切れ等で見つからない場合は、SQLを再実行して復元する
+                                with st.spinner("履歴の結果をBigQueryから再取得中です..."):
+                                    try:
+                                        df, result_meta = fetch_with_result_policy(bq_client, history["sql"], job_config=make_job_config())
+                                    except Exception as e:
+                                        st.error(f"履歴の結果を再取得できませんでした: {e}")
+                            if df is not None:
+                                st.session_state.user_input_main = history["user_input"]
+                                st.session_state.sql = history["sql"]
+                                st.session_state.editable_sql = history["sql"]
+                                st.session_state.df = df
+                                st.session_state.graph_cfg = history["graph_cfg"]
+                                st.session_state.comment = history["comment"]
+                                st.session_state.result_meta = result_meta
+                                st.rerun()
+
+        st.markdown("---")
+        cache_stats = get_query_cache().stats()
+        st.caption(
+            f"クエリキャッシュ: ヒット {cache_stats['hits'] + cache_stats['disk_hits']} / ミス {cache_stats['misses']}"
+            f"（ヒット率 {cache_stats['hit_rate']:.0%}、{cache_stats['entries']}件, {cache_stats['bytes'] / 1024 / 1024:.1f}MB）"
+        )
+        sql_stats = get_sql_cache().stats()
+        st.caption(f"SQL生成キャッシュ: ヒット {sql_stats['hits'] + sql_stats['fuzzy_hits']} / ミス {sql_stats['misses']}（{sql_stats['entries']}件）")
+        comment_stats = get_comment_cache().stats()
+        st.caption(f"AIコメントキャッシュ: ヒット {comment_stats['hits']} / ミス {comment_stats['misses']}（{comment_stats['entries']}件）")
+        job_stats = get_job_manager().stats()
+        st.caption(f"BigQueryジョブ: 実行中 {job_stats['running']} / 投入 {job_stats['submitted']} / 取り消し {job_stats['cancelled']}")
+        memory_stats = governor.stats()
+        st.caption(
+            f"セッションのメモリ: {memory_stats['total_bytes'] / 1024 / 1024:.1f}MB / {memory_stats['budget_bytes'] / 1024 / 1024:.0f}MB"
+            f"（{memory_stats['sessions']}セッション, 追い出し {memory_stats['evicted_sessions']}回）"
+        )
+        history_stats = get_history_store().stats()
+        st.caption(
+            f"分析履歴の結果: メモリ {history_stats['entries']}件, {history_stats['bytes'] / 1024 / 1024:.1f}MB"
+            f"（ディスクから復元 {history_stats['disk_hits']}件）"
+        )
+        index_stats = get_dimension_index().stats()
+        st.caption(
+            f"フィルタの索引: {index_stats['pairs']:,}組（{index_stats['bytes'] / 1024:.0f}KB）"
+            f"/ 全件作成 {index_stats['full_refreshes']}回, 増分更新 {index_stats['incremental_refreshes']}回"
+        )
+        for service, pool_stats in get_pool_stats().items():
+            st.caption(
+                f"{service}: 実行中 {pool_stats['in_flight']} / 呼び出し {pool_stats['calls']}"
+                f"（待ち {pool_stats['queued']}件, 平均 {pool_stats['avg_wait']:.2f}秒, 最大 {pool_stats['max_wait']:.1f}秒, 混雑 {pool_stats['busy']}件）"
+            )
 
     # メインコンテンツの表示
     if st.session_state.view_mode == "📊 ダッシュボード表示":
@@ -135,5 +206,15 @@ def main():
     elif st.session_state.view_mode == "🤖 AIアシスタント分析（全画面）":
         show_analysis_workbench(sheet_analysis_queries=SHEET_ANALYSIS_QUERIES)
 
+    # このセッションの使用量を記録し、インスタンスの予算を超えていれば他の古いセッションから追い出す
+    session_state = current_session_state()
+    if session_state is not None:
+        governor.track(current_session_id(), session_state)
+        governor.enforce(exclude=current_session_id())
+
+    # 画面を表示し終えてから、まだ使われていないクライアントをバックグラウンドで作成しておく
+    bq_client.warm_up()
+    model.warm_up()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
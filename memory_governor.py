@@ -0,0 +1,223 @@
+# memory_governor.py
+"""
+インスタンス内の全セッションのメモリ使用量の把握と追い出し
+- 各セッションのスクリプト実行の終わりに、重いオブジェクト（結果のDataFrame・グラフ・全件データ・履歴）の大きさを計測する
+  DataFrame は memory_usage(deep=True)、グラフはトレースが持つ配列の大きさで見積もる
+- 合計が INSTANCE_MEMORY_BUDGET_MB を超えたら、最後の操作が古いセッションから順に重いオブジェクトを手放す
+  - 結果のDataFrameは履歴ストアのディスク層に退避し、そのセッションの次の実行時に読み戻す
+  - グラフ・全件データは破棄する（グラフは次の描画で作り直され、全件データは再取得できる）
+- 実行中のセッションを避けるため、GOVERNOR_MIN_IDLE_SECONDS 以上操作のないセッションだけを対象にする
+Streamlit の SessionState は弱参照できないため、GOVERNOR_SESSION_TTL_SECONDS 操作のないセッションは
+重いオブジェクトを手放したうえで管理対象から外す
+"""
+import os
+import sys
+import time
+import threading
+import pandas as pd
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from history_store import get_history_store
+
+INSTANCE_MEMORY_BUDGET_BYTES = int(os.environ.get("INSTANCE_MEMORY_BUDGET_MB", "1024")) * 1024 * 1024
+GOVERNOR_MIN_IDLE_SECONDS = int(os.environ.get("GOVERNOR_MIN_IDLE_SECONDS", "30"))
+GOVERNOR_SESSION_TTL_SECONDS = int(os.environ.get("GOVERNOR_SESSION_TTL_SECONDS", "3600"))
+
+# 計測・追い出しの対象にするセッション変数
+HEAVY_KEYS = ["df", "fig", "full_result", "analysis_history"]
+# 計測はしない（他のキーと同じオブジェクトを参照する）が、追い出し時に参照を外すセッション変数
+RELEASED_KEYS = ["fingerprint_memo"]
+# 追い出し後に残す値（ここにないキーは削除する）
+EVICTED_PLACEHOLDERS = {"df": pd.DataFrame, "fig": lambda: None}
+# 追い出さないキー（履歴は軽量なメタデータのみ）
+PINNED_KEYS = {"analysis_history"}
+_FIGURE_ARRAY_PROPERTIES = ("x", "y", "z", "text", "customdata", "values", "labels", "hovertext")
+
+def estimate_size(obj, _depth: int = 0) -> int:
+    """オブジェクトのおおよそのメモリ使用量（バイト）を返す"""
+    if obj is None:
+        return 0
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(obj, pd.DataFrame) else int(usage)
+    if hasattr(obj, "data") and hasattr(obj, "layout") and hasattr(obj, "to_plotly_json"):
+        return _estimate_figure_size(obj)
+    if isinstance(obj, (bytes, bytearray, str)):
+        return len(obj)
+    if _depth < 3 and isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(value, _depth + 1) for value in obj.values())
+    if _depth < 3 and isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimate_size(value, _depth + 1) for value in obj)
+    return sys.getsizeof(obj)
+
+def _estimate_figure_size(fig) -> int:
+    """Plotlyのグラフの大きさを、各トレースが持つ配列の大きさから見積もる"""
+    total = 0
+    for trace in fig.data:
+        for prop in _FIGURE_ARRAY_PROPERTIES:
+            try:
+                value = trace[prop]
+            except (KeyError, ValueError):
+                continue
+            if value is None:
+                continue
+            if hasattr(value, "nbytes"):
+                total += int(value.nbytes)
+            elif isinstance(value, (list, tuple)):
+                # 要素は Python オブジェクトとして保持される（ポインタ + 値）
+                total += len(value) * 40
+    return total
+
+class _SessionRecord:
+    __slots__ = ("state", "last_active", "sizes", "_memo")
+
+    def __init__(self, state):
+        self.state = state
+        self.last_active = time.time()
+        self.sizes = {}
+        self._memo = {}  # キー -> (値の識別子, バイト数)。値が変わっていなければ再計測しない
+
+    @property
+    def total(self) -> int:
+        return sum(self.sizes.values())
+
+    @property
+    def evictable(self) -> int:
+        return sum(size for key, size in self.sizes.items() if key not in PINNED_KEYS)
+
+class MemoryGovernor:
+    """セッションごとの重いオブジェクトの大きさを記録し、予算超過時に古いセッションから追い出す"""
+
+    def __init__(self, budget_bytes=INSTANCE_MEMORY_BUDGET_BYTES, min_idle_seconds=GOVERNOR_MIN_IDLE_SECONDS,
+                 session_ttl=GOVERNOR_SESSION_TTL_SECONDS, history_store=None):
+        self.budget_bytes = budget_bytes
+        self.min_idle_seconds = min_idle_seconds
+        self.session_ttl = session_ttl
+        self.history_store = history_store or get_history_store()
+        self._sessions = {}  # session_id -> _SessionRecord
+        self._lock = threading.Lock()
+        self._stats = {"evicted_sessions": 0, "evicted_bytes": 0, "spilled_frames": 0, "restored_frames": 0, "expired_sessions": 0}
+
+    def track(self, session_id: str, state):
+        """セッションの重いオブジェクトを計測し、最終操作時刻を更新する（スクリプト実行の終わりに呼ぶ）"""
+        with self._lock:
+            record = self._sessions.get(session_id)
+            if record is None:
+                record = self._sessions[session_id] = _SessionRecord(state)
+            else:
+                # スクリプト実行ごとに窓口（SafeSessionState）が作り直されるため、最新の実行のものに差し替える
+                record.state = state
+            record.last_active = time.time()
+        sizes = {}
+        for key in HEAVY_KEYS:
+            value = state[key] if key in state else None
+            signature = (id(value), len(value) if hasattr(value, "__len__") else None)
+            memo = record._memo.get(key)
+            if memo is not None and memo[0] == signature:
+                sizes[key] = memo[1]
+                continue
+            size = estimate_size(value)
+            record._memo[key] = (signature, size)
+            sizes[key] = size
+        with self._lock:
+            record.sizes = sizes
+
+    def restore(self, state) -> bool:
+        """
+        このセッションの結果が追い出されていれば読み戻す（スクリプト実行の始めに呼ぶ）。
+        読み戻せなかった場合は False を返す。
+        """
+        evicted = state["evicted_result"] if "evicted_result" in state else None
+        if not evicted:
+            return True
+        del state["evicted_result"]
+        df = self.history_store.get(evicted["fingerprint"]) if evicted.get("fingerprint") else None
+        if df is None:
+            return False
+        state["df"] = df
+        with self._lock:
+            self._stats["restored_frames"] += 1
+        return True
+
+    def enforce(self, exclude: str = None) -> list:
+        """
+        期限切れのセッションを管理対象から外し、合計が予算を超えていれば
+        最後の操作が古いセッションから追い出す。追い出したセッションIDのリストを返す。
+        """
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, record in self._sessions.items()
+                       if sid != exclude and now - record.last_active > self.session_ttl]
+            expired_records = [self._sessions.pop(sid) for sid in expired]
+            self._stats["expired_sessions"] += len(expired_records)
+            total = sum(record.total for record in self._sessions.values())
+            candidates = sorted(
+                ((sid, record) for sid, record in self._sessions.items()
+                 if sid != exclude and now - record.last_active >= self.min_idle_seconds and record.evictable > 0),
+                key=lambda item: item[1].last_active,
+            )
+        for record in expired_records:
+            self._evict(record)
+
+        evicted = []
+        for sid, record in candidates:
+            if total <= self.budget_bytes:
+                break
+            freed = self._evict(record)
+            total -= freed
+            evicted.append(sid)
+            with self._lock:
+                self._stats["evicted_sessions"] += 1
+                self._stats["evicted_bytes"] += freed
+        return evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = {sid: record.total for sid, record in self._sessions.items()}
+            return {
+                **self._stats,
+                "sessions": len(sessions),
+                "total_bytes": sum(sessions.values()),
+                "budget_bytes": self.budget_bytes,
+                "largest_session_bytes": max(sessions.values(), default=0),
+            }
+
+    def _evict(self, record: _SessionRecord) -> int:
+        """セッションの重いオブジェクトを手放し、解放したバイト数を返す"""
+        state, freed = record.state, 0
+        for key in HEAVY_KEYS + RELEASED_KEYS:
+            if key in PINNED_KEYS or key not in state:
+                continue
+            value = state[key]
+            if key == "df" and isinstance(value, pd.DataFrame) and not value.empty:
+                fingerprint = None
+                if self.history_store.spill_dir:
+                    fingerprint = self.history_store.put(value, keep_in_memory=False)
+                    with self._lock:
+                        self._stats["spilled_frames"] += 1
+                state["evicted_result"] = {"fingerprint": fingerprint, "rows": len(value)}
+            placeholder = EVICTED_PLACEHOLDERS.get(key)
+            if placeholder is not None:
+                state[key] = placeholder()
+            else:
+                del state[key]
+            with self._lock:
+                freed += record.sizes.pop(key, 0)
+                record._memo.pop(key, None)
+        return freed
+
+def current_session_state():
+    """
+    実行中のセッションの SafeSessionState を返す。
+    st.session_state は全セッション共通の窓口のため、他のセッションから追い出す際はこちらを保持する。
+    SafeSessionState は読み書きのたびにそのセッションのロックを取るため、別スレッドからの追い出しと競合しない。
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None:
+        return None
+    return ctx.session_state
+
+_memory_governor = MemoryGovernor()
+
+def get_memory_governor() -> MemoryGovernor:
+    """インスタンス全体で共有するメモリガバナーを返す"""
+    return _memory_governor
@@ -0,0 +1,178 @@
+# prefetch.py
+"""
+ダッシュボードのシート別AIコメントを先読みするスケジューラ
+- 最初のフィルタ選択後、よく使われるシートのデータ取得とコメント生成を上限つきのワーカーで並列実行する
+- 現在のシートはフォアグラウンドでストリーミング表示しながら生成するため、先読みするのはそれ以外のシートだけにする
+- 結果はフィルタ条件をキーにインスタンス内で共有する
+- セッションのフィルタが変わったら、そのセッションが投入した古い先読みを取り消す
+- 失敗したシートは PREFETCH_FAILURE_BACKOFF_SECONDS の間は再投入しない（再実行のたびに全セッションから再試行しない）
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_MAX_WORKERS = int(os.environ.get("PREFETCH_MAX_WORKERS", "3"))
+PREFETCH_RESULT_TTL_SECONDS = int(os.environ.get("PREFETCH_RESULT_TTL_SECONDS", "600"))
+PREFETCH_MAX_RESULTS = int(os.environ.get("PREFETCH_MAX_RESULTS", "200"))
+PREFETCH_FAILURE_BACKOFF_SECONDS = int(os.environ.get("PREFETCH_FAILURE_BACKOFF_SECONDS", "120"))
+# 利用頻度の高い順に先読みするシート
+PREFETCH_SHEETS = ["サマリー01", "メディア", "日別", "月別", "キャンペーン", "デバイス", "曜日", "時間", "年齢", "性別"]
+
+class PrefetchCancelled(Exception):
+    """フィルタ変更により先読みが取り消されたことを表す"""
+
+def make_filters_key(filters: dict) -> tuple:
+    """シート選択を除いたフィルタ条件をハッシュ可能なキーに変換する"""
+    return (
+        str(filters.get("start_date")),
+        str(filters.get("end_date")),
+        tuple(sorted(filters.get("media") or [])),
+        tuple(sorted(filters.get("campaigns") or [])),
+    )
+
+class PrefetchScheduler:
+    """シート×フィルタ単位の計算を上限つきスレッドプールで先読みする"""
+
+    def __init__(self, max_workers: int = PREFETCH_MAX_WORKERS, ttl_seconds: int = PREFETCH_RESULT_TTL_SECONDS,
+                 max_results: int = PREFETCH_MAX_RESULTS, failure_backoff: int = PREFETCH_FAILURE_BACKOFF_SECONDS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.ttl_seconds = ttl_seconds
+        self.max_results = max_results
+        self.failure_backoff = failure_backoff
+        self._results = OrderedDict()  # (シート名, フィルタキー) -> (完了時刻, 結果)
+        self._failures = {}  # (シート名, フィルタキー) -> 失敗した時刻
+        self._futures = {}  # (シート名, フィルタキー) -> Future
+        self._sessions = {}  # セッションID -> (フィルタキー, 取り消し用Event)
+        self._lock = threading.Lock()
+
+    def schedule(self, session_id, filters: dict, sheets: list, compute_fn):
+        """
+        指定シートの計算を先頭から順に投入する。
+        同じセッションで前回と異なるフィルタが指定された場合は、前回分を取り消す。
+        compute_fn(sheet_name, filters, cancel_event) は結果を返す関数。
+        """
+        filters_key = make_filters_key(filters)
+        with self._lock:
+            previous = self._sessions.get(session_id)
+            if previous and previous[0] != filters_key:
+                self._cancel_locked(previous)
+            if previous and previous[0] == filters_key:
+                cancel_event = previous[1]
+            else:
+                cancel_event = threading.Event()
+                self._sessions[session_id] = (filters_key, cancel_event)
+
+            for sheet_name in sheets:
+                key = (sheet_name, filters_key)
+                if self._get_result_locked(key) is not None or key in self._futures or self._backing_off_locked(key):
+                    continue
+                future = self._executor.submit(self._run, key, compute_fn, sheet_name, dict(filters), cancel_event)
+                self._futures[key] = future
+
+    def get(self, sheet_name: str, filters: dict, wait: bool = False):
+        """
+        先読み済みの結果を返す。wait=True で計算中であれば、完了を待つ
+        （同じシートをフォアグラウンドで二重に計算しないため）。結果がない場合はNone
+        """
+        key = (sheet_name, make_filters_key(filters))
+        with self._lock:
+            result = self._get_result_locked(key)
+            if result is not None:
+                return result
+            future = self._futures.get(key)
+        if future is None or not wait:
+            return None
+        try:
+            return future.result()
+        except (CancelledError, PrefetchCancelled, Exception):
+            return None
+
+    def put(self, sheet_name: str, filters: dict, result):
+        """フォアグラウンドで計算した結果を先読みの結果として登録する"""
+        with self._lock:
+            self._store_locked((sheet_name, make_filters_key(filters)), result)
+
+    def invalidate(self, sheet_name: str, filters: dict):
+        with self._lock:
+            key = (sheet_name, make_filters_key(filters))
+            self._results.pop(key, None)
+            self._failures.pop(key, None)
+
+    # --- 内部処理 ---
+    def _run(self, key, compute_fn, sheet_name, filters, cancel_event):
+        try:
+            if cancel_event.is_set():
+                raise PrefetchCancelled()
+            result = compute_fn(sheet_name, filters, cancel_event)
+            if result is not None and not cancel_event.is_set():
+                with self._lock:
+                    self._store_locked(key, result)
+            return result
+        except PrefetchCancelled:
+            return None
+        except Exception as e:
+            print(f"Prefetch failed for sheet '{sheet_name}': {e}")
+            with self._lock:
+                self._failures.pop(key, None)
+                self._failures[key] = time.time()
+                while len(self._failures) > self.max_results:
+                    self._failures.pop(next(iter(self._failures)))
+            return None
+        finally:
+            with self._lock:
+                self._futures.pop(key, None)
+
+    def _cancel_locked(self, session_entry):
+        filters_key, cancel_event = session_entry
+        # 他のセッションが同じフィルタで待っている可能性があるため、フィルタが一致する別セッションがあれば残す
+        if any(entry[0] == filters_key for entry in self._sessions.values() if entry is not session_entry):
+            return
+        cancel_event.set()
+        for key, future in list(self._futures.items()):
+            if key[1] == filters_key:
+                future.cancel()
+
+    def _backing_off_locked(self, key) -> bool:
+        failed_at = self._failures.get(key)
+        if failed_at is None:
+            return False
+        if time.time() - failed_at >= self.failure_backoff:
+            del self._failures[key]
+            return False
+        return True
+
+    def _get_result_locked(self, key):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > self.ttl_seconds:
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return entry[1]
+
+    def _store_locked(self, key, result):
+        self._failures.pop(key, None)
+        self._results[key] = (time.time(), result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_prefetch_scheduler() -> PrefetchScheduler:
+    """インスタンス全体で共有する先読みスケジューラを返す"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PrefetchScheduler()
+        return _scheduler
+
+def prefetch_sheets(current_sheet: str, sheets: list = None) -> list:
+    """現在のシートを除いた先読み順を返す"""
+    sheets = sheets or PREFETCH_SHEETS
+    return [s for s in sheets if s != current_sheet]
@@ -4,6 +4,7 @@ BigQuery テーブルごとのプロンプト定義をまとめたファイル
 - データ集計部分とグラフ選択部分を分離
 - select_best_prompt() で自然言語から最適なテーブルを選択
 """
+import re
 
 PROMPT_DEFINITIONS = {
     # === 既存の定義 ===
@@ -196,6 +197,24 @@ MODIFY_SQL_TEMPLATE = """
 # 出力: 修正後のSQL
 """
 
+def get_table_columns() -> dict:
+    """
+    PROMPT_DEFINITIONS のテンプレートから「分析対象」テーブルと「カラム」を抽出し、
+    {テーブルID: [カラム名, ...]} の辞書を返す
+    """
+    catalog = {}
+    for info in PROMPT_DEFINITIONS.values():
+        table = re.search(r"# 分析対象: `([^`]+)`", info["template"])
+        columns = re.search(r"# カラム: (.+)", info["template"])
+        if table and columns:
+            known = catalog.setdefault(table.group(1), [])
+            known.extend(c.strip() for c in columns.group(1).split(",") if c.strip() and c.strip() not in known)
+    return catalog
+
+def get_prompt_id(info: dict) -> str:
+    """select_best_prompt() が返した定義のキー名を返す"""
+    return next((key for key, value in PROMPT_DEFINITIONS.items() if value is info), "unknown")
+
 def select_best_prompt(user_input: str):
     """
     自然言語指示から最適なテーブル（プロンプト）を選択するルール強化版ルーター
@@ -0,0 +1,217 @@
+# query_cache.py
+"""
+BigQueryのクエリ結果をインスタンス内で共有するキャッシュ
+- 空白・大文字小文字を正規化したSQLをキーにする（フィルタ条件はSQLのWHERE句に含まれる）
+- TTL + バイトサイズ上限によるLRU追い出し
+- QUERY_CACHE_DIR を設定すると Parquet でディスクにも保存し、インスタンス再起動後も再利用する
+"""
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd
+from arrow_fetch import fetch_dataframe
+from job_manager import JOB_MANAGER_ENABLED, get_job_manager, current_session_id
+from tracing import start_span, record_bigquery_job
+
+QUERY_CACHE_TTL_SECONDS = int(os.environ.get("QUERY_CACHE_TTL_SECONDS", "600"))
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_MB", "256")) * 1024 * 1024
+QUERY_CACHE_DIR = os.environ.get("QUERY_CACHE_DIR", "")
+
+# 文字列リテラルとバッククォート識別子は正規化の対象外にする
+_LITERAL_PATTERN = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)")
+
+def normalize_sql(sql: str) -> str:
+    """リテラル以外の空白の連続を1つにまとめ、小文字化したSQLを返す"""
+    parts = _LITERAL_PATTERN.split(sql.strip().rstrip(";").strip())
+    normalized = []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            normalized.append(part)
+        else:
+            normalized.append(re.sub(r"\s+", " ", part).lower())
+    return "".join(normalized).strip()
+
+def make_cache_key(sql: str) -> str:
+    """正規化したSQLのハッシュをキャッシュキーとして返す"""
+    return hashlib.sha256(normalize_sql(sql).encode("utf-8")).hexdigest()
+
+class QueryCache:
+    """TTL・LRU・ディスク層を持つスレッドセーフなクエリ結果キャッシュ"""
+
+    def __init__(self, ttl_seconds=QUERY_CACHE_TTL_SECONDS, max_bytes=QUERY_CACHE_MAX_BYTES, disk_dir=QUERY_CACHE_DIR):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()  # key -> (保存時刻, DataFrame, バイト数)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, sql: str):
+        """キャッシュ済みの結果を返す。存在しない、または期限切れの場合はNone"""
+        key = make_cache_key(sql)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, df, _ = entry
+                if now - stored_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return df.copy(deep=False)
+                self._remove(key)
+
+        df = self._read_disk(key, now)
+        with self._lock:
+            if df is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._store(key, df, now)
+        return df.copy(deep=False)
+
+    def put(self, sql: str, df: pd.DataFrame):
+        """結果をメモリ（および設定されていればディスク）に保存する"""
+        key = make_cache_key(sql)
+        with self._lock:
+            self._store(key, df, time.time())
+        self._write_disk(key, df)
+
+    def invalidate(self, sql: str):
+        """指定したSQLの結果をキャッシュから削除する"""
+        key = make_cache_key(sql)
+        with self._lock:
+            self._remove(key)
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        """ヒット/ミス数と現在のエントリ数・使用バイト数を返す"""
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            hit_rate = (self._stats["hits"] + self._stats["disk_hits"]) / lookups if lookups else 0.0
+            return {**self._stats, "entries": len(self._entries), "bytes": self._total_bytes, "hit_rate": hit_rate}
+
+    # --- 内部処理（呼び出し側でロックを保持すること） ---
+    def _store(self, key, df, stored_at):
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (stored_at, df, size)
+        self._total_bytes += size
+        while self._total_bytes > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self._stats["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+
+    # --- ディスク層 ---
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.parquet")
+
+    def _read_disk(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if now - os.path.getmtime(path) > self.ttl_seconds:
+                os.remove(path)
+                return None
+            return pd.read_parquet(path)
+        except Exception:
+            return None
+
+    def _write_disk(self, key, df):
+        if not self.disk_dir:
+            return
+        tmp_path = f"{self._disk_path(key)}.{threading.get_ident()}.tmp"
+        try:
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self._disk_path(key))
+        except Exception as e:
+            print(f"Failed to write query cache to disk: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def dataframe_fingerprint(df: pd.DataFrame) -> str:
+    """列名・型・値から、DataFrameの内容を表す軽量なハッシュを返す"""
+    h = hashlib.sha256()
+    h.update("|".join(map(str, df.columns)).encode("utf-8"))
+    h.update("|".join(map(str, df.dtypes)).encode("utf-8"))
+    try:
+        h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    except TypeError:
+        # リスト等のハッシュできない値を含む場合は文字列化して計算する
+        h.update(df.to_json(date_format="iso", default_handler=str).encode("utf-8"))
+    return h.hexdigest()[:32]
+
+_query_cache = QueryCache()
+
+def get_query_cache() -> QueryCache:
+    """インスタンス全体で共有するクエリキャッシュを返す"""
+    return _query_cache
+
+def destination_table_id(query_job):
+    """クエリジョブの結果が書き込まれたテーブルのIDを返す。取得できない場合はNone"""
+    destination = getattr(query_job, "destination", None)
+    if destination is None:
+        return None
+    return f"{destination.project}.{destination.dataset_id}.{destination.table_id}"
+
+def run_query(bq_client, sql: str, use_cache: bool = True, job_config=None, max_rows=None,
+              session_id=None, cancel_event=None) -> pd.DataFrame:
+    """
+    キャッシュを経由してSQLを実行し、結果のDataFrameを返す。
+    max_rows を指定した場合は行数予算で読み込みを打ち切り、全件とは別のキーでキャッシュする。
+    ジョブはジョブマネージャ経由で投入し、session_id（省略時は実行中のセッション）のジョブとして追跡する。
+    cancel_event がセットされると実行中のジョブを取り消し、JobCancelled を送出する。
+    """
+    cache = get_query_cache()
+    cache_sql = sql if max_rows is None else f"{sql}\n-- max_rows={max_rows}"
+    with start_span("bigquery.query", max_rows=max_rows) as span:
+        if use_cache:
+            cached = cache.get(cache_sql)
+            span.set_attribute("cache.hit", cached is not None)
+            if cached is not None:
+                span.set_attribute("bq.rows", len(cached))
+                return cached
+        with start_span("bigquery.job"):
+            if JOB_MANAGER_ENABLED:
+                query_job = get_job_manager().run(
+                    bq_client, sql, job_config=job_config,
+                    session_id=session_id or current_session_id(), cancel_event=cancel_event,
+                )
+            elif job_config is not None:
+                query_job = bq_client.query(sql, job_config=job_config)
+            else:
+                query_job = bq_client.query(sql)
+        with start_span("bigquery.download") as download_span:
+            df = fetch_dataframe(query_job, max_rows=max_rows)
+            download_span.set_attributes(rows=len(df), truncated=bool(df.attrs.get("truncated")))
+        if df.attrs.get("truncated"):
+            # 打ち切った結果の続きは、再スキャンせずにジョブの出力先（一時テーブル）から読めるようにする
+            df.attrs["destination"] = destination_table_id(query_job)
+        record_bigquery_job(query_job, rows=len(df))
+        if use_cache:
+            cache.put(cache_sql, df)
+        return df
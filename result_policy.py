@@ -0,0 +1,114 @@
+# result_policy.py
+"""
+AIが生成したクエリの結果サイズを制御するポリシー
+- RESULT_ROW_LIMIT 行までで読み込みを打ち切り、超過した場合は「打ち切り」として記録する
+- 超過時は先頭列（グラフのX軸）で GROUP BY したロールアップSQLを実行し、集計済みの結果に置き換える
+  ロールアップは最初のジョブの出力先（一時テーブル）を集計し、元のクエリを再実行しない（スキャン量は見積もりどおり）
+- 全件データはダウンロード時にのみ取得する。最初のジョブの出力先（一時テーブル）を読み、
+  出力先が分からない、または期限切れ等で読めない場合のみ full_sql を再実行する
+"""
+import os
+from query_cache import run_query
+from arrow_fetch import fetch_table_dataframe
+from retry_policy import classify_error, SEMANTIC
+
+RESULT_ROW_LIMIT = int(os.environ.get("RESULT_ROW_LIMIT", "5000"))
+AUTO_AGGREGATE_RESULTS = os.environ.get("AUTO_AGGREGATE_RESULTS", "true").lower() == "true"
+
+# 比率指標は合計値から再計算する（分子, 分母）。コスト列は候補の中から最初に見つかったものを使う
+COST_COLUMNS = ["CostIncludingFees", "Cost", "TotalCost", "ActualCost"]
+RATIO_METRICS = {
+    "CTR": ("Clicks", "Impressions"),
+    "CVR": ("Conversions", "Clicks"),
+    "CPA": ("{cost}", "Conversions"),
+    "CPC": ("{cost}", "Clicks"),
+    "CPM": ("{cost}", "Impressions"),
+    "ROAS": ("ConversionValue", "{cost}"),
+}
+
+def build_rollup_sql(source_table: str, sample_df):
+    """
+    サンプル結果の列構成から、元のクエリの結果テーブル source_table を先頭列で集計するロールアップSQLを組み立てる。
+    集計できる数値列がない場合はNoneを返す。
+    """
+    if sample_df is None or len(sample_df.columns) < 2:
+        return None
+    axis = sample_df.columns[0]
+    measures = [col for col in sample_df.select_dtypes(include="number").columns if col != axis]
+    if not measures:
+        return None
+
+    cost_col = next((col for col in COST_COLUMNS if col in measures), None)
+    select_items = [f"`{axis}`"]
+    for col in measures:
+        ratio = RATIO_METRICS.get(str(col).upper())
+        if ratio:
+            numerator, denominator = (part.format(cost=cost_col) if cost_col else part for part in ratio)
+            if numerator in measures and denominator in measures:
+                select_items.append(f"SAFE_DIVIDE(SUM(`{numerator}`), SUM(`{denominator}`)) AS `{col}`")
+            else:
+                select_items.append(f"AVG(`{col}`) AS `{col}`")
+        else:
+            select_items.append(f"SUM(`{col}`) AS `{col}`")
+
+    return (
+        f"SELECT {', '.join(select_items)}\n"
+        f"FROM `{source_table}`\n"
+        f"GROUP BY `{axis}`\n"
+        f"ORDER BY `{axis}`"
+    )
+
+def fetch_with_result_policy(bq_client, sql: str, job_config=None, row_limit: int = RESULT_ROW_LIMIT):
+    """
+    行数上限つきでSQLを実行し、(DataFrame, 結果メタ情報) を返す。
+    メタ情報の truncated / aggregated で、表示中のデータが全件でないことを判別できる。
+    """
+    meta = {"truncated": False, "aggregated": False, "row_limit": row_limit, "full_sql": sql, "rollup_sql": None, "destination": None}
+    if not row_limit:
+        return run_query(bq_client, sql, job_config=job_config), meta
+
+    df = run_query(bq_client, sql, job_config=job_config, max_rows=row_limit)
+    if not df.attrs.get("truncated"):
+        return df, meta
+
+    destination = df.attrs.get("destination")
+    meta.update(truncated=True, destination=destination)
+    rollup_sql = build_rollup_sql(destination, df) if AUTO_AGGREGATE_RESULTS and destination else None
+    if rollup_sql:
+        try:
+            df_rollup = run_query(bq_client, rollup_sql, job_config=job_config, max_rows=row_limit)
+            if not df_rollup.empty:
+                meta.update(aggregated=True, rollup_sql=rollup_sql, truncated=bool(df_rollup.attrs.get("truncated")))
+                return df_rollup, meta
+        except Exception as e:
+            print(f"Rollup query failed, using truncated result instead: {e}")
+    return df, meta
+
+def fetch_full_result(bq_client, meta: dict, job_config=None):
+    """
+    表示用に打ち切った・集計した結果の全件データを返す。
+    最初のジョブの出力先（一時テーブル）を読み、元のクエリは再実行しない。
+    出力先がない場合や、期限切れ等で見つからない場合（semantic）のみ full_sql を実行する。
+    """
+    destination = meta.get("destination")
+    if destination:
+        try:
+            return fetch_table_dataframe(bq_client, destination)
+        except Exception as e:
+            if classify_error(e) != SEMANTIC:
+                raise
+            print(f"Result table {destination} is unavailable, re-running the full query: {e}")
+    return run_query(bq_client, meta["full_sql"], job_config=job_config)
+
+def describe_result_meta(meta) -> str:
+    """結果メタ情報を画面表示用の文に変換する。全件の場合は空文字"""
+    if not meta:
+        return ""
+    if meta.get("aggregated"):
+        note = "結果が多いため、先頭列（X軸）で集計した値を表示しています。"
+        if meta.get("truncated"):
+            note += f"集計後も上位{meta['row_limit']:,}行のみ表示しています。"
+        return note
+    if meta.get("truncated"):
+        return f"結果が多いため、先頭の{meta['row_limit']:,}行のみ表示しています。"
+    return ""
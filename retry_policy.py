@@ -0,0 +1,114 @@
+# retry_policy.py
+"""
+BigQuery / Gemini のエラー分類と再試行ポリシー
+- transient : 5xx・タイムアウト・接続断。同じリクエストを指数バックオフ（ジッタつき）で再試行する
+- quota     : 429・レート制限・クォータ超過・混雑（ServiceBusy）。待ち時間を長めにして再試行する
+- permission: 401 / 403（クォータ起因の403を除く）。再試行もSQLの修正もしない
+- cancelled : 新しい操作によるジョブの取り消し。何もしない
+- configuration: クライアントの初期化失敗（認証情報・プロジェクトの設定漏れなど）。再試行もSQLの修正もせず、そのまま伝える
+- semantic  : 上記以外（構文エラー・存在しない列など）。SQLの誤りとしてAIの修正に回す
+各試行は分類と所要時間とともに記録する
+"""
+import os
+import time
+import random
+import concurrent.futures
+
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY_SECONDS = float(os.environ.get("RETRY_BASE_DELAY_SECONDS", "1.0"))
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get("RETRY_MAX_DELAY_SECONDS", "20.0"))
+# クォータ超過は短時間では回復しにくいため、待ち時間の基準を長くする
+QUOTA_DELAY_MULTIPLIER = float(os.environ.get("QUOTA_DELAY_MULTIPLIER", "4.0"))
+
+TRANSIENT, QUOTA, PERMISSION, CANCELLED, SEMANTIC = "transient", "quota", "permission", "cancelled", "semantic"
+CONFIGURATION = "configuration"
+RETRYABLE_CATEGORIES = {TRANSIENT, QUOTA}
+
+# BigQuery はクォータ超過も 403 で返すため、理由コードで判別する
+_QUOTA_MARKERS = ("ratelimitexceeded", "quotaexceeded", "quota exceeded", "resource exhausted", "too many requests")
+_TRANSIENT_MARKERS = ("backenderror", "internalerror", "timed out", "timeout", "deadline exceeded", "connection reset",
+                      "connection aborted", "service unavailable", "temporarily unavailable")
+# ステータスコードだけの一致はSQL中の数値と区別できないため、文言で判別する
+_PERMISSION_MARKERS = ("403 forbidden", "401 unauthorized", "accessdenied", "access denied", "permission denied")
+
+
+def classify_error(error: BaseException) -> str:
+    """例外を transient / quota / permission / cancelled / configuration / semantic のいずれかに分類する"""
+    name = type(error).__name__
+    if name in ("JobCancelled", "PrefetchCancelled"):
+        return CANCELLED
+    if name == "ClientInitError":
+        return CONFIGURATION
+    if name == "ServiceBusy":
+        return QUOTA
+
+    message = str(error).lower()
+    try:
+        from google.api_core import exceptions as gexc
+        if isinstance(error, (gexc.TooManyRequests, gexc.ResourceExhausted)):
+            return QUOTA
+        if isinstance(error, (gexc.Forbidden, gexc.Unauthorized, gexc.PermissionDenied)):
+            return QUOTA if any(marker in message for marker in _QUOTA_MARKERS) else PERMISSION
+        if isinstance(error, (gexc.ServerError, gexc.DeadlineExceeded, gexc.ServiceUnavailable, gexc.RetryError)):
+            return TRANSIENT
+        if isinstance(error, gexc.GoogleAPICallError):
+            # 400 系でも理由コードが一時的な障害を示すものがある
+            if any(marker in message for marker in ("backenderror", "internalerror", "ratelimitexceeded")):
+                return QUOTA if "ratelimitexceeded" in message else TRANSIENT
+            return SEMANTIC
+    except ImportError:
+        pass
+
+    if isinstance(error, (TimeoutError, ConnectionError, concurrent.futures.TimeoutError)):
+        return TRANSIENT
+    if any(marker in message for marker in _QUOTA_MARKERS):
+        return QUOTA
+    if any(marker in message for marker in _PERMISSION_MARKERS):
+        return PERMISSION
+    if name in ("ConnectionError", "ReadTimeout", "ConnectTimeout", "ChunkedEncodingError") or \
+            any(marker in message for marker in _TRANSIENT_MARKERS):
+        return TRANSIENT
+    return SEMANTIC
+
+
+def backoff_delay(retry_index: int, category: str = TRANSIENT,
+                  base: float = RETRY_BASE_DELAY_SECONDS, max_delay: float = RETRY_MAX_DELAY_SECONDS) -> float:
+    """retry_index 回目（0始まり）の再試行前に待つ秒数を返す（フルジッタ）"""
+    if category == QUOTA:
+        base *= QUOTA_DELAY_MULTIPLIER
+    return random.uniform(0, min(max_delay, base * (2 ** retry_index)))
+
+
+def call_with_retry(fn, attempts: list = None, label: str = "", max_attempts: int = RETRY_MAX_ATTEMPTS, sleep=time.sleep):
+    """
+    fn() を実行し、一時的なエラー（transient / quota）の場合はバックオフして同じ処理を再試行する。
+    それ以外のエラー、または最大試行回数に達した場合は最後の例外をそのまま送出する。
+    attempts にリストを渡すと、試行ごとに {label, attempt, category, latency, error} を追記する。
+    """
+    for attempt in range(1, max_attempts + 1):
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            category = classify_error(e)
+            _record(attempts, label, attempt, category, time.perf_counter() - started, e)
+            if category not in RETRYABLE_CATEGORIES or attempt == max_attempts:
+                raise
+            delay = backoff_delay(attempt - 1, category)
+            print(f"{label or 'call'} failed ({category}), retrying in {delay:.1f}s: {e}")
+            sleep(delay)
+        else:
+            _record(attempts, label, attempt, "ok", time.perf_counter() - started, None)
+            return result
+
+
+def _record(attempts, label, attempt, category, latency, error):
+    if attempts is None:
+        return
+    attempts.append({
+        "label": label,
+        "attempt": attempt,
+        "category": category,
+        "latency": round(latency, 3),
+        "error": str(error)[:300] if error is not None else "",
+    })
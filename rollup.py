@@ -0,0 +1,181 @@
+# rollup.py
+"""
+ダッシュボードのシート分析クエリ用の日次集計（ロールアップ）テーブル
+- LookerStudio_report_campaign を (Date, ServiceNameJA_Media, CampaignName) 単位で事前集計する
+- 直近 ROLLUP_REFRESH_DAYS 日分だけを削除・再挿入する増分更新を、バックグラウンドで定期実行する
+  削除と挿入は1つのトランザクションで行い、更新中に直近分が欠けて見えたり、複数インスタンスの同時更新で行が重複したりしないようにする
+- 参照列と集計関数がロールアップでカバーされるシートクエリだけを集計テーブルに振り向け、それ以外は元テーブルを使う
+生成するSQLは BigQuery と DuckDB の両方で実行できる構文に揃えている
+（DuckDB では quote='"'、partitioned=False を指定する）
+"""
+import os
+import re
+import time
+import datetime
+import threading
+from prompts import get_table_columns
+
+USE_ROLLUP_TABLES = os.environ.get("USE_ROLLUP_TABLES", "false").lower() == "true"
+CAMPAIGN_TABLE = "vorn-digi-mktg-poc-635a.toki_air.LookerStudio_report_campaign"
+ROLLUP_CAMPAIGN_TABLE = os.environ.get("ROLLUP_CAMPAIGN_TABLE", "vorn-digi-mktg-poc-635a.toki_air.rollup_campaign_daily")
+# 遅れて確定するデータを取り込むため、更新時は直近N日分を再集計する
+ROLLUP_REFRESH_DAYS = int(os.environ.get("ROLLUP_REFRESH_DAYS", "3"))
+ROLLUP_REFRESH_INTERVAL_SECONDS = int(os.environ.get("ROLLUP_REFRESH_INTERVAL_SECONDS", str(6 * 3600)))
+
+ROLLUP_KEYS = ["Date", "ServiceNameJA_Media", "CampaignName"]
+# DayOfWeekJA は Date から一意に決まるため、行数を増やさずに保持できる
+ROLLUP_ATTRIBUTES = ["DayOfWeekJA"]
+ROLLUP_MEASURES = ["CostIncludingFees", "Impressions", "Clicks", "Conversions"]
+ROLLUP_COLUMNS = set(ROLLUP_KEYS + ROLLUP_ATTRIBUTES + ROLLUP_MEASURES)
+
+# SUM以外の集計は事前集計値から正しく再計算できないため、含まれていればロールアップを使わない
+# （MIN / MAX も日次の集計値からは元の行の最小・最大と一致しない場合がある）
+_NON_ADDITIVE_PATTERN = re.compile(r"\b(AVG|COUNT|MIN|MAX|STDDEV\w*|VARIANCE|VAR_\w+|APPROX_\w+|PERCENTILE_\w+|ARRAY_AGG|STRING_AGG)\s*\(", re.IGNORECASE)
+_ALIAS_PATTERN = re.compile(r"\bAS\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+_LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_IDENTIFIER_PATTERN = re.compile(r"\b[A-Za-z_][A-Za-z0-9_]*\b")
+
+def build_rollup_select(source_table: str = CAMPAIGN_TABLE, since_date: str = None, quote: str = "`", until_date: str = None) -> str:
+    """元テーブルをロールアップの粒度に集計するSELECT文を返す"""
+    conditions = []
+    if since_date:
+        conditions.append(f"Date >= '{since_date}'")
+    if until_date:
+        conditions.append(f"Date <= '{until_date}'")
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    measures = ",\n    ".join(f"SUM({m}) AS {m}" for m in ROLLUP_MEASURES)
+    attributes = ",\n    ".join(f"ANY_VALUE({a}) AS {a}" for a in ROLLUP_ATTRIBUTES)
+    return f"""
+SELECT
+    {', '.join(ROLLUP_KEYS)},
+    {attributes},
+    {measures}
+FROM {quote}{source_table}{quote}
+{where_clause}
+GROUP BY {', '.join(ROLLUP_KEYS)}
+"""
+
+def build_create_statement(rollup_table: str = ROLLUP_CAMPAIGN_TABLE, source_table: str = CAMPAIGN_TABLE,
+                           partitioned: bool = True, quote: str = "`") -> str:
+    """ロールアップテーブルを全件作り直すCREATE文を返す"""
+    options = "\nPARTITION BY Date\nCLUSTER BY ServiceNameJA_Media, CampaignName" if partitioned else ""
+    return f"CREATE OR REPLACE TABLE {quote}{rollup_table}{quote}{options}\nAS{build_rollup_select(source_table, quote=quote)}"
+
+def build_incremental_statements(since_date: str, rollup_table: str = ROLLUP_CAMPAIGN_TABLE, source_table: str = CAMPAIGN_TABLE,
+                                 quote: str = "`") -> list:
+    """指定日以降を削除して再集計・挿入するSQLのリストを、1つのトランザクションとして返す"""
+    return [
+        "BEGIN TRANSACTION",
+        f"DELETE FROM {quote}{rollup_table}{quote} WHERE Date >= '{since_date}'",
+        f"INSERT INTO {quote}{rollup_table}{quote} ({', '.join(ROLLUP_KEYS + ROLLUP_ATTRIBUTES + ROLLUP_MEASURES)})"
+        f"{build_rollup_select(source_table, since_date, quote=quote)}",
+        "COMMIT TRANSACTION",
+    ]
+
+def _base_columns_referenced(query: str) -> set:
+    """
+    クエリテンプレートが参照している元テーブルの列名を返す。
+    SELECT句では「AS 別名」を除いた全識別子を、FROM以降では別名への参照を除いた識別子を対象にする。
+    """
+    base_columns = set(get_table_columns().get(CAMPAIGN_TABLE, []))
+    select_part, _, rest = query.partition("FROM `{table}`")
+    select_part = _LITERAL_PATTERN.sub("''", select_part)
+    rest = _LITERAL_PATTERN.sub("''", rest.replace("{where_clause}", ""))
+    aliases = set(_ALIAS_PATTERN.findall(select_part))
+    referenced = set(_IDENTIFIER_PATTERN.findall(_ALIAS_PATTERN.sub("", select_part)))
+    referenced |= set(_IDENTIFIER_PATTERN.findall(rest)) - aliases
+    return referenced & base_columns
+
+def is_covered_by_rollup(query_info: dict) -> bool:
+    """シートクエリがロールアップテーブルだけで正しく計算できるかを判定する"""
+    if query_info.get("table") != CAMPAIGN_TABLE:
+        return False
+    query = query_info["query"]
+    if _NON_ADDITIVE_PATTERN.search(query):
+        return False
+    # フィルタは build_where_clause で Date / ServiceNameJA_Media / CampaignName に掛かるため、常にカバーされる
+    return _base_columns_referenced(query) <= ROLLUP_COLUMNS
+
+
+class RollupManager:
+    """ロールアップテーブルの鮮度を管理し、クエリの振り向け先を決める"""
+
+    def __init__(self, rollup_table: str = ROLLUP_CAMPAIGN_TABLE, source_table: str = CAMPAIGN_TABLE,
+                 refresh_days: int = ROLLUP_REFRESH_DAYS, refresh_interval: int = ROLLUP_REFRESH_INTERVAL_SECONDS):
+        self.rollup_table = rollup_table
+        self.source_table = source_table
+        self.refresh_days = refresh_days
+        self.refresh_interval = refresh_interval
+        self.ready = False
+        self.last_refreshed = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def refresh(self, bq_client, full: bool = False) -> str:
+        """ロールアップを更新する。テーブルがない場合や full=True の場合は全件作成する"""
+        max_date = None if full else self._get_max_date(bq_client)
+        if max_date is None:
+            bq_client.query(build_create_statement(self.rollup_table, self.source_table)).result()
+            mode = "full"
+        else:
+            since_date = (max_date - datetime.timedelta(days=self.refresh_days)).strftime("%Y-%m-%d")
+            script = ";\n".join(build_incremental_statements(since_date, self.rollup_table, self.source_table))
+            bq_client.query(script).result()
+            mode = f"incremental since {since_date}"
+        self.ready = True
+        self.last_refreshed = time.time()
+        return mode
+
+    def _get_max_date(self, bq_client):
+        try:
+            rows = list(bq_client.query(f"SELECT MAX(Date) AS max_date FROM `{self.rollup_table}`").result())
+        except Exception:
+            # テーブル未作成
+            return None
+        max_date = rows[0]["max_date"] if rows else None
+        if isinstance(max_date, datetime.datetime):
+            max_date = max_date.date()
+        return max_date
+
+    def refresh_in_background(self, bq_client):
+        """更新間隔を過ぎていれば、バックグラウンドスレッドで更新を開始する"""
+        with self._lock:
+            if self._refreshing or time.time() - self.last_refreshed < self.refresh_interval:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                mode = self.refresh(bq_client)
+                print(f"Rollup table {self.rollup_table} refreshed ({mode}).")
+            except Exception as e:
+                # 更新に失敗しても、前回作成済みのロールアップがあればそのまま使う
+                print(f"Failed to refresh rollup table: {e}")
+                self.last_refreshed = time.time()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, name="rollup-refresh", daemon=True).start()
+
+    def resolve_table(self, query_info: dict) -> str:
+        """シートクエリの実行先テーブルを返す。ロールアップが使えない場合は元テーブル"""
+        if self.ready and is_covered_by_rollup(query_info):
+            return self.rollup_table
+        return query_info["table"]
+
+_rollup_manager = RollupManager()
+
+def maybe_refresh_rollup(bq_client):
+    """ロールアップが有効な場合、必要に応じてバックグラウンド更新を開始する"""
+    if USE_ROLLUP_TABLES:
+        _rollup_manager.refresh_in_background(bq_client)
+
+def is_rollup_ready() -> bool:
+    """ロールアップテーブルが利用可能な状態かを返す"""
+    return USE_ROLLUP_TABLES and _rollup_manager.ready
+
+def resolve_sheet_table(query_info: dict) -> str:
+    """シートクエリの {table} に埋め込むテーブルIDを返す"""
+    if not USE_ROLLUP_TABLES:
+        return query_info["table"]
+    return _rollup_manager.resolve_table(query_info)
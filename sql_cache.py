@@ -0,0 +1,144 @@
+# sql_cache.py
+"""
+自然言語の分析指示から生成したSQLのキャッシュ
+- キーは (プロンプトテンプレートID, 正規化した指示文, フィルタ句)
+- 実行に成功したSQLだけを保存し、ヒットした場合はGeminiの呼び出しとリトライループを省略する
+- 表記ゆれ程度の言い換えは difflib の類似度で同じ指示として扱う（SQL_CACHE_FUZZY_THRESHOLD）
+- PROMPT_DEFINITIONS / MODIFY_SQL_TEMPLATE が変わると、バージョンが変わり既存のエントリは無効になる
+「先月」「過去7日間」など相対的な期間を含む指示に対応するため、エントリは作成した日の間だけ有効
+"""
+import os
+import re
+import json
+import hashlib
+import datetime
+import threading
+import unicodedata
+from difflib import SequenceMatcher
+from collections import OrderedDict
+from prompts import PROMPT_DEFINITIONS, MODIFY_SQL_TEMPLATE
+
+SQL_CACHE_ENABLED = os.environ.get("SQL_CACHE_ENABLED", "true").lower() == "true"
+SQL_CACHE_FUZZY_THRESHOLD = float(os.environ.get("SQL_CACHE_FUZZY_THRESHOLD", "0.92"))
+SQL_CACHE_MAX_ENTRIES = int(os.environ.get("SQL_CACHE_MAX_ENTRIES", "500"))
+# 設定するとJSONファイルに保存し、インスタンス再起動後も再利用する
+SQL_CACHE_PATH = os.environ.get("SQL_CACHE_PATH", "")
+
+def compute_prompt_version() -> str:
+    """プロンプト定義の内容から、キャッシュのバージョン文字列を計算する"""
+    payload = json.dumps(PROMPT_DEFINITIONS, ensure_ascii=False, sort_keys=True) + MODIFY_SQL_TEMPLATE
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+# 1文字違いでも意味が変わる語（期間・数値・並び順）は、類似一致でも完全に一致することを条件にする
+_CRITICAL_TOKEN_PATTERN = re.compile(
+    r"\d+|今月|先月|前月|来月|今週|先週|前週|今日|本日|昨日|今年|昨年|前年|去年|過去|直近|"
+    r"高|低|多|少|昇順|降順|増|減|上位|下位|top|worst|best"
+)
+
+def normalize_instruction(text: str) -> str:
+    """全角・半角、大文字・小文字、空白、句読点の揺れを吸収した指示文を返す"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"[、。,.!?！？「」『』\s]+", " ", text)
+    return text.strip()
+
+class SqlGenerationCache:
+    """実行に成功した生成SQLを保持するスレッドセーフなキャッシュ"""
+
+    def __init__(self, path: str = SQL_CACHE_PATH, max_entries: int = SQL_CACHE_MAX_ENTRIES,
+                 fuzzy_threshold: float = SQL_CACHE_FUZZY_THRESHOLD):
+        self.path = path
+        self.max_entries = max_entries
+        self.fuzzy_threshold = fuzzy_threshold
+        self.version = compute_prompt_version()
+        self._entries = OrderedDict()  # キー文字列 -> エントリ辞書
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "fuzzy_hits": 0, "misses": 0}
+        self._load()
+
+    def _scope(self, prompt_id: str, filter_clause: str) -> str:
+        return f"{self.version}|{datetime.date.today().isoformat()}|{prompt_id}|{(filter_clause or '').strip()}"
+
+    def lookup(self, prompt_id: str, instruction: str, filter_clause: str):
+        """キャッシュ済みのSQLを返す。完全一致がなければ類似度の高い指示を探す。なければNone"""
+        scope = self._scope(prompt_id, filter_clause)
+        normalized = normalize_instruction(instruction)
+        with self._lock:
+            entry = self._entries.get(f"{scope}|{normalized}")
+            if entry is not None:
+                self._entries.move_to_end(f"{scope}|{normalized}")
+                self._stats["hits"] += 1
+                return entry["sql"]
+
+            if self.fuzzy_threshold < 1.0:
+                best_key, best_ratio = None, 0.0
+                critical_tokens = _CRITICAL_TOKEN_PATTERN.findall(normalized)
+                for key, candidate in self._entries.items():
+                    if candidate["scope"] != scope:
+                        continue
+                    if _CRITICAL_TOKEN_PATTERN.findall(candidate["instruction"]) != critical_tokens:
+                        continue
+                    ratio = SequenceMatcher(None, normalized, candidate["instruction"]).ratio()
+                    if ratio > best_ratio:
+                        best_key, best_ratio = key, ratio
+                if best_key is not None and best_ratio >= self.fuzzy_threshold:
+                    self._entries.move_to_end(best_key)
+                    self._stats["fuzzy_hits"] += 1
+                    return self._entries[best_key]["sql"]
+
+            self._stats["misses"] += 1
+            return None
+
+    def record_success(self, prompt_id: str, instruction: str, filter_clause: str, sql: str):
+        """実行に成功したSQLを保存する"""
+        scope = self._scope(prompt_id, filter_clause)
+        normalized = normalize_instruction(instruction)
+        with self._lock:
+            key = f"{scope}|{normalized}"
+            self._entries[key] = {"scope": scope, "instruction": normalized, "sql": sql}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save_locked()
+
+    def invalidate(self, prompt_id: str, instruction: str, filter_clause: str, sql: str):
+        """キャッシュしたSQLが実行に失敗した場合に、そのSQLを持つエントリを削除する"""
+        scope = self._scope(prompt_id, filter_clause)
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e["scope"] == scope and e["sql"] == sql]:
+                del self._entries[key]
+            self._save_locked()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+    # --- 永続化 ---
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            # バージョンが異なるエントリは読み込まない
+            for key, entry in data.items():
+                if entry.get("scope", "").startswith(f"{self.version}|"):
+                    self._entries[key] = entry
+        except Exception as e:
+            print(f"Failed to load SQL cache: {e}")
+
+    def _save_locked(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Failed to save SQL cache: {e}")
+
+_sql_cache = SqlGenerationCache()
+
+def get_sql_cache() -> SqlGenerationCache:
+    """インスタンス全体で共有するSQL生成キャッシュを返す"""
+    return _sql_cache
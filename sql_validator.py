@@ -0,0 +1,141 @@
+# sql_validator.py
+"""
+AIが生成したSQLをBigQueryへ送る前にローカルで検証・修正する
+- マークダウンのコードフェンス、末尾のセミコロン、テーブルIDの引用符の誤りは機械的に直す
+- テーブルIDと列名は PROMPT_DEFINITIONS から作ったカタログ（get_table_columns）と照合し、
+  綴り違い程度であれば difflib で最も近い名前に置き換える
+- 直せなかった問題だけをエラーとして返し、呼び出し側はそのときだけGeminiに修正を依頼する
+構文解析には sqlglot（BigQuery方言）を使う。インストールされていない場合、列名と構文の検査は省略する
+"""
+import os
+import re
+from difflib import get_close_matches
+from prompts import get_table_columns
+
+SQL_VALIDATION_ENABLED = os.environ.get("SQL_VALIDATION_ENABLED", "true").lower() == "true"
+# 列名・テーブル名を綴り違いとして置き換える類似度の下限
+SQL_REPAIR_CUTOFF = float(os.environ.get("SQL_REPAIR_CUTOFF", "0.8"))
+
+_FENCE_PATTERN = re.compile(r"```(?:sql|SQL)?")
+# 全角のバッククォートや、Geminiが出力しがちな引用符の代用文字
+_QUOTE_LIKE_CHARS = str.maketrans({"｀": "`", "´": "`", "‘": "'", "’": "'", "“": '"', "”": '"'})
+# FROM / JOIN の直後のテーブル参照（引用符なし・' " ` で囲まれたもの）
+_TABLE_REF_PATTERN = re.compile(r"\b(FROM|JOIN)\s+(`|'|\"|)([A-Za-z0-9_\-]+(?:\.[A-Za-z0-9_\-]+)*)\2", re.IGNORECASE)
+_LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+
+
+def clean_sql_text(sql: str, fixes: list) -> str:
+    """コードフェンス・代用引用符・末尾のセミコロンを取り除く"""
+    cleaned = _FENCE_PATTERN.sub("", sql or "").translate(_QUOTE_LIKE_CHARS).strip()
+    if cleaned.lower().startswith("sql\n"):
+        cleaned = cleaned[4:].strip()
+    stripped = cleaned.rstrip(";").rstrip()
+    if stripped != (sql or "").strip():
+        fixes.append("コードフェンス・引用符・末尾のセミコロンを整形しました")
+    return stripped
+
+def _resolve_table(table_id: str, catalog: dict):
+    """テーブル参照をカタログのテーブルIDに対応づける。見つからなければNone"""
+    if table_id in catalog:
+        return table_id
+    # データセットやプロジェクトを省略した参照は、テーブル名が一意に一致すれば補う
+    by_suffix = [known for known in catalog if known.split(".")[-1] == table_id.split(".")[-1]]
+    if len(by_suffix) == 1:
+        return by_suffix[0]
+    matches = get_close_matches(table_id, list(catalog), n=1, cutoff=SQL_REPAIR_CUTOFF)
+    return matches[0] if matches else None
+
+def _fix_table_references(sql: str, catalog: dict, fixes: list, errors: list):
+    """FROM / JOIN のテーブル参照をバッククォートで囲んだ正しいIDに揃え、(SQL, 参照テーブルの集合) を返す"""
+    tables = set()
+    cte_names = {name.lower() for name in re.findall(r"\b([A-Za-z_][A-Za-z0-9_]*)\s+AS\s*\(", sql, re.IGNORECASE)}
+
+    def _replace(match):
+        keyword, quote, table_id = match.groups()
+        if "." not in table_id and (table_id.lower() in cte_names or not quote):
+            # CTE名や EXTRACT(... FROM Date) の列名と区別できないため、テーブル名と完全に一致する場合のみ補う
+            resolved = next((known for known in catalog if known.split(".")[-1] == table_id), None)
+            if resolved is None or table_id.lower() in cte_names:
+                return match.group(0)
+        else:
+            resolved = _resolve_table(table_id, catalog)
+        if resolved is None:
+            errors.append(f"テーブル {table_id} は分析対象のテーブルにありません")
+            return match.group(0)
+        tables.add(resolved)
+        if resolved != table_id:
+            fixes.append(f"テーブル {table_id} を {resolved} に修正しました")
+        elif quote != "`":
+            fixes.append(f"テーブル {table_id} をバッククォートで囲みました")
+        return f"{keyword} `{resolved}`"
+
+    return _TABLE_REF_PATTERN.sub(_replace, sql), tables
+
+def _replace_identifier(sql: str, wrong: str, right: str) -> str:
+    """文字列リテラルの外にある識別子 wrong を right に置き換える"""
+    pattern = re.compile(rf"{_LITERAL_PATTERN.pattern}|`{re.escape(wrong)}`|\b{re.escape(wrong)}\b", re.IGNORECASE)
+
+    def _replace(match):
+        token = match.group(0)
+        if token[0] in "'\"":
+            return token
+        return f"`{right}`" if token.startswith("`") else right
+
+    return pattern.sub(_replace, sql)
+
+def _check_columns(sql: str, tables: set, catalog: dict, fixes: list, errors: list) -> str:
+    """sqlglot で構文を解析し、カタログにない列名を修正する。sqlglot がなければそのまま返す"""
+    try:
+        import sqlglot
+        from sqlglot import exp
+    except ImportError:
+        return sql
+
+    try:
+        tree = sqlglot.parse_one(sql, read="bigquery")
+    except sqlglot.errors.ParseError as e:
+        errors.append(f"SQLの構文エラー: {str(e).splitlines()[0]}")
+        return sql
+    if tree is None or not tables:
+        return sql
+
+    known = {}
+    for table in tables:
+        known.update({column.lower(): column for column in catalog[table]})
+    # SELECT句やCTE・サブクエリで付けた別名は、後続の句から列として参照できる
+    aliases = {alias.alias.lower() for alias in tree.find_all(exp.Alias)}
+    aliases |= {alias.name.lower() for alias in tree.find_all(exp.TableAlias) if alias.name}
+
+    for name in sorted({column.name for column in tree.find_all(exp.Column) if column.name}):
+        if name.lower() in known or name.lower() in aliases:
+            continue
+        matches = get_close_matches(name, list(known.values()), n=1, cutoff=SQL_REPAIR_CUTOFF)
+        if matches:
+            sql = _replace_identifier(sql, name, matches[0])
+            fixes.append(f"列 {name} を {matches[0]} に修正しました")
+        else:
+            errors.append(f"列 {name} は {', '.join(sorted(tables))} にありません")
+    return sql
+
+def validate_and_repair_sql(sql: str, catalog: dict = None):
+    """
+    SQLをローカルで検証し、機械的に直せる問題を修正する。
+    (修正後のSQL, 実施した修正のリスト, 修正できなかった問題のリスト) を返す。
+    """
+    fixes, errors = [], []
+    sql = clean_sql_text(sql, fixes)
+    if not SQL_VALIDATION_ENABLED:
+        return sql, fixes, errors
+    if not sql:
+        return sql, fixes, ["SQLが空です"]
+
+    catalog = catalog if catalog is not None else get_table_columns()
+    if ";" in _LITERAL_PATTERN.sub("''", sql):
+        errors.append("複数のSQL文が含まれています。SELECT文を1つだけ出力してください")
+    sql, tables = _fix_table_references(sql, catalog, fixes, errors)
+    sql = _check_columns(sql, tables, catalog, fixes, errors)
+    return sql, fixes, errors
+
+def describe_problems(problems: list) -> str:
+    """問題のリストをGeminiへの修正依頼に埋め込む文字列に変換する"""
+    return "\n".join(f"- {problem}" for problem in problems)
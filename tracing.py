@@ -0,0 +1,159 @@
+# tracing.py
+"""
+分析パイプラインの段階別の処理時間を記録するトレーシング
+- OpenTelemetry と同じく、トレースID・スパンID・親スパンID・属性を持つスパンを入れ子で記録する
+- ルートスパンが終了した時点で、トレース内の全スパンを1行1スパンのJSONで出力する
+  （TRACE_LOG_PATH 未設定時は標準出力。Cloud Run では構造化ログとして扱われる）
+- BigQuery のスキャンバイト数・スロット時間・行数や、LLM のトークン数はスパンの属性として記録する
+現在のスパンは contextvars で管理するため、ワーカースレッドで作ったスパンは別のトレースになる
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import datetime
+import threading
+import contextvars
+from contextlib import contextmanager
+
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "true").lower() == "true"
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", "")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """1つの処理段階の開始・終了時刻と属性"""
+
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start_time = time.time()
+        self.end_time = None
+        # 同じトレースの終了済みスパン（ルートスパンが保持する）
+        self.finished = [] if parent is None else parent.finished
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_time if self.end_time is not None else time.time()
+        return (end - self.start_time) * 1000
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_to_attribute(self, key: str, value):
+        """数値の属性に加算する（同じスパン内で複数回呼ばれるLLM呼び出しのトークン数など）"""
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def record_error(self, error: BaseException):
+        self.status = "error"
+        self.attributes["error.type"] = type(error).__name__
+        self.attributes["error.message"] = str(error)[:300]
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "start": datetime.datetime.fromtimestamp(self.start_time).isoformat(timespec="milliseconds"),
+            "duration_ms": round(self.duration_ms, 1),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class JsonLinesExporter:
+    """終了したスパンを1行1件のJSONとして書き出す"""
+
+    def __init__(self, path: str = TRACE_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: list):
+        lines = [json.dumps({"type": "trace_span", **span}, ensure_ascii=False, default=str) for span in spans]
+        if not lines:
+            return
+        with self._lock:
+            try:
+                if self.path:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write("\n".join(lines) + "\n")
+                else:
+                    print("\n".join(lines), file=sys.stdout, flush=True)
+            except Exception as e:
+                print(f"Failed to export trace: {e}")
+
+
+_exporter = JsonLinesExporter()
+
+def set_exporter(exporter):
+    """スパンの出力先を差し替える（export(spans) を持つオブジェクト）"""
+    global _exporter
+    _exporter = exporter
+
+def current_span():
+    """実行中のスパンを返す。なければNone"""
+    return _current_span.get()
+
+def set_current_attributes(**attributes):
+    """実行中のスパンがあれば属性を設定する"""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attributes(**attributes)
+
+@contextmanager
+def start_span(name: str, **attributes):
+    """
+    スパンを開始し、ブロックの終了時に終了する。
+    実行中のスパンがあればその子スパンになり、なければ新しいトレースのルートスパンになる。
+    """
+    parent = _current_span.get()
+    span = Span(name, parent, attributes)
+    if not TRACE_ENABLED:
+        yield span
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        if isinstance(e, Exception):
+            span.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end_time = time.time()
+        span.finished.append(span.to_dict())
+        if parent is None:
+            _exporter.export(span.finished)
+
+def record_bigquery_job(query_job, rows: int = None):
+    """BigQueryジョブの統計（スキャンバイト数・スロット時間・キャッシュ利用）を実行中のスパンに記録する"""
+    span = _current_span.get()
+    if span is None:
+        return
+    for attribute, key in (("total_bytes_processed", "bq.bytes_processed"), ("slot_millis", "bq.slot_ms"),
+                           ("cache_hit", "bq.cache_hit"), ("job_id", "bq.job_id")):
+        value = getattr(query_job, attribute, None)
+        if value is not None:
+            span.set_attribute(key, value)
+    if rows is not None:
+        span.set_attribute("bq.rows", rows)
+
+def record_llm_usage(usage_metadata):
+    """Geminiの応答の usage_metadata からトークン数を実行中のスパンに加算する"""
+    span = _current_span.get()
+    if span is None or usage_metadata is None:
+        return
+    for attribute, key in (("prompt_token_count", "llm.prompt_tokens"), ("candidates_token_count", "llm.response_tokens")):
+        value = getattr(usage_metadata, attribute, None)
+        if value:
+            span.add_to_attribute(key, value)
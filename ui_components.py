@@ -1,9 +1,15 @@
 # ui_components.py
 import streamlit as st
-import io
 import pandas as pd
 from charting import render_plotly_chart
-from analysis_logic import run_analysis_flow, generate_ai_comment, rerun_sql_flow, modify_and_rerun_sql_flow
+from analysis_logic import run_analysis_flow, generate_ai_comment, rerun_sql_flow, modify_and_rerun_sql_flow, execute_analysis_sql
+from cost_guard import format_cost_estimate, make_job_config
+from result_policy import describe_result_meta, fetch_full_result
+from query_cache import dataframe_fingerprint
+from retry_policy import call_with_retry
+from exporter import EXPORT_FORMATS, ExportTooLarge, get_export_cache
+from history_store import add_history_entry
+from tracing import start_span
 
 ANALYSIS_RECIPES = {
     "自由入力": "",
@@ -13,6 +19,59 @@ ANALYSIS_RECIPES = {
     "デバイス別パフォーマンス比較": "先月の実績をデバイスカテゴリ別（PC, スマートフォン, タブレット）に集計し、デバイスごとのコンバージョン数とCPAを比較してください。"
     }
 
+def show_timing_panel():
+    """直近の分析の段階別処理時間（トレース）を折りたたみパネルで表示する"""
+    spans = list(st.session_state.get("last_trace") or [])
+    if chart_span := st.session_state.get("last_chart_span"):
+        spans.append(chart_span)
+    if not spans:
+        return
+    depth = {}
+    for span in sorted(spans, key=lambda s: s["start"]):
+        depth[span["span_id"]] = depth.get(span["parent_id"], -1) + 1 if span["parent_id"] else 0
+    rows = []
+    for span in sorted(spans, key=lambda s: s["start"]):
+        attributes = span["attributes"]
+        rows.append({
+            "段階": "　" * depth[span["span_id"]] + span["name"],
+            "時間(ms)": span["duration_ms"],
+            "行数": attributes.get("bq.rows", attributes.get("rows")),
+            "スキャン(MB)": round(attributes["bq.bytes_processed"] / 1024 / 1024, 1) if attributes.get("bq.bytes_processed") else None,
+            "スロット(ms)": attributes.get("bq.slot_ms"),
+            "トークン(入力/出力)": f"{attributes['llm.prompt_tokens']}/{attributes.get('llm.response_tokens', 0)}" if attributes.get("llm.prompt_tokens") else None,
+            "状態": span["status"],
+        })
+    with st.expander("⏱️ 処理時間の内訳", expanded=False):
+        st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
+def result_fingerprint(df: pd.DataFrame) -> str:
+    """結果の内容ハッシュを、同じDataFrameに対しては再計算せずに返す"""
+    memo = st.session_state.get("fingerprint_memo")
+    if memo is None or memo["df"] is not df:
+        memo = {"df": df, "fingerprint": dataframe_fingerprint(df)}
+        st.session_state.fingerprint_memo = memo
+    return memo["fingerprint"]
+
+def show_export_buttons(df: pd.DataFrame, basename: str, key: str, fingerprint: str = None):
+    """
+    出力形式ごとに「作成」ボタンを表示し、押された形式のファイルだけを作成してダウンロードボタンに切り替える。
+    作成済みのファイルは結果の内容ハッシュで共有キャッシュから取り出す。
+    """
+    fingerprint = fingerprint or result_fingerprint(df)
+    cache = get_export_cache()
+    cols = st.columns(len(EXPORT_FORMATS))
+    for col, (fmt, (label, extension, mime)) in zip(cols, EXPORT_FORMATS.items()):
+        with col:
+            data = cache.peek(fingerprint, fmt)
+            if data is None and st.button(f"{label}を作成", key=f"{key}_build_{fmt}"):
+                with st.spinner(f"{label}ファイルを作成中です..."):
+                    try:
+                        data = cache.get_or_build(df, fingerprint, fmt)
+                    except ExportTooLarge as e:
+                        st.warning(str(e))
+            if data is not None:
+                st.download_button(f"{label}形式でDL", data, f"{basename}.{extension}", mime, key=f"{key}_dl_{fmt}")
+
 def show_analysis_workbench(sheet_analysis_queries):
     """右側の分析ワークベンチUIを描画する"""
     st.header("🤖 AIアシスタント分析")
@@ -43,6 +102,10 @@ def show_analysis_workbench(sheet_analysis_queries):
         st.session_state.recipe_selection_old = recipe_selection
 
         user_input = st.text_area("分析指示:", key="user_input_main", height=150)
+        speculative = st.checkbox(
+            "複数のSQL候補を並列に試す", key="speculative_sql",
+            help="曖昧な指示向け。候補SQLを並列に生成・見積もりし、最もスキャン量の少ない有効な候補を実行します。"
+        )
 
         if st.button("分析を実行する", type="primary"):
             run_analysis_flow(
@@ -51,10 +114,29 @@ def show_analysis_workbench(sheet_analysis_queries):
                 st.session_state.apply_date_filter,
                 st.session_state.apply_media_filter,
                 st.session_state.apply_campaign_filter,
-                sheet_analysis_queries
+                sheet_analysis_queries,
+                speculative=speculative
             )
             st.session_state.editable_sql = st.session_state.get("sql", "")
 
+        # スキャン量が確認閾値を超えたSQLは、ユーザーの確認後に実行する
+        if pending := st.session_state.get("pending_sql"):
+            with st.container(border=True):
+                st.warning("スキャン量の大きいクエリです。実行してよろしいですか？")
+                if estimate := st.session_state.get("cost_estimate"):
+                    st.caption(format_cost_estimate(estimate))
+                st.code(pending["sql"], language="sql")
+                confirm_cols = st.columns(2)
+                with confirm_cols[0]:
+                    if st.button("このまま実行する", type="primary"):
+                        execute_analysis_sql(pending["user_input"], pending["sql"], cache_key=pending.get("cache_key"), alternatives=pending.get("alternatives"))
+                        st.session_state.editable_sql = st.session_state.get("sql", "")
+                        st.rerun()
+                with confirm_cols[1]:
+                    if st.button("キャンセル"):
+                        st.session_state.pending_sql = None
+                        st.rerun()
+
         if not st.session_state.get("df", pd.DataFrame()).empty:
             with st.expander("実行結果プレビュー ＆ 対話で分析を修正", expanded=True):
                 st.dataframe(st.session_state.df.head())
@@ -84,6 +166,8 @@ def show_analysis_workbench(sheet_analysis_queries):
     with tab2:
         if not st.session_state.get("df", pd.DataFrame()).empty:
             st.subheader("📈 分析結果")
+            if result_note := describe_result_meta(st.session_state.get("result_meta")):
+                st.caption(f"⚠️ {result_note}全件データは「③ SQL・データ」タブからダウンロードできます。")
 
             with st.expander("グラフ設定の表示/変更", expanded=True):
                 cfg = st.session_state.get("graph_cfg", {})
@@ -116,7 +200,9 @@ def show_analysis_workbench(sheet_analysis_queries):
                     cfg["legend_col"] = st.selectbox("凡例 (色分け)", legend_options, index=legend_index)
 
             st.session_state.graph_cfg = cfg
-            st.session_state.fig = render_plotly_chart(st.session_state.df, st.session_state.graph_cfg)
+            with start_span("chart.build", rows=len(st.session_state.df)) as chart_span:
+                st.session_state.fig = render_plotly_chart(st.session_state.df, st.session_state.graph_cfg)
+            st.session_state.last_chart_span = chart_span.to_dict()
             st.plotly_chart(st.session_state.fig, use_container_width=True)
 
             st.markdown("##### 🤖 AIによる分析コメント")
@@ -125,15 +211,18 @@ def show_analysis_workbench(sheet_analysis_queries):
             action_cols = st.columns(2)
             with action_cols[0]:
                 if st.button("コメントを再生成"):
-                    st.session_state.comment = generate_ai_comment(st.session_state.model, st.session_state.df, st.session_state.graph_cfg)
+                    st.session_state.comment = generate_ai_comment(st.session_state.model, st.session_state.df, st.session_state.graph_cfg, st.session_state.get("result_meta"), force_refresh=True, placeholder=st.empty())
                     st.rerun()
             with action_cols[1]:
                 if st.button("この分析を履歴に保存", icon="💾"):
                     user_input_for_history = st.session_state.get("user_input_main", "手動修正による分析")
-                    history_entry = { "user_input": user_input_for_history, "sql": st.session_state.sql, "df": st.session_state.df, "graph_cfg": st.session_state.graph_cfg, "comment": st.session_state.comment }
-                    st.session_state.analysis_history.append(history_entry)
-                    if len(st.session_state.analysis_history) > 10: st.session_state.analysis_history.pop(0)
+                    add_history_entry(
+                        st.session_state.analysis_history, user_input_for_history, st.session_state.sql, st.session_state.df,
+                        st.session_state.graph_cfg, st.session_state.comment, st.session_state.get("result_meta"),
+                        fingerprint=result_fingerprint(st.session_state.df),
+                    )
                     st.toast("現在の分析を履歴に保存しました！", icon="✅")
+            show_timing_panel()
         else:
             st.info("「① 指示・対話」タブから分析を実行してください。")
 
@@ -142,6 +231,11 @@ def show_analysis_workbench(sheet_analysis_queries):
             st.subheader("🔍 SQLと生データ")
             with st.expander("SQLの確認・修正 ▼", expanded=False):
                 st.code(st.session_state.get("sql", ""), language="sql")
+                if estimate := st.session_state.get("cost_estimate"):
+                    st.caption(format_cost_estimate(estimate))
+                if attempts := st.session_state.get("execution_attempts"):
+                    st.caption("実行の試行履歴（分類・所要時間）")
+                    st.dataframe(pd.DataFrame(attempts), hide_index=True, use_container_width=True)
                 edited_sql = st.text_area("SQLを直接編集して再実行できます:", value=st.session_state.get("editable_sql", ""), height=150, key="sql_edit_area")
                 if st.button("SQLを直接修正して再実行"):
                     rerun_sql_flow(
@@ -154,13 +248,25 @@ def show_analysis_workbench(sheet_analysis_queries):
                     )
             with st.expander("テーブルデータとダウンロード"):
                 st.dataframe(st.session_state.df)
-                dl_cols = st.columns(2)
-                with dl_cols[0]:
-                    df_csv = st.session_state.df.to_csv(index=False).encode("utf-8-sig")
-                    st.download_button("CSV形式でDL", df_csv, "result.csv", "text/csv")
-                with dl_cols[1]:
-                    excel_buf = io.BytesIO()
-                    st.session_state.df.to_excel(excel_buf, index=False, sheet_name="Result", engine="xlsxwriter")
-                    st.download_button("Excel形式でDL", excel_buf, "result.xlsx")
+                show_export_buttons(st.session_state.df, "result", key="result_export")
+
+                # 表示用に行数を絞った・集計した結果の場合は、全件データを別途取得する
+                result_meta = st.session_state.get("result_meta")
+                if describe_result_meta(result_meta):
+                    st.caption(describe_result_meta(result_meta))
+                    if st.button("全件データを取得する"):
+                        with st.spinner("全件データをBigQueryから取得中です..."):
+                            try:
+                                df_full = call_with_retry(
+                                    lambda: fetch_full_result(st.session_state.bq_client, result_meta, job_config=make_job_config()),
+                                    label="full_result",
+                                )
+                                st.session_state.full_result = {"sql": result_meta["full_sql"], "df": df_full, "fingerprint": dataframe_fingerprint(df_full)}
+                            except Exception as e:
+                                st.error(f"全件データを取得できませんでした: {e}")
+                    full_result = st.session_state.get("full_result")
+                    if full_result and full_result["sql"] == result_meta["full_sql"]:
+                        st.caption(f"全件データ: {len(full_result['df']):,}行")
+                        show_export_buttons(full_result["df"], "result_full", key="full_export", fingerprint=full_result["fingerprint"])
         else:
             st.info("分析を実行すると、ここにSQLとデータが表示されます。")
\ No newline at end of file